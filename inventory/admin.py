@@ -1,15 +1,64 @@
 # inventory/admin.py
+from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Prefetch
+from django.utils.functional import cached_property
 from .models import Warehouse, Customer, Product, WarehouseStock, StockTransaction
 
+
+# Never analyzed tables and partitions report -1 rows
+ROW_ESTIMATE_SQL = """
+    SELECT CASE WHEN parent.relkind = 'p' THEN (
+        SELECT COALESCE(SUM(GREATEST(child.reltuples, 0)), 0) FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = parent.oid
+    ) ELSE parent.reltuples END::bigint
+    FROM pg_class parent WHERE parent.oid = %s::regclass
+"""
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Counting every row of a big table on each changelist page is slow on
+    PostgreSQL, so unfiltered lists use the planner's row estimate once it
+    exceeds ADMIN_EXACT_COUNT_LIMIT. A partitioned table has no estimate of
+    its own, so those of its partitions are added up
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(ROW_ESTIMATE_SQL, [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row and row[0] > settings.ADMIN_EXACT_COUNT_LIMIT:
+                return row[0]
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables that grow with every stock movement"""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 class WarehouseAdmin(admin.ModelAdmin):
     list_display = ('name', 'location', 'get_authorized_users', 'created_at')
     search_fields = ('name', 'location')
-    filter_horizontal = ('authorized_users',)
+    autocomplete_fields = ('authorized_users',)
     list_filter = ('location',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('authorized_users', queryset=User.objects.only('username').order_by('username'))
+        )
+
     def get_authorized_users(self, obj):
         return ", ".join([user.username for user in obj.authorized_users.all()])
     get_authorized_users.short_description = 'Authorized Users'
@@ -24,19 +73,35 @@ class ProductAdmin(admin.ModelAdmin):
     search_fields = ('name', 'sku')
     list_filter = ('created_at',)
 
-class WarehouseStockAdmin(admin.ModelAdmin):
-    list_display = ('warehouse', 'product', 'quantity', 'updated_at')
-    list_filter = ('warehouse', 'product')
-    search_fields = ('warehouse__name', 'product__name')
+class WarehouseStockAdmin(LargeTableAdmin):
+    list_display = ('warehouse', 'product', 'quantity', 'reserved', 'updated_at')
+    list_select_related = ('warehouse', 'product')
+    # Products are found through the search box; a filter would list them all
+    list_filter = ('warehouse',)
+    search_fields = ('warehouse__name', 'product__name', 'product__sku')
+    autocomplete_fields = ('warehouse', 'product')
 
-class StockTransactionAdmin(admin.ModelAdmin):
-    list_display = ('get_transaction_details', 'product', 'quantity', 'transaction_type', 
+class StockTransactionAdmin(LargeTableAdmin):
+    list_display = ('get_transaction_details', 'product', 'quantity', 'transaction_type',
                    'transfer_type', 'performed_by', 'created_at')
+    list_select_related = (
+        'source_warehouse', 'destination_warehouse', 'customer', 'product', 'performed_by'
+    )
     list_filter = ('transaction_type', 'transfer_type', 'created_at')
-    search_fields = ('product__name', 'source_warehouse__name', 
+    search_fields = ('product__name', 'source_warehouse__name',
                     'destination_warehouse__name', 'customer__name')
+    autocomplete_fields = (
+        'source_warehouse', 'destination_warehouse', 'customer', 'product', 'performed_by'
+    )
     readonly_fields = ('created_at', 'updated_at')
 
+    # Recorded transactions are part of the stock ledger
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
     def get_transaction_details(self, obj):
         if obj.transaction_type == 'WW':
             return f"{obj.source_warehouse} → {obj.destination_warehouse}"
@@ -48,7 +113,12 @@ class StockTransactionAdmin(admin.ModelAdmin):
 
 class CustomUserAdmin(UserAdmin):
     list_display = UserAdmin.list_display + ('get_warehouses',)
-    
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(
+            Prefetch('authorized_warehouses', queryset=Warehouse.objects.only('name').order_by('name'))
+        )
+
     def get_warehouses(self, obj):
         return ", ".join([warehouse.name for warehouse in obj.authorized_warehouses.all()])
     get_warehouses.short_description = 'Assigned Warehouses'
@@ -62,4 +132,4 @@ admin.site.register(Warehouse, WarehouseAdmin)
 admin.site.register(Customer, CustomerAdmin)
 admin.site.register(Product, ProductAdmin)
 admin.site.register(WarehouseStock, WarehouseStockAdmin)
-admin.site.register(StockTransaction, StockTransactionAdmin)
\ No newline at end of file
+admin.site.register(StockTransaction, StockTransactionAdmin)
@@ -0,0 +1,210 @@
+"""
+Monthly partitions and archives of the stock transaction table. On
+PostgreSQL the table is partitioned by created_at per UTC calendar month;
+elsewhere months are only the unit of archiving. Closed months older than
+TRANSACTION_ARCHIVE_AFTER_MONTHS are written to gzipped NDJSON files and
+removed from the database, and exports read them back from there
+"""
+import gzip
+import json
+import logging
+import os
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import Min
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import StockTransaction, StockTransactionArchive, month_start, add_months
+from .serializers import StockTransactionRowSerializer
+
+logger = logging.getLogger(__name__)
+
+
+def partition_name(month):
+    return f'{StockTransaction._meta.db_table}_{month:%Y_%m}'
+
+
+def default_partition_name():
+    return f'{StockTransaction._meta.db_table}_default'
+
+
+def is_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass',
+            [StockTransaction._meta.db_table]
+        )
+        return cursor.fetchone() is not None
+
+
+def create_partitions(months_ahead=None):
+    """
+    Create any missing monthly partitions from the current month to
+    months_ahead months on, before rows for them land in the default
+    partition. Rows that already did are moved into the new partition.
+    Returns the names of the partitions created
+    """
+    if months_ahead is None:
+        months_ahead = settings.TRANSACTION_PARTITION_MONTHS_AHEAD
+    connection = connections[router.db_for_write(StockTransaction)]
+    if not is_partitioned(connection):
+        return []
+
+    current = month_start(timezone.now())
+    created = []
+    for offset in range(months_ahead + 1):
+        month = add_months(current, offset)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT to_regclass(%s)', [partition_name(month)])
+            if cursor.fetchone()[0] is not None:
+                continue
+        create_partition(connection, month)
+        created.append(partition_name(month))
+    return created
+
+
+def create_partition(connection, month):
+    """
+    Create the partition of month. PostgreSQL refuses to while the default
+    partition holds rows of the month, so those are moved into the new
+    table before it is attached
+    """
+    qn = connection.ops.quote_name
+    table = qn(StockTransaction._meta.db_table)
+    name = qn(partition_name(month))
+    default = qn(default_partition_name())
+    bounds = f"FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+    in_month = 'created_at >= %s AND created_at < %s'
+    params = [month, add_months(month, 1)]
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        # Keeps rows of the month from landing in the default partition meanwhile
+        cursor.execute(f'LOCK TABLE {default} IN SHARE ROW EXCLUSIVE MODE')
+        cursor.execute(f'SELECT 1 FROM {default} WHERE {in_month} LIMIT 1', params)
+        if cursor.fetchone() is None:
+            cursor.execute(f'CREATE TABLE {name} PARTITION OF {table} FOR VALUES {bounds}')
+            return
+        cursor.execute(f'CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        cursor.execute(f'INSERT INTO {name} SELECT * FROM {default} WHERE {in_month}', params)
+        cursor.execute(f'DELETE FROM {default} WHERE {in_month}', params)
+        cursor.execute(f'ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES {bounds}')
+
+
+def archive_month(month):
+    """
+    Write the transactions created in the closed month starting at month
+    to an archive file, then remove them from the database; on PostgreSQL
+    by dropping the month's partition and deleting any of its rows from the
+    default partition. Returns the StockTransactionArchive, or None when
+    the month has no transactions
+    """
+    end = add_months(month, 1)
+    if end > month_start(timezone.now()):
+        raise ValueError('Only closed months can be archived')
+    transactions = StockTransaction.objects.filter(created_at__gte=month, created_at__lt=end)
+    rows = StockTransactionRowSerializer.get_queryset(transactions.order_by('created_at', 'id'))
+
+    directory = Path(settings.TRANSACTION_ARCHIVE_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"stock_transactions_{month:%Y_%m}_{timezone.now():%Y%m%d%H%M%S}.ndjson.gz"
+    temporary = path.with_name(f'{path.name}.tmp')
+    written = 0
+    with gzip.open(temporary, 'wt', encoding='utf-8') as archive_file:
+        for row in rows.iterator(chunk_size=settings.EXPORT_CHUNK_SIZE):
+            for field in StockTransactionRowSerializer.datetime_fields:
+                row[field] = row[field].isoformat()
+            archive_file.write(json.dumps(row, separators=(',', ':')))
+            archive_file.write('\n')
+            written += 1
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+    if not written:
+        temporary.unlink()
+        return None
+    os.replace(temporary, path)
+
+    connection = connections[router.db_for_write(StockTransaction)]
+    qn = connection.ops.quote_name
+    with transaction.atomic(using=connection.alias):
+        partition = None
+        if is_partitioned(connection):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT to_regclass(%s)', [partition_name(month)])
+                partition = cursor.fetchone()[0]
+                # Nothing may slip into the month between the count and the drop
+                if partition is not None:
+                    cursor.execute(f'LOCK TABLE {qn(partition_name(month))} IN ACCESS EXCLUSIVE MODE')
+                cursor.execute(f'LOCK TABLE {qn(default_partition_name())} IN SHARE ROW EXCLUSIVE MODE')
+        if transactions.count() != written:
+            raise RuntimeError(f'Transactions of {month:%Y-%m} changed while they were archived')
+        archive = StockTransactionArchive.objects.create(month=month.date(), file=path.name, rows=written)
+        if partition is not None:
+            with connection.cursor() as cursor:
+                cursor.execute(f'DROP TABLE {qn(partition_name(month))}')
+        # Rows of the month outside its partition, or of a month without one
+        transactions.delete()
+    return archive
+
+
+def archive_closed_months(keep_months=None):
+    """
+    Archive every month with transactions that closed more than
+    keep_months months ago (TRANSACTION_ARCHIVE_AFTER_MONTHS by default).
+    Returns the new archives
+    """
+    if keep_months is None:
+        keep_months = settings.TRANSACTION_ARCHIVE_AFTER_MONTHS
+    horizon = add_months(month_start(timezone.now()), -keep_months)
+    oldest = StockTransaction.objects.filter(created_at__lt=horizon).aggregate(oldest=Min('created_at'))['oldest']
+    archives = []
+    month = month_start(oldest) if oldest is not None else horizon
+    while month < horizon:
+        archive = archive_month(month)
+        if archive is not None:
+            logger.info('Archived %s', archive)
+            archives.append(archive)
+        month = add_months(month, 1)
+    return archives
+
+
+def iter_archived_rows(start=None, end=None, warehouse_ids=None, warehouse_id=None, transaction_type=None):
+    """
+    Archived transaction rows, oldest first, that StockTransaction.objects
+    .matching() would have selected, with the same values as
+    StockTransactionRowSerializer.get_queryset(). The archives to read are
+    looked up right away; the files are read as the rows are consumed
+    """
+    archives = StockTransactionArchive.objects.all()
+    if start is not None:
+        archives = archives.filter(month__gte=month_start(start).date())
+    if end is not None:
+        archives = archives.filter(month__lte=month_start(end).date())
+    files = [Path(settings.TRANSACTION_ARCHIVE_DIR) / archive.file for archive in archives]
+    warehouse_ids = set(warehouse_ids) if warehouse_ids is not None else None
+    warehouse_id = int(warehouse_id) if warehouse_id is not None else None
+
+    def matches(row):
+        warehouses = {row['source_warehouse'], row['destination_warehouse']}
+        if warehouse_ids is not None and not warehouses & warehouse_ids:
+            return False
+        if warehouse_id is not None and warehouse_id not in warehouses:
+            return False
+        if transaction_type and row['transaction_type'] != transaction_type:
+            return False
+        return start is None or start <= row['created_at'] <= end
+
+    return (row for row in _read_archives(files) if matches(row))
+
+
+def _read_archives(files):
+    for path in files:
+        with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+            for line in archive_file:
+                row = json.loads(line)
+                for field in StockTransactionRowSerializer.datetime_fields:
+                    row[field] = parse_datetime(row[field])
+                yield row
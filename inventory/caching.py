@@ -0,0 +1,67 @@
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+
+def warehouse_generation_key(warehouse_id):
+    return f'warehouse_generation_{warehouse_id}'
+
+
+def get_warehouse_generations(warehouse_ids):
+    """
+    Current cache generation of each warehouse. Cached values derived from a
+    warehouse's stock embed its generation in their key, so bumping it makes
+    them unreachable without having to find and delete them
+    """
+    keys = {warehouse_generation_key(warehouse_id): warehouse_id for warehouse_id in warehouse_ids}
+    generations = {keys[key]: value for key, value in cache.get_many(keys).items()}
+    for key, warehouse_id in keys.items():
+        if warehouse_id not in generations:
+            # Start from the clock rather than 0 so an evicted counter never
+            # revives entries cached under an earlier generation
+            cache.add(key, time.time_ns(), timeout=None)
+            generations[warehouse_id] = cache.get(key)
+    return generations
+
+
+def bump_warehouse_generations(warehouse_ids):
+    """Invalidate everything cached for the warehouses once the current transaction commits"""
+    warehouse_ids = {warehouse_id for warehouse_id in warehouse_ids if warehouse_id}
+    if warehouse_ids:
+        transaction.on_commit(lambda: _bump(warehouse_ids))
+
+
+def _bump(warehouse_ids):
+    for warehouse_id in warehouse_ids:
+        key = warehouse_generation_key(warehouse_id)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def delete_on_commit(keys):
+    """
+    Delete cache keys once the current transaction commits. Deleted any
+    earlier, a concurrent request could cache the uncommitted, old state
+    again before the change becomes visible
+    """
+    keys = list(keys)
+    if keys:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+CRITICAL_STOCK_EVENTS_KEY = 'critical_stock_events'
+
+
+def bump_critical_stock_events():
+    """Tell critical stock streams that new events were committed"""
+    transaction.on_commit(_bump_critical_stock_events)
+
+
+def _bump_critical_stock_events():
+    try:
+        cache.incr(CRITICAL_STOCK_EVENTS_KEY)
+    except ValueError:
+        cache.set(CRITICAL_STOCK_EVENTS_KEY, time.time_ns(), timeout=None)
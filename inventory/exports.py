@@ -0,0 +1,73 @@
+import csv
+import io
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+
+# Bytes collected before a chunk is handed to the response
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_csv(rows, fields):
+    """CSV with a header line, encoded in chunks; missing keys become empty cells"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, restval='', extrasaction='ignore')
+    writer.writeheader()
+    # Send the header right away so the client sees the first byte at once
+    yield _drain(buffer)
+    for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= CHUNK_SIZE:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def iter_ndjson(rows):
+    """One JSON document per line, encoded in chunks"""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write(json.dumps(row, separators=(',', ':')))
+        buffer.write('\n')
+        if buffer.tell() >= CHUNK_SIZE:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def iter_gzip(chunks):
+    """Gzip a stream of byte chunks, flushing after the first so it reaches the client immediately"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    flush_mode = zlib.Z_SYNC_FLUSH
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if flush_mode is not None:
+            compressed += compressor.flush(flush_mode)
+            flush_mode = None
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+async def aiter_chunks(chunks):
+    """
+    Async iterator over the chunks of a sync one, each produced in the sync
+    thread. Under ASGI a sync iterator would be read to the end before the
+    response starts
+    """
+    chunks = iter(chunks)
+    done = object()
+    try:
+        while (chunk := await sync_to_async(next)(chunks, done)) is not done:
+            yield chunk
+    finally:
+        # Closes the database cursor of an abandoned export in its own thread
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+def _drain(buffer):
+    data = buffer.getvalue().encode('utf-8')
+    buffer.seek(0)
+    buffer.truncate()
+    return data
@@ -0,0 +1,41 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+def check_database(alias):
+    with connections[alias].cursor() as cursor:
+        cursor.execute('SELECT 1')
+        cursor.fetchone()
+
+
+def check_cache():
+    cache.set('health_check', 'ok', timeout=10)
+    if cache.get('health_check') != 'ok':
+        raise RuntimeError('cache did not return the value just written')
+
+
+def run_health_checks():
+    """
+    Check every backing service, returning (healthy, {name: result}) where
+    result is the check's latency in milliseconds or the error message
+    """
+    checks = {f'database:{DEFAULT_DB_ALIAS}': lambda: check_database(DEFAULT_DB_ALIAS)}
+    if settings.REPLICA_DATABASE:
+        checks[f'database:{settings.REPLICA_DATABASE}'] = lambda: check_database(settings.REPLICA_DATABASE)
+    checks['cache'] = check_cache
+
+    results = {}
+    healthy = True
+    for name, check in checks.items():
+        start = time.perf_counter()
+        try:
+            check()
+        except Exception as e:
+            healthy = False
+            results[name] = f'error: {e}'
+        else:
+            results[name] = round((time.perf_counter() - start) * 1000, 2)
+    return healthy, results
@@ -0,0 +1,168 @@
+"""
+Stock lookups for handheld scanners. The views here run natively under
+ASGI: the ORM and cache are awaited, so one worker serves many concurrent
+lookups while waiting on the database
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.settings import api_settings as jwt_settings
+
+from .models import Product, WarehouseStock
+from .permissions import aget_authorized_warehouse_ids
+
+
+def product_sku_cache_key(sku):
+    return f'product_by_sku_{sku}'
+
+
+PRODUCT_SKU_GENERATION_KEY = 'product_sku_generation'
+
+
+class ProductIdCache:
+    """
+    In-process LRU of SKU to product id, so SKU filters can use the stock
+    table's product index without joining products. SKUs are only ever
+    reassigned by renaming or deleting a product, which bumps a shared
+    generation; every process drops its entries when it sees a new one
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def resolve(self, skus):
+        """Map each known SKU to its product id; unknown SKUs are left out"""
+        generation = cache.get(PRODUCT_SKU_GENERATION_KEY)
+        resolved, missing = {}, []
+        with self._lock:
+            if generation != self._generation:
+                self._ids.clear()
+                self._generation = generation
+            for sku in skus:
+                product_id = self._ids.get(sku)
+                if product_id is None:
+                    missing.append(sku)
+                else:
+                    self._ids.move_to_end(sku)
+                    resolved[sku] = product_id
+
+        if missing:
+            found = dict(Product.objects.filter(sku__in=missing).values_list('sku', 'id'))
+            resolved.update(found)
+            with self._lock:
+                if generation == self._generation:
+                    self._ids.update(found)
+                    while len(self._ids) > self.maxsize:
+                        self._ids.popitem(last=False)
+        return resolved
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+
+
+product_ids = ProductIdCache(settings.PRODUCT_ID_CACHE_SIZE)
+
+
+def forget_product_skus():
+    """Drop SKU to id mappings in every process once the current transaction commits"""
+    def bump():
+        product_ids.clear()
+        try:
+            cache.incr(PRODUCT_SKU_GENERATION_KEY)
+        except ValueError:
+            cache.set(PRODUCT_SKU_GENERATION_KEY, time.time_ns(), timeout=None)
+    transaction.on_commit(bump)
+
+
+async def aauthenticate(request):
+    """The active user of the request's JWT bearer token, or None"""
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    try:
+        raw_token = authentication.get_raw_token(header) if header else None
+        if raw_token is None:
+            return None
+        token = authentication.get_validated_token(raw_token)
+    except AuthenticationFailed:
+        return None
+    return await User.objects.filter(
+        **{jwt_settings.USER_ID_FIELD: token.get(jwt_settings.USER_ID_CLAIM)}, is_active=True
+    ).afirst()
+
+
+async def aget_product_by_sku(sku):
+    """Id, name, sku and minimum stock of the product with this SKU, cached"""
+    cache_key = product_sku_cache_key(sku)
+    product = await cache.aget(cache_key)
+    if product is None:
+        product = await Product.objects.filter(sku=sku).values(
+            'id', 'name', 'sku', 'minimum_stock'
+        ).afirst()
+        if product is not None:
+            await cache.aset(cache_key, product, timeout=settings.PRODUCT_SKU_CACHE_TIMEOUT)
+    return product
+
+
+def stock_rows():
+    return WarehouseStock.objects.values(
+        'warehouse', 'product', 'quantity', 'reserved', 'minimum_stock', 'updated_at',
+        warehouse_name=F('warehouse__name'),
+        product_name=F('product__name'),
+        sku=F('product__sku'),
+    )
+
+
+def error(detail, status):
+    return JsonResponse({'detail': detail}, status=status)
+
+
+@require_GET
+async def stock_lookup(request, warehouse_id, product_id):
+    """Stock of one product in one warehouse"""
+    user = await aauthenticate(request)
+    if user is None:
+        return error('Authentication credentials were not provided.', 401)
+    if not user.is_staff and warehouse_id not in await aget_authorized_warehouse_ids(user):
+        return error('Not found.', 404)
+
+    stock = await stock_rows().filter(warehouse_id=warehouse_id, product_id=product_id).afirst()
+    if stock is None:
+        return error('Not found.', 404)
+    return JsonResponse(stock)
+
+
+@require_GET
+async def stock_lookup_by_sku(request, sku):
+    """Stock of a product in every warehouse the user may see, or in ?warehouse= only"""
+    user = await aauthenticate(request)
+    if user is None:
+        return error('Authentication credentials were not provided.', 401)
+
+    product = await aget_product_by_sku(sku)
+    if product is None:
+        return error('Not found.', 404)
+
+    stocks = stock_rows().filter(product_id=product['id']).order_by('warehouse_id')
+    if not user.is_staff:
+        stocks = stocks.filter(warehouse_id__in=await aget_authorized_warehouse_ids(user))
+    warehouse_id = request.GET.get('warehouse')
+    if warehouse_id:
+        if not warehouse_id.isdigit():
+            return error('warehouse must be an id.', 400)
+        stocks = stocks.filter(warehouse_id=warehouse_id)
+
+    return JsonResponse({'product': product, 'results': [stock async for stock in stocks]})
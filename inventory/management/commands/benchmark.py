@@ -0,0 +1,210 @@
+import json
+import random
+import statistics
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from inventory.metrics import collect_metrics
+from inventory.models import Warehouse, Customer, Product, WarehouseStock
+from inventory.synthetic import SCALES, generate_dataset, product_sku
+from inventory.tasks import send_stock_status_report
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / 'benchmarks' / 'baseline.json'
+BULK_ROWS = 1000
+BULK_TARGET_ROWS_PER_S = 10000
+
+
+class Command(BaseCommand):
+    help = (
+        'Generate a seeded synthetic inventory in the test database and time the '
+        'hot paths: creating a transaction, a bulk upload, listing transactions, the warehouse '
+        'summary, stock lookups and the daily stock report. Results are written '
+        'as JSON and compared with a stored baseline; more queries than the '
+        'baseline, or a median more than --tolerance slower, fails the command. '
+        'Runs on whichever database backend is configured.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scale', choices=SCALES, default='small')
+        parser.add_argument('--warehouses', type=int, help='Overrides the scale')
+        parser.add_argument('--products', type=int, help='Overrides the scale')
+        parser.add_argument('--transactions', type=int, help='Overrides the scale')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--output', help='Write the results to this JSON file')
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE))
+        parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+        parser.add_argument('--tolerance', type=float, default=0.5,
+                            help='Allowed median slowdown against the baseline, as a fraction')
+        parser.add_argument('--keepdb', action='store_true',
+                            help='Keep the test database and reuse its data on the next run')
+
+    def handle(self, *args, **options):
+        scale = dict(SCALES[options['scale']])
+        for name in scale:
+            if options[name] is not None:
+                scale[name] = options[name]
+        if scale['warehouses'] < 2:
+            raise CommandError('At least two warehouses are needed for transfers')
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        try:
+            # Keep benchmark traffic away from the shared cache, mail server,
+            # Celery broker and replica, none of which hold the test database,
+            # and accept the test client's host as the test runner would
+            with override_settings(
+                ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+                EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+                REPLICA_DATABASE=None,
+            ):
+                dataset = self.dataset(scale, options['seed'])
+                results = {
+                    'database': connection.vendor,
+                    'scale': scale,
+                    'seed': options['seed'],
+                    'scenarios': self.run_scenarios(dataset, options['seed'], options['repeat']),
+                }
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            Path(options['output']).write_text(output + '\n')
+        self.stdout.write(output)
+
+        baseline_path = Path(options['baseline'])
+        if options['save_baseline']:
+            baseline_path.parent.mkdir(parents=True, exist_ok=True)
+            baseline_path.write_text(output + '\n')
+            self.stdout.write(f'Saved baseline to {baseline_path}')
+        elif baseline_path.exists():
+            self.compare(results, json.loads(baseline_path.read_text()), options['tolerance'])
+        else:
+            self.stdout.write(f'No baseline at {baseline_path}; store one with --save-baseline')
+
+    def dataset(self, scale, seed):
+        if Warehouse.objects.exists():
+            self.stdout.write('Reusing the data kept in the test database')
+            return {
+                'admin_user': User.objects.get(username='benchmark-admin').id,
+                'user': User.objects.get(username='benchmark-user').id,
+                'warehouses': list(Warehouse.objects.order_by('id').values_list('id', flat=True)),
+                'customers': list(Customer.objects.order_by('id').values_list('id', flat=True)),
+                'products': list(Product.objects.order_by('id').values_list('id', flat=True)),
+            }
+        start = time.perf_counter()
+        dataset = generate_dataset(seed=seed, log=lambda message: self.stderr.write(f'  {message}'), **scale)
+        self.stderr.write(f'Generated in {time.perf_counter() - start:.1f}s')
+        return dataset
+
+    def run_scenarios(self, dataset, seed, repeat):
+        rng = random.Random(seed)
+        admin_client = APIClient()
+        admin_client.force_authenticate(User.objects.get(pk=dataset['admin_user']))
+        user_client = APIClient()
+        user_client.force_authenticate(User.objects.get(pk=dataset['user']))
+
+        # Entries into well stocked rows, so no critical stock alert is queued
+        stocks = list(WarehouseStock.objects.filter(quantity__gte=100).values_list('warehouse_id', 'product_id')[:1000])
+        product_count = len(dataset['products'])
+
+        def create_transaction():
+            warehouse_id, product_id = rng.choice(stocks)
+            return admin_client.post('/api/stock-transactions/', {
+                'destination_warehouse': warehouse_id, 'customer': rng.choice(dataset['customers']),
+                'product': product_id, 'quantity': 1, 'transaction_type': 'CW'
+            }, format='json')
+
+        def bulk_create():
+            rows = []
+            for _ in range(BULK_ROWS):
+                warehouse_id, product_id = rng.choice(stocks)
+                rows.append({
+                    'destination_warehouse': warehouse_id, 'customer': rng.choice(dataset['customers']),
+                    'product': product_id, 'quantity': 1, 'transaction_type': 'CW'
+                })
+            return admin_client.post('/api/stock-transactions/bulk_create/', rows, format='json')
+
+        def report():
+            with collect_metrics() as metrics:
+                send_stock_status_report()
+            mail.outbox = []
+            return metrics
+
+        scenarios = {
+            'transaction_create': create_transaction,
+            'transaction_bulk_create': bulk_create,
+            'transaction_list': lambda: user_client.get('/api/stock-transactions/', {'page_size': 1000}),
+            'warehouse_summary': lambda: admin_client.get('/api/stock-transactions/warehouse_summary/'),
+            'stock_lookup_sku': lambda: user_client.get('/api/warehouse-stocks/', {
+                'sku': product_sku(rng.randrange(product_count))
+            }),
+            'stock_lookup_batch': lambda: user_client.post('/api/warehouse-stocks/lookup/', {
+                'skus': [product_sku(rng.randrange(product_count)) for _ in range(500)]
+            }, format='json'),
+            'stock_status_report': report,
+        }
+        results = {}
+        for name, scenario in scenarios.items():
+            repeats = max(1, repeat // 10) if name == 'stock_status_report' else repeat
+            self.stderr.write(f'Running {name}')
+            try:
+                results[name] = self.measure(scenario, repeats)
+            except (ImportError, OSError) as e:
+                # The PDF report needs WeasyPrint's system libraries
+                results[name] = {'skipped': str(e).splitlines()[0]}
+        bulk = results['transaction_bulk_create']
+        bulk['rows_per_s'] = round(BULK_ROWS / bulk['median_ms'] * 1000)
+        bulk['target_rows_per_s'] = BULK_TARGET_ROWS_PER_S
+        return results
+
+    def measure(self, scenario, repeat):
+        """Median and 95th percentile latency and the most queries over repeat runs, after one warm-up"""
+        scenario()
+        timings, queries = [], 0
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outcome = scenario()
+            timings.append(time.perf_counter() - start)
+            status_code = getattr(outcome, 'status_code', 200)
+            if status_code >= 400:
+                raise CommandError(f'Scenario failed with status {status_code}: {outcome.content[:200]}')
+            queries = max(queries, getattr(outcome, 'metrics', outcome).queries)
+        timings.sort()
+        return {
+            'median_ms': round(statistics.median(timings) * 1000, 2),
+            'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000, 2),
+            'queries': queries,
+        }
+
+    def compare(self, results, baseline, tolerance):
+        comparable_timings = all(
+            results[key] == baseline.get(key) for key in ('database', 'scale', 'seed')
+        )
+        if not comparable_timings:
+            self.stdout.write('Baseline was taken on another database or scale; comparing query counts only')
+
+        regressions = []
+        for name, result in results['scenarios'].items():
+            expected = baseline['scenarios'].get(name)
+            if not expected or 'skipped' in result or 'skipped' in expected:
+                continue
+            if result['queries'] > expected['queries']:
+                regressions.append(f"{name}: {result['queries']} queries, baseline {expected['queries']}")
+            if comparable_timings and result['median_ms'] > expected['median_ms'] * (1 + tolerance):
+                regressions.append(
+                    f"{name}: median {result['median_ms']} ms, baseline {expected['median_ms']} ms"
+                )
+        if regressions:
+            raise CommandError('Performance regressions:\n  ' + '\n  '.join(regressions))
+        self.stdout.write('No regressions against the baseline')
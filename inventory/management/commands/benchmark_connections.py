@@ -0,0 +1,57 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+from django.db.backends.signals import connection_created
+from django.test import Client
+from django.test.utils import override_settings
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare database connection churn and latency for API requests with '
+        'and without persistent connections.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--path', default='/api/health/')
+
+    def handle(self, *args, **options):
+        conn_max_age = settings.DATABASE_CONN_MAX_AGE or 60
+        for label, max_age in (('reconnect', 0), (f'persistent ({conn_max_age}s)', conn_max_age)):
+            # The test client sends Host: testserver
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                opened, elapsed = self.run(options['path'], options['requests'], max_age)
+            self.stdout.write(
+                f"{label:<18} {opened:>5} connections opened for {options['requests']} requests, "
+                f"{elapsed / options['requests'] * 1000:.2f} ms/request"
+            )
+
+    def run(self, path, request_count, max_age):
+        for conn in connections.all():
+            conn.close()
+            conn.settings_dict['CONN_MAX_AGE'] = max_age
+
+        opened = []
+        def count(sender, connection, **kwargs):
+            opened.append(connection.alias)
+        connection_created.connect(count)
+
+        client = Client()
+        try:
+            start = time.perf_counter()
+            for _ in range(request_count):
+                # The test client skips the request_started/finished hooks
+                # that let a WSGI or ASGI server close or keep connections
+                close_old_connections()
+                response = client.get(path)
+                close_old_connections()
+                # Failed requests may never reach the database, which would make the counts meaningless
+                if not 200 <= response.status_code < 300:
+                    raise CommandError(f'GET {path} returned status {response.status_code}')
+            elapsed = time.perf_counter() - start
+        finally:
+            connection_created.disconnect(count)
+        return len(opened), elapsed
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import time
+import zipfile
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from inventory.models import Warehouse, Product, WarehouseStock
+from inventory.tasks import get_stock_report_summary, write_stock_report_archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Time serial against parallel PDF rendering of the daily stock report '
+        'on a synthetic dataset. The dataset is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--warehouses', type=int, default=500)
+        parser.add_argument('--products', type=int, default=20)
+        parser.add_argument('--workers', type=int, default=os.cpu_count())
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.seed(options['warehouses'], options['products'])
+            summary = get_stock_report_summary()
+            timestamp = timezone.now()
+
+            serial_time, serial_files = self.run(summary, timestamp, workers=1)
+            parallel_time, parallel_files = self.run(summary, timestamp, workers=options['workers'])
+
+            transaction.set_rollback(True)
+
+        if serial_files != parallel_files:
+            self.stderr.write('Serial and parallel archives contain different files')
+        self.stdout.write(
+            f"{options['warehouses']} warehouses, {summary['total_count']} stock rows, "
+            f"{len(serial_files)} PDFs"
+        )
+        self.stdout.write(f'serial:   {serial_time:.2f}s')
+        self.stdout.write(f"parallel: {parallel_time:.2f}s ({options['workers']} workers)")
+        self.stdout.write(f'speedup:  {serial_time / parallel_time:.2f}x')
+
+    def seed(self, warehouse_count, product_count):
+        run_id = int(time.time())
+        warehouses = Warehouse.objects.bulk_create([
+            Warehouse(name=f'Benchmark Warehouse {index}', location='Benchmark')
+            for index in range(warehouse_count)
+        ])
+        products = Product.objects.bulk_create([
+            Product(name=f'Benchmark Product {index}', description='', sku=f'BENCH-{run_id}-{index}')
+            for index in range(product_count)
+        ])
+        WarehouseStock.objects.bulk_create([
+            WarehouseStock(
+                warehouse=warehouse, product=product, quantity=(w + p) % 40, minimum_stock=product.minimum_stock
+            )
+            for w, warehouse in enumerate(warehouses)
+            for p, product in enumerate(products)
+        ], batch_size=1000)
+
+    def run(self, summary, timestamp, workers):
+        with tempfile.TemporaryFile() as report_file:
+            start = time.perf_counter()
+            write_stock_report_archive(report_file, summary, timestamp, workers=workers)
+            elapsed = time.perf_counter() - start
+            report_file.seek(0)
+            with zipfile.ZipFile(report_file) as archive:
+                files = archive.namelist()
+        return elapsed, files
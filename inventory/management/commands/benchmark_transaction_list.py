@@ -0,0 +1,75 @@
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from inventory.models import Warehouse, Product, WarehouseStock, StockTransaction
+from inventory.serializers import StockTransactionSerializer, StockTransactionRowSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare ms per 1000 rows of the transaction listing with the model '
+        'serializer and with the lean row path, on a synthetic dataset that '
+        'is rolled back afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000)
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            user = self.seed(options['rows'])
+            request = APIRequestFactory().get('/api/stock-transactions/')
+            request.user = user
+            queryset = StockTransaction.objects.select_related(
+                'source_warehouse', 'destination_warehouse', 'customer', 'product', 'performed_by'
+            ).order_by('-created_at', 'id')[:options['rows']]
+
+            def serializer_path():
+                return StockTransactionSerializer(queryset.all(), many=True, context={'request': request}).data
+
+            def row_path():
+                return StockTransactionRowSerializer.to_representation(
+                    StockTransactionRowSerializer.get_queryset(queryset.all())
+                )
+
+            timings = {
+                'serializer': self.measure(serializer_path, options['repeat']),
+                'rows': self.measure(row_path, options['repeat']),
+            }
+            transaction.set_rollback(True)
+
+        scale = 1000 / options['rows']
+        for label, seconds in timings.items():
+            self.stdout.write(f'{label:<11} {seconds * 1000 * scale:8.2f} ms per 1000 rows')
+        self.stdout.write(f"speedup:    {timings['serializer'] / timings['rows']:.1f}x")
+
+    def seed(self, row_count):
+        run_id = int(time.time())
+        user = User.objects.create_user(f'benchmark-{run_id}')
+        warehouses = Warehouse.objects.bulk_create([
+            Warehouse(name=f'Benchmark Warehouse {index}', location='Benchmark') for index in range(2)
+        ])
+        product = Product.objects.create(name='Benchmark Product', description='', sku=f'BENCH-{run_id}')
+        WarehouseStock.objects.create(warehouse=warehouses[0], product=product, quantity=row_count)
+        StockTransaction.objects.record_many([
+            StockTransaction(
+                source_warehouse=warehouses[0], destination_warehouse=warehouses[1], product=product,
+                quantity=1, transaction_type='WW', transfer_type='TRUCK', performed_by=user
+            )
+            for _ in range(row_count)
+        ])
+        return user
+
+    def measure(self, build, repeat):
+        """Best of repeat runs, each querying and building every row"""
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            build()
+            best = min(best, time.perf_counter() - start)
+        return best
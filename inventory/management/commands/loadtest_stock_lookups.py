@@ -0,0 +1,161 @@
+import asyncio
+import multiprocessing
+import random
+import socket
+import statistics
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from inventory.models import Warehouse, Product, WarehouseStock
+
+
+def serve(host, port):
+    import uvicorn
+    # Settings were loaded before the fork; match what asgi.py configures
+    for database in settings.DATABASES.values():
+        database['CONN_MAX_AGE'] = 0
+    uvicorn.run(
+        'warehouse_inventory.asgi:application',
+        host=host, port=port, workers=1, lifespan='off', log_level='warning'
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Load test the async stock lookup endpoints: creates the test database, '
+        'seeds it, serves the ASGI app with a single uvicorn worker and sends '
+        'concurrent lookups over keep-alive connections. SQLite needs a TEST NAME '
+        'so the server process can open the same file.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=20000)
+        parser.add_argument('--concurrency', type=int, default=500)
+        parser.add_argument('--warehouses', type=int, default=20)
+        parser.add_argument('--products', type=int, default=200)
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--keepdb', action='store_true')
+
+    def handle(self, *args, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError('uvicorn is required: pip install uvicorn')
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=options['keepdb'])
+        server = None
+        try:
+            token, paths = self.seed(options['warehouses'], options['products'])
+            # The forked server must open its own connections to the test database
+            connections.close_all()
+            server = multiprocessing.get_context('fork').Process(
+                target=serve, args=(options['host'], options['port']), daemon=True
+            )
+            server.start()
+            self.wait_for_port(options['host'], options['port'])
+
+            elapsed, latencies, statuses = asyncio.run(self.load(
+                options['host'], options['port'], token, paths,
+                options['requests'], options['concurrency']
+            ))
+        finally:
+            if server is not None:
+                server.terminate()
+                server.join()
+            connection.creation.destroy_test_db(old_name, verbosity=0, keepdb=options['keepdb'])
+
+        latencies.sort()
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000
+
+        self.stdout.write(
+            f"{options['requests']} lookups, {options['concurrency']} concurrent connections, "
+            f"1 uvicorn worker"
+        )
+        self.stdout.write(f'throughput: {options["requests"] / elapsed:.0f} requests/s')
+        self.stdout.write(
+            f'latency:    p50 {percentile(0.50):.1f} ms, p95 {percentile(0.95):.1f} ms, '
+            f'p99 {percentile(0.99):.1f} ms, mean {statistics.mean(latencies) * 1000:.1f} ms'
+        )
+        self.stdout.write(f'statuses:   {dict(statuses)}')
+
+    def seed(self, warehouse_count, product_count):
+        user = User.objects.create_user('loadtest')
+        warehouses = Warehouse.objects.bulk_create([
+            Warehouse(name=f'Load Test Warehouse {index}', location='Load Test')
+            for index in range(warehouse_count)
+        ])
+        user.authorized_warehouses.set(warehouses)
+        products = Product.objects.bulk_create([
+            Product(name=f'Load Test Product {index}', description='', sku=f'LOAD-{index}')
+            for index in range(product_count)
+        ])
+        WarehouseStock.objects.bulk_create([
+            WarehouseStock(
+                warehouse=warehouse, product=product, quantity=(w * p) % 50, minimum_stock=product.minimum_stock
+            )
+            for w, warehouse in enumerate(warehouses)
+            for p, product in enumerate(products)
+        ], batch_size=1000)
+
+        paths = [f'/api/stock/{w.id}/{p.id}/' for w in warehouses for p in products]
+        paths += [f'/api/stock/sku/{p.sku}/?warehouse={w.id}' for w in warehouses for p in products]
+        return str(RefreshToken.for_user(user).access_token), paths
+
+    def wait_for_port(self, host, port, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection((host, port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise CommandError(f'uvicorn did not start listening on {host}:{port}')
+
+    async def load(self, host, port, token, paths, request_count, concurrency):
+        remaining = iter(range(request_count))
+        latencies = []
+        statuses = Counter()
+
+        async def client():
+            reader, writer = await asyncio.open_connection(host, port)
+            try:
+                for _ in remaining:
+                    path = random.choice(paths)
+                    start = time.perf_counter()
+                    writer.write(
+                        f'GET {path} HTTP/1.1\r\nHost: {host}\r\n'
+                        f'Authorization: Bearer {token}\r\n\r\n'.encode()
+                    )
+                    await writer.drain()
+                    statuses[await self.read_response(reader)] += 1
+                    latencies.append(time.perf_counter() - start)
+            finally:
+                writer.close()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return time.perf_counter() - start, latencies, statuses
+
+    async def read_response(self, reader):
+        """Read one HTTP/1.1 response and return its status code"""
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while (line := await reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if 'content-length' in headers:
+            await reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding') == 'chunked':
+            while size := int((await reader.readline()).strip(), 16):
+                await reader.readexactly(size + 2)
+            await reader.readline()
+        return status
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from inventory.models import WarehouseStockSummary
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the per-warehouse stock summaries from WarehouseStock, or verify them with --verify.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Only compare the stored summaries with freshly computed totals.',
+        )
+
+    def handle(self, *args, **options):
+        expected = WarehouseStockSummary.objects.compute()
+        stored = {
+            summary['warehouse_id']: summary
+            for summary in WarehouseStockSummary.objects.values(
+                'warehouse_id', 'total_skus', 'critical_skus', 'total_units'
+            )
+        }
+        stale = [
+            warehouse_id for warehouse_id, totals in expected.items()
+            if {key: stored.get(warehouse_id, {}).get(key) for key in totals} != totals
+        ]
+
+        if options['verify']:
+            if stale:
+                raise CommandError(
+                    f'{len(stale)} of {len(expected)} warehouse summaries are out of date '
+                    f'(warehouse ids: {", ".join(map(str, sorted(stale)))})'
+                )
+            self.stdout.write(self.style.SUCCESS(f'All {len(expected)} warehouse summaries are up to date'))
+            return
+
+        WarehouseStockSummary.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            f'Rebuilt {len(expected)} warehouse summaries ({len(stale)} were out of date)'
+        ))
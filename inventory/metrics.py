@@ -0,0 +1,158 @@
+"""
+Per-request query count, database time, serializer time and latency.
+RequestMetricsMiddleware collects them for every request, reports them in a
+Server-Timing header and adds them to the process-wide registry that
+/api/metrics/ renders in the Prometheus text format
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from rest_framework import serializers
+
+_current = ContextVar('request_metrics', default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestMetrics:
+    __slots__ = ('queries', 'db_time', 'serialize_time', 'total_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.total_time = 0.0
+
+    def server_timing(self):
+        return (
+            f'db;dur={self.db_time * 1000:.2f};desc="{self.queries} queries", '
+            f'serialize;dur={self.serialize_time * 1000:.2f}, '
+            f'total;dur={self.total_time * 1000:.2f}'
+        )
+
+
+@contextmanager
+def collect_metrics():
+    """Collect the metrics of the code run inside the block, including its sync_to_async calls"""
+    metrics = RequestMetrics()
+    token = _current.set(metrics)
+    start = time.perf_counter()
+    try:
+        yield metrics
+    finally:
+        metrics.total_time = time.perf_counter() - start
+        _current.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    """Database execute wrapper, installed on every connection when it is opened"""
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db_time += time.perf_counter() - start
+
+
+@contextmanager
+def timed_serialization():
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serialize_time += time.perf_counter() - start
+
+
+class TimedSerializerMixin:
+    """Count the time spent building response data as serializer time"""
+
+    def to_representation(self, instance):
+        # Time each top-level object once; nested fields are part of it
+        parent = self.parent
+        if parent is None or (isinstance(parent, serializers.ListSerializer) and parent.parent is None):
+            with timed_serialization():
+                return super().to_representation(instance)
+        return super().to_representation(instance)
+
+
+class MetricsRegistry:
+    """Totals per view action since the process started"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = defaultdict(int)
+        self._totals = defaultdict(lambda: [0, 0.0, 0.0, 0.0, [0] * len(LATENCY_BUCKETS)])
+
+    def observe(self, view, action, method, status, metrics):
+        with self._lock:
+            self._requests[view, action, method, status] += 1
+            totals = self._totals[view, action]
+            totals[0] += metrics.queries
+            totals[1] += metrics.db_time
+            totals[2] += metrics.serialize_time
+            totals[3] += metrics.total_time
+            bucket = bisect_left(LATENCY_BUCKETS, metrics.total_time)
+            if bucket < len(LATENCY_BUCKETS):
+                totals[4][bucket] += 1
+
+    def reset(self):
+        with self._lock:
+            self._requests.clear()
+            self._totals.clear()
+
+    def render(self):
+        """The collected metrics in the Prometheus text exposition format"""
+        with self._lock:
+            requests = sorted(self._requests.items())
+            totals = sorted((key, list(value)) for key, value in self._totals.items())
+
+        counts = defaultdict(int)
+        lines = [
+            '# HELP inventory_requests_total Requests served, by view action and response status',
+            '# TYPE inventory_requests_total counter',
+        ]
+        for (view, action, method, status), count in requests:
+            counts[view, action] += count
+            lines.append(
+                f'inventory_requests_total{{view="{view}",action="{action}",'
+                f'method="{method}",status="{status}"}} {count}'
+            )
+
+        for name, index, help_text in (
+            ('inventory_request_queries_total', 0, 'SQL queries run'),
+            ('inventory_request_db_seconds_total', 1, 'Time spent in SQL queries'),
+            ('inventory_request_serialize_seconds_total', 2, 'Time spent serializing responses'),
+        ):
+            lines.append(f'# HELP {name} {help_text}, by view action')
+            lines.append(f'# TYPE {name} counter')
+            for (view, action), values in totals:
+                lines.append(f'{name}{{view="{view}",action="{action}"}} {values[index]}')
+
+        lines.append('# HELP inventory_request_duration_seconds Request latency, by view action')
+        lines.append('# TYPE inventory_request_duration_seconds histogram')
+        for (view, action), values in totals:
+            labels = f'view="{view}",action="{action}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, values[4]):
+                cumulative += count
+                lines.append(f'inventory_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(
+                f'inventory_request_duration_seconds_bucket{{{labels},le="+Inf"}} {counts[view, action]}'
+            )
+            lines.append(f'inventory_request_duration_seconds_sum{{{labels}}} {values[3]}')
+            lines.append(f'inventory_request_duration_seconds_count{{{labels}}} {counts[view, action]}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,63 @@
+import logging
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .metrics import collect_metrics, registry
+
+logger = logging.getLogger(__name__)
+
+
+def view_action(request):
+    """The view and, for viewsets, the action that handled the request"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unmatched', ''
+    view_class = getattr(match.func, 'cls', None)
+    if view_class is None:
+        return match._func_path.rsplit('.', 1)[-1], ''
+    actions = getattr(match.func, 'actions', None) or {}
+    return view_class.__name__, actions.get(request.method.lower(), '')
+
+
+class RequestMetricsMiddleware:
+    """
+    Record query count, database time, serializer time and latency of each
+    request. They are sent back in a Server-Timing header, kept on the
+    response as response.metrics and added to the /api/metrics/ registry.
+    Works with sync and async views alike
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        with collect_metrics() as metrics:
+            response = self.get_response(request)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        with collect_metrics() as metrics:
+            response = await self.get_response(request)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        view, action = view_action(request)
+        registry.observe(view, action, request.method, response.status_code, metrics)
+        response['Server-Timing'] = metrics.server_timing()
+        response.metrics = metrics
+
+        budget = settings.QUERY_BUDGETS.get(f'{view}.{action}' if action else view)
+        if budget is not None and metrics.queries > budget:
+            logger.warning(
+                '%s %s ran %d queries, over its budget of %d',
+                request.method, request.path, metrics.queries, budget
+            )
+        return response
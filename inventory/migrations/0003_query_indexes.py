@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-18 04:46
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0002_criticalstockalert'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stocktransaction',
+            index=models.Index(fields=['-created_at', 'id'], name='stocktxn_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stocktransaction',
+            index=models.Index(condition=models.Q(('source_warehouse__isnull', False)), fields=['source_warehouse', '-created_at'], name='stocktxn_source_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stocktransaction',
+            index=models.Index(condition=models.Q(('destination_warehouse__isnull', False)), fields=['destination_warehouse', '-created_at'], name='stocktxn_dest_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='stocktransaction',
+            index=models.Index(fields=['transaction_type', '-created_at'], name='stocktxn_type_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='warehousestock',
+            index=models.Index(fields=['warehouse', 'product', 'quantity'], name='stock_quantity_idx'),
+        ),
+    ]
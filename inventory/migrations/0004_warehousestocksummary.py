@@ -0,0 +1,50 @@
+# Generated by Django 5.1.4 on 2026-10-18 04:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import Coalesce
+
+
+def build_summaries(apps, schema_editor):
+    Warehouse = apps.get_model('inventory', 'Warehouse')
+    WarehouseStockSummary = apps.get_model('inventory', 'WarehouseStockSummary')
+    totals = Warehouse.objects.annotate(
+        total_skus=Count('warehousestock'),
+        critical_skus=Count(
+            'warehousestock',
+            filter=Q(warehousestock__quantity__lte=F('warehousestock__product__minimum_stock'))
+        ),
+        total_units=Coalesce(Sum('warehousestock__quantity'), 0)
+    ).values_list('id', 'total_skus', 'critical_skus', 'total_units')
+    WarehouseStockSummary.objects.bulk_create([
+        WarehouseStockSummary(
+            warehouse_id=warehouse_id,
+            total_skus=skus,
+            critical_skus=critical,
+            total_units=units
+        )
+        for warehouse_id, skus, critical, units in totals.iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0003_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WarehouseStockSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('total_skus', models.PositiveIntegerField(default=0)),
+                ('critical_skus', models.PositiveIntegerField(default=0)),
+                ('total_units', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('warehouse', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stock_summary', to='inventory.warehouse')),
+            ],
+        ),
+        migrations.RunPython(build_summaries, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:04
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def create_baseline_checkpoint(apps, schema_editor):
+    """Start the ledger's history from the current stock levels"""
+    WarehouseStock = apps.get_model('inventory', 'WarehouseStock')
+    StockCheckpoint = apps.get_model('inventory', 'StockCheckpoint')
+    taken_at = timezone.now()
+    StockCheckpoint.objects.bulk_create([
+        StockCheckpoint(warehouse_id=warehouse_id, product_id=product_id, quantity=quantity, taken_at=taken_at)
+        for warehouse_id, product_id, quantity in WarehouseStock.objects.filter(
+            quantity__gt=0
+        ).values_list('warehouse_id', 'product_id', 'quantity').iterator()
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0004_warehousestocksummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('taken_at', models.DateTimeField()),
+                ('product', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.product')),
+                ('warehouse', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.warehouse')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('taken_at', 'warehouse', 'product'), name='unique_stock_checkpoint')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('delta', models.IntegerField()),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.product')),
+                ('transaction', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='ledger_entries', to='inventory.stocktransaction')),
+                ('warehouse', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.warehouse')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at'], name='ledger_created_idx'), models.Index(fields=['warehouse', 'product', 'created_at'], name='ledger_stock_created_idx')],
+            },
+        ),
+        migrations.RunPython(create_baseline_checkpoint, migrations.RunPython.noop),
+    ]
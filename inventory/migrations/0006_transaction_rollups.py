@@ -0,0 +1,62 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:49
+
+import datetime
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDay, TruncHour
+
+
+def build_rollups(apps, schema_editor):
+    StockTransaction = apps.get_model('inventory', 'StockTransaction')
+    StockTransactionRollup = apps.get_model('inventory', 'StockTransactionRollup')
+    for period, trunc in (('H', TruncHour), ('D', TruncDay)):
+        # Per product, then over all products as product 0
+        for fields in (['product_id'], []):
+            grouped = StockTransaction.objects.annotate(
+                bucket=trunc('created_at', tzinfo=datetime.timezone.utc)
+            ).order_by().values(
+                'bucket', 'source_warehouse_id', 'destination_warehouse_id',
+                'transaction_type', 'transfer_type', *fields
+            ).annotate(transactions=Count('id'), units=Sum('quantity'))
+            StockTransactionRollup.objects.bulk_create([
+                StockTransactionRollup(
+                    period=period, bucket=row['bucket'], product_id=row.get('product_id', 0),
+                    source_warehouse=row['source_warehouse_id'] or 0,
+                    destination_warehouse=row['destination_warehouse_id'] or 0,
+                    transaction_type=row['transaction_type'], transfer_type=row['transfer_type'] or '',
+                    count=row['transactions'], quantity=row['units'],
+                )
+                for row in grouped.iterator()
+            ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0005_stock_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockTransactionRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('H', 'Hour'), ('D', 'Day')], max_length=1)),
+                ('bucket', models.DateTimeField()),
+                ('source_warehouse', models.BigIntegerField(default=0)),
+                ('destination_warehouse', models.BigIntegerField(default=0)),
+                ('transaction_type', models.CharField(max_length=2)),
+                ('transfer_type', models.CharField(blank=True, default='', max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('quantity', models.PositiveBigIntegerField(default=0)),
+                ('product', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period', 'bucket'], name='rollup_period_bucket_idx')],
+                'constraints': [models.UniqueConstraint(fields=('period', 'product', 'bucket', 'source_warehouse', 'destination_warehouse', 'transaction_type', 'transfer_type'), name='unique_transaction_rollup')],
+            },
+        ),
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
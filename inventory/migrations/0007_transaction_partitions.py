@@ -0,0 +1,104 @@
+# Generated by Django 5.1.4 on 2026-10-18 05:55
+
+import datetime
+
+from django.db import migrations, models
+
+# Monthly partitions created past the current month; Celery beat keeps adding them
+MONTHS_AHEAD = 3
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_by_month(apps, schema_editor):
+    """
+    Rebuild the transaction table on PostgreSQL as a table partitioned by
+    UTC month of created_at, with a default partition for anything outside
+    the monthly ones. The primary key has to include created_at; ids stay
+    unique through their sequence. Other databases keep a plain table
+    """
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    qn = schema_editor.quote_name
+    table = apps.get_model('inventory', 'StockTransaction')._meta.db_table
+    old_table = f'{table}_unpartitioned'
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s',
+            [table]
+        )
+        indexes = [(name, definition) for name, definition in cursor.fetchall() if name != f'{table}_pkey']
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f'",
+            [table]
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(f"SELECT min(created_at) FROM {qn(table)}")
+        oldest = cursor.fetchone()[0]
+
+    # Free the table, primary key and index names for the partitioned table
+    schema_editor.execute(f'ALTER TABLE {qn(table)} RENAME TO {qn(old_table)}')
+    schema_editor.execute(f'ALTER TABLE {qn(old_table)} RENAME CONSTRAINT {qn(table + "_pkey")} TO {qn(old_table + "_pkey")}')
+    for name, _ in indexes:
+        schema_editor.execute(f'DROP INDEX {qn(name)}')
+
+    schema_editor.execute(
+        f'CREATE TABLE {qn(table)} (LIKE {qn(old_table)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+        f'PARTITION BY RANGE (created_at)'
+    )
+    schema_editor.execute(f'ALTER TABLE {qn(table)} ADD PRIMARY KEY (id, created_at)')
+    schema_editor.execute(f'CREATE TABLE {qn(table + "_default")} PARTITION OF {qn(table)} DEFAULT')
+    current = datetime.datetime.now(datetime.timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    month = min(oldest, current).astimezone(datetime.timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    ) if oldest else current
+    while month <= add_months(current, MONTHS_AHEAD):
+        schema_editor.execute(
+            f'CREATE TABLE {qn(f"{table}_{month:%Y_%m}")} PARTITION OF {qn(table)} '
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        )
+        month = add_months(month, 1)
+
+    schema_editor.execute(f'INSERT INTO {qn(table)} SELECT * FROM {qn(old_table)}')
+    # Dropping the old table drops its identity sequence; ids continue from a plain one
+    schema_editor.execute(f'DROP TABLE {qn(old_table)}')
+    schema_editor.execute(f'CREATE SEQUENCE {qn(table + "_id_seq")} OWNED BY {qn(table)}.id')
+    schema_editor.execute(
+        f"ALTER TABLE {qn(table)} ALTER COLUMN id SET DEFAULT nextval('{table}_id_seq')"
+    )
+    schema_editor.execute(
+        f"SELECT setval('{table}_id_seq', COALESCE(MAX(id), 0) + 1, false) FROM {qn(table)}"
+    )
+    for _, definition in indexes:
+        schema_editor.execute(definition)
+    for name, definition in foreign_keys:
+        schema_editor.execute(f'ALTER TABLE {qn(table)} ADD CONSTRAINT {qn(name)} {definition}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0006_transaction_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockTransactionArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('file', models.CharField(max_length=255)),
+                ('rows', models.PositiveIntegerField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['month', 'id'],
+            },
+        ),
+        migrations.RunPython(partition_by_month, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.4 on 2026-10-18 06:03
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def copy_minimum_stock(apps, schema_editor):
+    Product = apps.get_model('inventory', 'Product')
+    WarehouseStock = apps.get_model('inventory', 'WarehouseStock')
+    WarehouseStock.objects.update(minimum_stock=Subquery(
+        Product.objects.filter(pk=OuterRef('product_id')).values('minimum_stock')[:1]
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0007_transaction_partitions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CriticalStockEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(blank=True, null=True)),
+                ('minimum_stock', models.PositiveIntegerField()),
+                ('is_critical', models.BooleanField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='warehousestock',
+            name='minimum_stock',
+            field=models.PositiveIntegerField(default=0, editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(copy_minimum_stock, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='warehousestock',
+            name='is_critical',
+            field=models.GeneratedField(db_persist=True, expression=models.Q(('quantity__lte', models.F('minimum_stock'))), output_field=models.BooleanField()),
+        ),
+        migrations.AddIndex(
+            model_name='warehousestock',
+            index=models.Index(condition=models.Q(('is_critical', True)), fields=['warehouse', 'product'], name='stock_critical_idx'),
+        ),
+        migrations.AddField(
+            model_name='criticalstockevent',
+            name='product',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.product'),
+        ),
+        migrations.AddField(
+            model_name='criticalstockevent',
+            name='warehouse',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='inventory.warehouse'),
+        ),
+    ]
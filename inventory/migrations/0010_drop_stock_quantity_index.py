@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-18 07:00
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0009_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='warehousestock',
+            name='stock_quantity_idx',
+        ),
+    ]
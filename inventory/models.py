@@ -1,11 +1,18 @@
-from django.db import models
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-from django.contrib.auth.models import User
-from django.core.mail import send_mail
 from django.conf import settings
+from django.db import models, router, connections, transaction, IntegrityError
+from django.db.models import F, Q, Count, Sum, Max, Min
+from django.db.models.functions import Coalesce, TruncDay, TruncHour
+
+from django.contrib.auth.models import User
 from django.utils import timezone
 from django.core.exceptions import ValidationError
 
+from .caching import bump_warehouse_generations, bump_critical_stock_events
+from .pagination import rows_after
+
 
 class Warehouse(models.Model):
     name = models.CharField(max_length=100)
@@ -47,19 +54,397 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
+class WarehouseStockManager(models.Manager):
+    def _apply_delta(self, warehouse_id, product_id, delta):
+        """
+        Apply a signed quantity change as a single conditional UPDATE and
+        return the resulting quantity, or None if no row was changed
+        (missing stock record or not enough units to withdraw)
+        """
+        connection = connections[router.db_for_write(self.model)]
+        qn = connection.ops.quote_name
+        sql = (
+            f'UPDATE {qn(self.model._meta.db_table)} '
+            f'SET {qn("quantity")} = {qn("quantity")} + %s, {qn("updated_at")} = %s '
+            f'WHERE {qn("warehouse_id")} = %s AND {qn("product_id")} = %s '
+            f'AND {qn("quantity")} - {qn("reserved")} >= %s '
+            f'RETURNING {qn("quantity")}'
+        )
+        params = [
+            delta,
+            connection.ops.adapt_datetimefield_value(timezone.now()),
+            warehouse_id,
+            product_id,
+            max(-delta, 0),
+        ]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def withdraw(self, warehouse_id, product_id, quantity):
+        """Deduct stock only if enough units are available, i.e. not reserved"""
+        return self._apply_delta(warehouse_id, product_id, -quantity)
+
+    def hold(self, warehouse_id, product_id, quantity):
+        """Reserve units only if that many are available; returns whether they were"""
+        return self.filter(
+            warehouse_id=warehouse_id, product_id=product_id, quantity__gte=F('reserved') + quantity
+        ).update(reserved=F('reserved') + quantity) == 1
+
+    def release_holds(self, holds, batch_size=300):
+        """
+        Return reserved units, keyed by (warehouse_id, product_id), to the
+        available stock with one UPDATE ... FROM (VALUES ...) per batch of keys
+        """
+        keys = [key for key, units in holds.items() if units]
+        connection = connections[router.db_for_write(self.model)]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            sql = (
+                f'UPDATE {table} '
+                f'SET {qn("reserved")} = {table}.{qn("reserved")} - d.column3 '
+                f'FROM (VALUES {", ".join(["(%s, %s, %s)"] * len(batch))}) AS d '
+                f'WHERE {table}.{qn("warehouse_id")} = d.column1 '
+                f'AND {table}.{qn("product_id")} = d.column2'
+            )
+            params = []
+            for warehouse_id, product_id in batch:
+                params.extend([warehouse_id, product_id, holds[(warehouse_id, product_id)]])
+            with connection.cursor() as cursor:
+                cursor.execute(sql, params)
+
+    def deposit(self, warehouse_id, product_id, quantity, minimum_stock):
+        """
+        Add stock, creating the stock record on first receipt. Returns the
+        new quantity and whether the record was created
+        """
+        new_quantity = self._apply_delta(warehouse_id, product_id, quantity)
+        if new_quantity is None:
+            stock = self.model(
+                warehouse_id=warehouse_id, product_id=product_id, quantity=quantity, minimum_stock=minimum_stock
+            )
+            # The caller writes the ledger entry and summary change for this receipt
+            stock._ledger_recorded = True
+            stock._summary_recorded = True
+            try:
+                with transaction.atomic():
+                    stock.save(force_insert=True)
+                return stock.quantity, True
+            except IntegrityError:
+                # Another transaction created the record in the meantime
+                new_quantity = self._apply_delta(warehouse_id, product_id, quantity)
+        return new_quantity, False
+
+    def apply_deltas(self, deltas, batch_size=300):
+        """
+        Apply net quantity changes keyed by (warehouse_id, product_id) with
+        one conditional UPDATE ... FROM (VALUES ...) per batch of keys, and
+        return the resulting (quantity, minimum_stock, created) per key,
+        where created tells a record made for this receipt. Nothing is
+        applied if any key would drop below zero; a ValidationError lists
+        every shortfall
+        """
+        deltas = {key: delta for key, delta in deltas.items() if delta}
+        # Rows are locked in key order, the same in every batch, so two
+        # concurrent uploads never wait on each other's locks
+        keys = sorted(deltas)
+        results = {}
+        shortfall = False
+
+        connection = connections[router.db_for_write(self.model)]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+
+        with transaction.atomic(using=connection.alias):
+            # Receipts may target a warehouse that has never held the product;
+            # RETURNING lists only the records actually inserted
+            receipts = [key for key in keys if deltas[key] > 0]
+            created = set()
+            if receipts:
+                minimum_stocks = dict(Product.objects.filter(
+                    id__in={p for _, p in receipts}
+                ).values_list('id', 'minimum_stock'))
+                columns = ', '.join(qn(column) for column in (
+                    'warehouse_id', 'product_id', 'quantity', 'reserved', 'minimum_stock', 'created_at', 'updated_at'
+                ))
+                for start in range(0, len(receipts), batch_size):
+                    batch = receipts[start:start + batch_size]
+                    params = []
+                    for warehouse_id, product_id in batch:
+                        params.extend([warehouse_id, product_id, minimum_stocks.get(product_id, 0), now, now])
+                    with connection.cursor() as cursor:
+                        cursor.execute(
+                            f'INSERT INTO {table} ({columns}) '
+                            f'VALUES {", ".join(["(%s, %s, 0, 0, %s, %s, %s)"] * len(batch))} '
+                            f'ON CONFLICT ({qn("warehouse_id")}, {qn("product_id")}) DO NOTHING '
+                            f'RETURNING {qn("warehouse_id")}, {qn("product_id")}',
+                            params
+                        )
+                        created.update((warehouse_id, product_id) for warehouse_id, product_id in cursor.fetchall())
+
+            for start in range(0, len(keys), batch_size):
+                batch = keys[start:start + batch_size]
+                sql = (
+                    f'UPDATE {table} '
+                    f'SET {qn("quantity")} = {table}.{qn("quantity")} + d.column3, {qn("updated_at")} = %s '
+                    f'FROM (VALUES {", ".join(["(%s, %s, %s)"] * len(batch))}) AS d '
+                    f'WHERE {table}.{qn("warehouse_id")} = d.column1 '
+                    f'AND {table}.{qn("product_id")} = d.column2 '
+                    f'AND {table}.{qn("quantity")} + d.column3 >= {table}.{qn("reserved")} '
+                    f'RETURNING {table}.{qn("warehouse_id")}, {table}.{qn("product_id")}, '
+                    f'{table}.{qn("quantity")}, {table}.{qn("minimum_stock")}'
+                )
+                params = [now]
+                for warehouse_id, product_id in batch:
+                    params.extend([warehouse_id, product_id, deltas[(warehouse_id, product_id)]])
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    updated = cursor.fetchall()
+                if len(updated) != len(batch):
+                    transaction.set_rollback(True, using=connection.alias)
+                    shortfall = True
+                    break
+                for warehouse_id, product_id, quantity, minimum_stock in updated:
+                    key = (warehouse_id, product_id)
+                    results[key] = quantity, minimum_stock, key in created
+
+        if shortfall:
+            raise self._shortfall_error(deltas)
+        return results
+
+    def _shortfall_error(self, deltas):
+        """Explain which withdrawals in a rolled back batch could not be met"""
+        withdrawals = {key: -delta for key, delta in deltas.items() if delta < 0}
+        available = {
+            (warehouse_id, product_id): quantity
+            for warehouse_id, product_id, quantity in self.filter(
+                warehouse_id__in={w for w, _ in withdrawals},
+                product_id__in={p for _, p in withdrawals}
+            ).values_list('warehouse_id', 'product_id', F('quantity') - F('reserved'))
+        }
+        errors = []
+        for (warehouse_id, product_id), requested in withdrawals.items():
+            params = {
+                'warehouse': warehouse_id,
+                'product': product_id,
+                'available': available.get((warehouse_id, product_id)),
+                'requested': requested,
+            }
+            if params['available'] is None:
+                errors.append(ValidationError(
+                    'No stock record found for product %(product)s in warehouse %(warehouse)s',
+                    code='no_stock',
+                    params=params
+                ))
+            elif params['available'] < requested:
+                errors.append(ValidationError(
+                    'Insufficient stock for product %(product)s in warehouse %(warehouse)s. '
+                    'Available: %(available)s, Requested: %(requested)s',
+                    code='insufficient_stock',
+                    params=params
+                ))
+        return ValidationError(errors)
+
+
 class WarehouseStock(models.Model):
     warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE)
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=0)
+    # Units held by stock reservations; only quantity - reserved can be withdrawn
+    reserved = models.PositiveIntegerField(default=0, editable=False)
+    # Copied from the product, so the database keeps is_critical current on
+    # every quantity change and critical stock is found without a join
+    minimum_stock = models.PositiveIntegerField(editable=False)
+    is_critical = models.GeneratedField(
+        expression=Q(quantity__lte=F('minimum_stock')),
+        output_field=models.BooleanField(),
+        db_persist=True,
+    )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = WarehouseStockManager()
+
     class Meta:
         unique_together = ['warehouse', 'product']
+        indexes = [
+            models.Index(fields=['warehouse', 'product'], condition=Q(is_critical=True), name='stock_critical_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(reserved__lte=F('quantity')),
+                name='stock_reserved_lte_quantity',
+                violation_error_message='Quantity cannot be less than the units reserved'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.product.name} at {self.warehouse.name}: {self.quantity}"
 
+    def save(self, *args, **kwargs):
+        # Saves through the ORM may move the record to another product
+        self.minimum_stock = self.product.minimum_stock
+        super().save(*args, **kwargs)
+
+class WarehouseStockSummaryManager(models.Manager):
+    def compute(self, warehouse_ids=None):
+        """Totals per warehouse computed from scratch out of WarehouseStock"""
+        warehouses = Warehouse.objects.all()
+        if warehouse_ids is not None:
+            warehouses = warehouses.filter(id__in=warehouse_ids)
+        totals = warehouses.annotate(
+            total_skus=Count('warehousestock'),
+            critical_skus=Count('warehousestock', filter=Q(warehousestock__is_critical=True)),
+            total_units=Coalesce(Sum('warehousestock__quantity'), 0)
+        ).values_list('id', 'total_skus', 'critical_skus', 'total_units')
+        return {
+            warehouse_id: {'total_skus': skus, 'critical_skus': critical, 'total_units': units}
+            for warehouse_id, skus, critical, units in totals
+        }
+
+    def rebuild(self, warehouse_ids=None):
+        """
+        Recompute and store the summaries of the given (or all) warehouses.
+        The summaries are locked first, in warehouse order like transactions
+        lock them, so totals are computed only after concurrent increments
+        commit and cannot overwrite them
+        """
+        with transaction.atomic(using=self.db):
+            summaries = self.select_for_update().order_by('warehouse_id')
+            if warehouse_ids is not None:
+                summaries = summaries.filter(warehouse_id__in=warehouse_ids)
+            list(summaries.values_list('pk', flat=True))
+            totals = self.compute(warehouse_ids)
+            self.bulk_create(
+                [self.model(warehouse_id=warehouse_id, **values) for warehouse_id, values in sorted(totals.items())],
+                update_conflicts=True,
+                unique_fields=['warehouse'],
+                update_fields=['total_skus', 'critical_skus', 'total_units', 'updated_at']
+            )
+        return totals
+
+    def record_changes(self, changes):
+        """
+        Apply stock record changes, given as (warehouse_id, minimum_stock,
+        old_quantity, new_quantity), to the warehouse summaries as one
+        increment per warehouse, in warehouse order. None for old_quantity
+        means the record was created, for new_quantity that it was deleted
+        """
+        increments = defaultdict(lambda: [0, 0, 0])
+        for warehouse_id, minimum_stock, old_quantity, new_quantity in changes:
+            totals = increments[warehouse_id]
+            for quantity, sign in ((old_quantity, -1), (new_quantity, 1)):
+                if quantity is not None:
+                    totals[0] += sign
+                    totals[1] += sign * (quantity <= minimum_stock)
+                    totals[2] += sign * quantity
+
+        missing = []
+        for warehouse_id, (skus, critical, units) in sorted(increments.items()):
+            if not (skus or critical or units):
+                continue
+            updated = self.filter(warehouse_id=warehouse_id).update(
+                total_skus=F('total_skus') + skus,
+                critical_skus=F('critical_skus') + critical,
+                total_units=F('total_units') + units,
+                updated_at=timezone.now()
+            )
+            if not updated:
+                missing.append(warehouse_id)
+        if missing:
+            self.rebuild(missing)
+
+
+class WarehouseStockSummary(models.Model):
+    """Per-warehouse stock totals kept in step with WarehouseStock for reporting"""
+    warehouse = models.OneToOneField(Warehouse, on_delete=models.CASCADE, related_name='stock_summary')
+    total_skus = models.PositiveIntegerField(default=0)
+    critical_skus = models.PositiveIntegerField(default=0)
+    total_units = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = WarehouseStockSummaryManager()
+
+    def __str__(self):
+        return f"{self.warehouse}: {self.total_skus} products, {self.critical_skus} critical"
+
+
+class StockTransactionQuerySet(models.QuerySet):
+    def involving_warehouse(self, warehouse_id):
+        """
+        Transactions into or out of a warehouse. Written as a UNION of two
+        partial index seeks instead of an OR, which cannot use either index
+        """
+        model = self.model
+        return self.filter(pk__in=model._base_manager.filter(
+            source_warehouse_id=warehouse_id
+        ).values('pk').union(
+            model._base_manager.filter(destination_warehouse_id=warehouse_id).values('pk'),
+            all=True
+        ))
+
+
+    def matching(self, warehouse_ids=None, warehouse_id=None, transaction_type=None, start=None, end=None):
+        """
+        Transactions into or out of any of warehouse_ids and warehouse_id,
+        of transaction_type and created in [start, end], where given
+        """
+        queryset = self
+        if warehouse_ids is not None:
+            queryset = queryset.filter(
+                Q(source_warehouse_id__in=warehouse_ids) | Q(destination_warehouse_id__in=warehouse_ids)
+            )
+        if warehouse_id is not None:
+            queryset = queryset.involving_warehouse(warehouse_id)
+        if transaction_type:
+            queryset = queryset.filter(transaction_type=transaction_type)
+        if start is not None and end is not None:
+            queryset = queryset.filter(created_at__range=(start, end))
+        return queryset
+
+
+class StockTransactionManager(models.Manager.from_queryset(StockTransactionQuerySet)):
+    def record_many(self, transactions, batch_size=1000):
+        """
+        Insert already cleaned transactions and apply their net stock effect
+        per (warehouse, product) in one database transaction, bypassing the
+        row by row save() path
+        """
+        deltas = defaultdict(int)
+        for stock_transaction in transactions:
+            for key, delta in stock_transaction.stock_deltas():
+                deltas[key] += delta
+
+        with transaction.atomic():
+            stocks = WarehouseStock.objects.apply_deltas(deltas)
+            WarehouseStockSummary.objects.record_changes(
+                (key[0], minimum_stock, None if new else quantity - deltas[key], quantity)
+                for key, (quantity, minimum_stock, new) in stocks.items()
+            )
+            created = self.bulk_create(transactions, batch_size=batch_size)
+            StockTransactionRollup.objects.record(created)
+            StockLedgerEntry.objects.record(
+                (warehouse_id, product_id, stock_transaction.pk, delta)
+                for stock_transaction in created
+                for (warehouse_id, product_id), delta in stock_transaction.stock_deltas()
+            )
+            bump_warehouse_generations(w for w, _ in deltas)
+
+            # Like save(), records created for a receipt were not critical before
+            CriticalStockEvent.objects.record(
+                (*key, not new and stock_is_critical(quantity - deltas[key], minimum_stock), quantity, minimum_stock)
+                for key, (quantity, minimum_stock, new) in stocks.items()
+            )
+            for key, (quantity, minimum_stock, _) in stocks.items():
+                if stock_is_critical(quantity, minimum_stock):
+                    queue_critical_stock_alert(*key)
+        return created
+
+
 # Stock Transaction Model
 class StockTransaction(models.Model):
     TRANSFER_TYPES = [
@@ -85,129 +470,822 @@ class StockTransaction(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = StockTransactionManager()
+
+    class Meta:
+        indexes = [
+            # Listing order and keyset pagination
+            models.Index(fields=['-created_at', 'id'], name='stocktxn_created_idx'),
+            # Per-warehouse history, partial since CW/WC leave one side empty
+            models.Index(
+                fields=['source_warehouse', '-created_at'],
+                name='stocktxn_source_created_idx',
+                condition=Q(source_warehouse__isnull=False)
+            ),
+            models.Index(
+                fields=['destination_warehouse', '-created_at'],
+                name='stocktxn_dest_created_idx',
+                condition=Q(destination_warehouse__isnull=False)
+            ),
+            models.Index(fields=['transaction_type', '-created_at'], name='stocktxn_type_created_idx'),
+        ]
+
     def clean(self):
+        self.validate_transfer()
+        # Advisory, so forms such as the admin's can show the error; save()
+        # makes the binding check atomically with the withdrawal
+        if self.source_warehouse_id and self.product_id and self.quantity:
+            available = WarehouseStock.objects.filter(
+                warehouse_id=self.source_warehouse_id, product_id=self.product_id
+            ).values_list(F('quantity') - F('reserved'), flat=True).first()
+            if available is None or available < self.quantity:
+                raise self._insufficient_stock_error()
+
+    def validate_transfer(self):
+        """Check the warehouses and customer required by the transaction type, without queries"""
         if self.transaction_type == 'WW':
-            if not self.source_warehouse or not self.destination_warehouse:
+            if not self.source_warehouse_id or not self.destination_warehouse_id:
                 raise ValidationError(
                     'Warehouse to Warehouse transfer requires both source and destination warehouses'
                 )
-            if self.customer:
+            if self.customer_id:
                 raise ValidationError('Customer should not be set for Warehouse to Warehouse transfer')
-            if self.source_warehouse == self.destination_warehouse:
+            if self.source_warehouse_id == self.destination_warehouse_id:
                 raise ValidationError('Source and destination warehouses cannot be the same')
                 
         elif self.transaction_type == 'WC':
-            if not self.source_warehouse or not self.customer:
+            if not self.source_warehouse_id or not self.customer_id:
                 raise ValidationError(
                     'Warehouse to Customer transfer requires source warehouse and customer'
                 )
-            if self.destination_warehouse:
+            if self.destination_warehouse_id:
                 raise ValidationError(
                     'Destination warehouse should not be set for Warehouse to Customer transfer'
                 )
                 
         elif self.transaction_type == 'CW':
-            if not self.destination_warehouse or not self.customer:
+            if not self.destination_warehouse_id or not self.customer_id:
                 raise ValidationError(
                     'Customer to Warehouse transfer requires destination warehouse and customer'
                 )
-            if self.source_warehouse:
+            if self.source_warehouse_id:
                 raise ValidationError(
                     'Source warehouse should not be set for Customer to Warehouse transfer'
                 )
 
-        # Check if source warehouse has enough stock
-        if self.source_warehouse:
-            try:
-                stock = WarehouseStock.objects.get(
-                    warehouse=self.source_warehouse,
-                    product=self.product
-                )
-                if stock.quantity < self.quantity:
-                    raise ValidationError(
-                        f'Insufficient stock in {self.source_warehouse.name}. '
-                        f'Available: {stock.quantity}, Requested: {self.quantity}'
+    def stock_deltas(self):
+        """Signed stock changes of this transaction per (warehouse_id, product_id)"""
+        deltas = []
+        if self.source_warehouse_id:
+            deltas.append(((self.source_warehouse_id, self.product_id), -self.quantity))
+        if self.destination_warehouse_id:
+            deltas.append(((self.destination_warehouse_id, self.product_id), self.quantity))
+        return deltas
+
+    def _insufficient_stock_error(self):
+        """Build the error for a withdrawal that matched no stock row"""
+        available = WarehouseStock.objects.filter(
+            warehouse=self.source_warehouse,
+            product=self.product
+        ).values_list(F('quantity') - F('reserved'), flat=True).first()
+        if available is None:
+            return ValidationError(
+                f'No stock record found for {self.product.name} '
+                f'in {self.source_warehouse.name}'
+            )
+        return ValidationError(
+            f'Insufficient stock in {self.source_warehouse.name}. '
+            f'Available: {available}, Requested: {self.quantity}'
+        )
+
+    def save(self, *args, **kwargs):
+        # Recorded transactions are part of the stock ledger; corrections
+        # are made with a new, opposite transaction
+        if not self._state.adding:
+            raise ValidationError('Recorded stock transactions cannot be changed')
+        self.validate_transfer()
+        critical = []
+        changes = []
+        summaries = []
+
+        minimum_stock = self.product.minimum_stock
+
+        with transaction.atomic():
+            # Stock rows are changed in (warehouse_id, product_id) order, so
+            # transfers in opposite directions lock them in the same order
+            # and cannot deadlock. The conditional update of a withdrawal
+            # doubles as the availability check
+            for (warehouse_id, product_id), delta in sorted(self.stock_deltas()):
+                if delta < 0:
+                    quantity = WarehouseStock.objects.withdraw(warehouse_id, product_id, -delta)
+                    if quantity is None:
+                        raise self._insufficient_stock_error()
+                    created = False
+                else:
+                    quantity, created = WarehouseStock.objects.deposit(
+                        warehouse_id, product_id, delta, minimum_stock
                     )
-            except WarehouseStock.DoesNotExist:
-                raise ValidationError(
-                    f'No stock record found for {self.product.name} '
-                    f'in {self.source_warehouse.name}'
+                summaries.append((warehouse_id, minimum_stock, None if created else quantity - delta, quantity))
+                # New stock records are announced by the post_save signals
+                if not created:
+                    changes.append((
+                        warehouse_id, product_id,
+                        stock_is_critical(quantity - delta, minimum_stock), quantity, minimum_stock
+                    ))
+                critical.append((warehouse_id, quantity))
+
+            # Summary rows are locked last and in warehouse order for the same reason
+            WarehouseStockSummary.objects.record_changes(summaries)
+
+            super().save(*args, **kwargs)
+            StockTransactionRollup.objects.record([self])
+            StockLedgerEntry.objects.bulk_create([
+                StockLedgerEntry(
+                    warehouse_id=warehouse_id, product_id=product_id, transaction=self, delta=delta
+                )
+                for (warehouse_id, product_id), delta in self.stock_deltas()
+            ])
+            bump_warehouse_generations([self.source_warehouse_id, self.destination_warehouse_id])
+            CriticalStockEvent.objects.record(changes)
+
+            # Check critical levels for both warehouses
+            for warehouse_id, quantity in critical:
+                self._check_critical_stock(warehouse_id, quantity)
+
+    def delete(self, *args, **kwargs):
+        raise ValidationError('Recorded stock transactions cannot be deleted')
+
+    def _check_critical_stock(self, warehouse_id, quantity):
+        """Check if stock is at critical level and queue an alert if necessary"""
+        if quantity <= self.product.minimum_stock:
+            queue_critical_stock_alert(warehouse_id, self.product_id)
+
+
+class StockLedgerQuerySet(models.QuerySet):
+    def record(self, entries, batch_size=500):
+        """
+        Append (warehouse_id, product_id, transaction_id, delta) entries with
+        one multi-row INSERT per batch, without building model instances
+        """
+        connection = connections[router.db_for_write(self.model)]
+        qn = connection.ops.quote_name
+        columns = ', '.join(qn(column) for column in (
+            'warehouse_id', 'product_id', 'transaction_id', 'delta', 'created_at'
+        ))
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        entries = list(entries)
+        for start in range(0, len(entries), batch_size):
+            batch = entries[start:start + batch_size]
+            params = [value for entry in batch for value in (*entry, now)]
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {qn(self.model._meta.db_table)} ({columns}) '
+                    f'VALUES {", ".join(["(%s, %s, %s, %s, %s)"] * len(batch))}',
+                    params
                 )
 
+    def update(self, **kwargs):
+        raise TypeError('The stock ledger is append-only')
+
+    def delete(self):
+        raise TypeError('The stock ledger is append-only')
+
+
+class StockLedgerEntry(models.Model):
+    """
+    One signed stock change of a (warehouse, product). Entries are never
+    changed or removed, and outlive the records they reference
+    """
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    # Empty for direct adjustments of WarehouseStock, e.g. in the admin
+    transaction = models.ForeignKey(
+        'StockTransaction', on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True, related_name='ledger_entries'
+    )
+    delta = models.IntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = StockLedgerQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at'], name='ledger_created_idx'),
+            models.Index(fields=['warehouse', 'product', 'created_at'], name='ledger_stock_created_idx'),
+        ]
+
     def save(self, *args, **kwargs):
-        self.clean()
+        if not self._state.adding:
+            raise TypeError('The stock ledger is append-only')
         super().save(*args, **kwargs)
-        
-        # Update warehouse stock levels
-        if self.transaction_type == 'WW':
-            # Deduct from source warehouse
-            source_stock = WarehouseStock.objects.get(
-                warehouse=self.source_warehouse,
-                product=self.product
+
+    def delete(self, *args, **kwargs):
+        raise TypeError('The stock ledger is append-only')
+
+    def __str__(self):
+        return f"{self.delta:+d} of product {self.product_id} at warehouse {self.warehouse_id}"
+
+
+class StockCheckpointManager(models.Manager):
+    def latest_before(self, moment):
+        """Time of the newest checkpoint taken at or before moment, or None"""
+        return self.filter(taken_at__lte=moment).aggregate(taken_at=Max('taken_at'))['taken_at']
+
+    def _balance_sources(self, moment, warehouse_ids, product_ids):
+        """
+        (warehouse_id, product_id, quantity) rows of the newest checkpoint
+        before moment and of the ledger totals since, which add up to the
+        balances at moment
+        """
+        checkpoint_at = self.latest_before(moment)
+        filters = {}
+        if warehouse_ids is not None:
+            filters['warehouse_id__in'] = warehouse_ids
+        if product_ids is not None:
+            filters['product_id__in'] = product_ids
+
+        checkpoints = self.none()
+        entries = StockLedgerEntry.objects.filter(created_at__lte=moment, **filters)
+        if checkpoint_at is not None:
+            checkpoints = self.filter(taken_at=checkpoint_at, **filters)
+            entries = entries.filter(created_at__gt=checkpoint_at)
+        changes = entries.order_by().values('warehouse_id', 'product_id').annotate(total=Sum('delta'))
+        return (
+            checkpoints.values_list('warehouse_id', 'product_id', 'quantity'),
+            changes.values_list('warehouse_id', 'product_id', 'total'),
+        )
+
+    def balances(self, moment, warehouse_ids=None, product_ids=None):
+        """
+        Stock per (warehouse_id, product_id) at moment: the newest checkpoint
+        before it plus the ledger entries since, so at most one checkpoint
+        interval of entries is read. Keys without stock are left out
+        """
+        balances = defaultdict(int)
+        for source in self._balance_sources(moment, warehouse_ids, product_ids):
+            for warehouse_id, product_id, quantity in source:
+                balances[warehouse_id, product_id] += quantity
+        return {key: quantity for key, quantity in balances.items() if quantity}
+
+    def balance_page(self, moment, ordering, position=None, limit=100, warehouse_ids=None, product_ids=None):
+        """
+        Up to limit (warehouse_id, product_id, quantity) balances at moment
+        strictly after position in ordering, which sorts warehouse_id and
+        product_id in the same direction. Reads only as many checkpoint
+        rows and ledger totals as the page needs
+        """
+        sources = self._balance_sources(moment, warehouse_ids, product_ids)
+        descending = ordering[0].startswith('-')
+        rows = []
+        while len(rows) < limit:
+            totals = defaultdict(int)
+            bounds = []
+            for source in sources:
+                if position is not None:
+                    source = source.filter(rows_after(position, ordering))
+                fetched = list(source.order_by(*ordering)[:limit])
+                for warehouse_id, product_id, quantity in fetched:
+                    totals[warehouse_id, product_id] += quantity
+                if len(fetched) == limit:
+                    # Keys after the last one fetched may still have rows here
+                    bounds.append(fetched[-1][:2])
+            # Keys up to the nearest bound are complete in both sources
+            bound = (max if descending else min)(bounds) if bounds else None
+            for key in sorted(totals, reverse=descending):
+                if bound is not None and (key < bound if descending else key > bound):
+                    break
+                if totals[key]:
+                    rows.append((*key, totals[key]))
+            if bound is None:
+                break
+            position = list(bound)
+        return rows[:limit]
+
+    def create_checkpoint(self, moment):
+        """Store the balances at moment; returns the number of rows written"""
+        latest = self.latest_before(moment)
+        if latest == moment:
+            return 0
+        if self.filter(taken_at__gt=moment).exists():
+            raise ValueError('Checkpoints must be taken in chronological order')
+        checkpoints = self.bulk_create([
+            self.model(warehouse_id=warehouse_id, product_id=product_id, quantity=quantity, taken_at=moment)
+            for (warehouse_id, product_id), quantity in self.balances(moment).items()
+        ], batch_size=1000)
+        return len(checkpoints)
+
+
+    def prune(self, before, since=None):
+        """
+        Thin the checkpoints taken before `before` (and from since on, to
+        bound the scan) out to the first of each day. Returns the number of
+        rows deleted
+        """
+        checkpoints = self.filter(taken_at__lt=before)
+        if since is not None:
+            checkpoints = checkpoints.filter(taken_at__gte=since)
+        firsts = checkpoints.annotate(day=TruncDay('taken_at')).values('day').annotate(
+            first=Min('taken_at')
+        ).values('first')
+        return checkpoints.exclude(taken_at__in=firsts).delete()[0]
+
+
+class StockCheckpoint(models.Model):
+    """Stock of every (warehouse, product) at a moment, derived from the ledger"""
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    quantity = models.IntegerField()
+    taken_at = models.DateTimeField()
+
+    objects = StockCheckpointManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['taken_at', 'warehouse', 'product'], name='unique_stock_checkpoint'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} of product {self.product_id} at warehouse {self.warehouse_id} on {self.taken_at}"
+
+
+def floor_time(moment, period):
+    """Start of the UTC hour or day containing moment"""
+    moment = moment.astimezone(dt_timezone.utc).replace(minute=0, second=0, microsecond=0)
+    if period == StockTransactionRollup.DAY:
+        moment = moment.replace(hour=0)
+    return moment
+
+
+def ceil_time(moment, period):
+    floor = floor_time(moment, period)
+    return floor if floor == moment else floor + StockTransactionRollup.PERIODS[period]
+
+
+def month_start(moment):
+    """Start of the UTC calendar month containing moment"""
+    return floor_time(moment, StockTransactionRollup.DAY).replace(day=1)
+
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def rollup_ranges(start=None, end=None):
+    """
+    Split [start, end] into the rollup buckets lying entirely inside it and
+    the partial hours at either end, which are counted from the transactions.
+    Returns (bucket filter, transaction filter or None); no range means all time
+    """
+    HOUR, DAY = StockTransactionRollup.HOUR, StockTransactionRollup.DAY
+    if start is None and end is None:
+        return Q(period=DAY), None
+    first_hour, last_hour = ceil_time(start, HOUR), floor_time(end, HOUR)
+    if first_hour > last_hour:
+        # Start and end fall within the same hour
+        return Q(pk__in=[]), Q(created_at__range=(start, end))
+
+    edges = Q(created_at__gte=last_hour, created_at__lte=end)
+    if start < first_hour:
+        edges |= Q(created_at__gte=start, created_at__lt=first_hour)
+
+    first_day, last_day = ceil_time(first_hour, DAY), floor_time(last_hour, DAY)
+    if first_day < last_day:
+        buckets = (
+            Q(period=HOUR, bucket__gte=first_hour, bucket__lt=first_day)
+            | Q(period=DAY, bucket__gte=first_day, bucket__lt=last_day)
+            | Q(period=HOUR, bucket__gte=last_day, bucket__lt=last_hour)
+        )
+    else:
+        buckets = Q(period=HOUR, bucket__gte=first_hour, bucket__lt=last_hour)
+    return buckets, edges
+
+
+class StockTransactionRollupQuerySet(models.QuerySet):
+    def matching(self, warehouse_ids=None, warehouse_id=None, transaction_type=None):
+        """Rollups of transactions that StockTransactionQuerySet.matching() would select"""
+        queryset = self
+        if warehouse_ids is not None:
+            queryset = queryset.filter(
+                Q(source_warehouse__in=warehouse_ids) | Q(destination_warehouse__in=warehouse_ids)
             )
-            source_stock.quantity -= self.quantity
-            source_stock.save()
-            
-            # Add to destination warehouse
-            dest_stock, created = WarehouseStock.objects.get_or_create(
-                warehouse=self.destination_warehouse,
-                product=self.product,
-                defaults={'quantity': 0}
+        if warehouse_id is not None:
+            queryset = queryset.filter(Q(source_warehouse=warehouse_id) | Q(destination_warehouse=warehouse_id))
+        if transaction_type:
+            queryset = queryset.filter(transaction_type=transaction_type)
+        return queryset
+
+
+class StockTransactionRollupManager(models.Manager.from_queryset(StockTransactionRollupQuerySet)):
+    key_fields = ('source_warehouse', 'destination_warehouse', 'transaction_type', 'transfer_type')
+
+    def record(self, transactions, batch_size=500):
+        """Add transactions to their hourly and daily rollups with one upsert per batch"""
+        totals = defaultdict(lambda: [0, 0])
+        for stock_transaction in transactions:
+            key = (
+                stock_transaction.source_warehouse_id or 0, stock_transaction.destination_warehouse_id or 0,
+                stock_transaction.transaction_type, stock_transaction.transfer_type or '',
             )
-            dest_stock.quantity += self.quantity
-            dest_stock.save()
+            for period in self.model.PERIODS:
+                bucket = floor_time(stock_transaction.created_at, period)
+                for product_id in (stock_transaction.product_id, self.model.ALL_PRODUCTS):
+                    total = totals[(period, product_id, bucket) + key]
+                    total[0] += 1
+                    total[1] += stock_transaction.quantity
 
-            # Check critical levels for both warehouses
-            self._check_critical_stock(source_stock)
-            self._check_critical_stock(dest_stock)
-            
-        elif self.transaction_type == 'WC':
-            source_stock = WarehouseStock.objects.get(
-                warehouse=self.source_warehouse,
-                product=self.product
+        connection = connections[router.db_for_write(self.model)]
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        key_columns = ', '.join(qn(self.model._meta.get_field(name).column) for name in self.model.KEY)
+        keys = list(totals)
+        for start in range(0, len(keys), batch_size):
+            batch = keys[start:start + batch_size]
+            params = []
+            for key in batch:
+                period, product_id, bucket, *rest = key
+                params.extend([
+                    period, product_id, connection.ops.adapt_datetimefield_value(bucket), *rest, *totals[key]
+                ])
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'INSERT INTO {table} ({key_columns}, {qn("count")}, {qn("quantity")}) '
+                    f'VALUES {", ".join(["(%s, %s, %s, %s, %s, %s, %s, %s, %s)"] * len(batch))} '
+                    f'ON CONFLICT ({key_columns}) DO UPDATE SET '
+                    f'{qn("count")} = {table}.{qn("count")} + EXCLUDED.{qn("count")}, '
+                    f'{qn("quantity")} = {table}.{qn("quantity")} + EXCLUDED.{qn("quantity")}',
+                    params
+                )
+
+    def rebuild(self, start=None, end=None, batch_size=5000):
+        """
+        Recompute the rollups of transactions created between start and end,
+        rounded out to whole days (everything by default), leaving archived
+        months alone. Meant for periods no longer receiving transactions,
+        e.g. after a bulk import. Returns the number of rollup rows written
+        """
+        transactions = StockTransaction.objects.all()
+        rollups = self.all()
+        # Archived transactions are gone, but their rollups are still valid
+        archived_until = StockTransactionArchive.objects.archived_until()
+        if archived_until is not None and (start is None or start < archived_until):
+            start = archived_until
+        if start is not None:
+            start = floor_time(start, self.model.DAY)
+            transactions = transactions.filter(created_at__gte=start)
+            rollups = rollups.filter(bucket__gte=start)
+        if end is not None:
+            end = ceil_time(end, self.model.DAY)
+            transactions = transactions.filter(created_at__lt=end)
+            rollups = rollups.filter(bucket__lt=end)
+
+        written = 0
+        with transaction.atomic():
+            rollups.delete()
+            for period, trunc in ((self.model.HOUR, TruncHour), (self.model.DAY, TruncDay)):
+                for fields in (['product_id'], []):
+                    grouped = transactions.annotate(
+                        bucket=trunc('created_at', tzinfo=dt_timezone.utc)
+                    ).order_by().values(
+                        'bucket', 'source_warehouse_id', 'destination_warehouse_id',
+                        'transaction_type', 'transfer_type', *fields
+                    ).annotate(transactions=Count('id'), units=Sum('quantity'))
+                    batch = []
+                    for row in grouped.iterator(chunk_size=batch_size):
+                        batch.append(self.model(
+                            period=period, bucket=row['bucket'],
+                            product_id=row.get('product_id', self.model.ALL_PRODUCTS),
+                            source_warehouse=row['source_warehouse_id'] or 0,
+                            destination_warehouse=row['destination_warehouse_id'] or 0,
+                            transaction_type=row['transaction_type'], transfer_type=row['transfer_type'] or '',
+                            count=row['transactions'], quantity=row['units'],
+                        ))
+                        if len(batch) == batch_size:
+                            written += len(self.bulk_create(batch))
+                            batch = []
+                    written += len(self.bulk_create(batch))
+        return written
+
+    def counts(self, start=None, end=None, **filters):
+        """
+        Number of transactions created in [start, end] (all time by default)
+        matching filters, keyed by (source_warehouse_id,
+        destination_warehouse_id, transaction_type, transfer_type)
+        """
+        buckets, edges = rollup_ranges(start, end)
+        counts = Counter()
+        rollups = self.filter(buckets, product=self.model.ALL_PRODUCTS).matching(**filters)
+        rollups = rollups.order_by().values(*self.key_fields).annotate(
+            total=Sum('count')
+        ).values_list(*self.key_fields, 'total')
+        for source_id, destination_id, transaction_type, transfer_type, total in rollups:
+            counts[source_id or None, destination_id or None, transaction_type, transfer_type or None] += total
+        if edges is not None:
+            recent = StockTransaction.objects.filter(edges).matching(**filters).order_by().values(
+                'source_warehouse_id', 'destination_warehouse_id', 'transaction_type', 'transfer_type'
+            ).annotate(total=Count('id')).values_list(
+                'source_warehouse_id', 'destination_warehouse_id', 'transaction_type', 'transfer_type', 'total'
             )
-            source_stock.quantity -= self.quantity
-            source_stock.save()
+            for *key, total in recent:
+                counts[tuple(key)] += total
+        return counts
 
-            # Check critical level
-            self._check_critical_stock(source_stock)
-            
-        elif self.transaction_type == 'CW':
-            dest_stock, created = WarehouseStock.objects.get_or_create(
-                warehouse=self.destination_warehouse,
-                product=self.product,
-                defaults={'quantity': 0}
+    def top_products(self, limit, start=None, end=None, **filters):
+        """
+        The limit products with the most transactions created in [start, end]
+        matching filters, as (product_id, name, count), most first
+        """
+        buckets, edges = rollup_ranges(start, end)
+        ranked = self.filter(buckets).exclude(product=self.model.ALL_PRODUCTS).matching(**filters)
+        ranked = ranked.order_by().values('product_id', 'product__name').annotate(
+            total=Sum('count')
+        ).values_list('product_id', 'product__name', 'total')
+        totals = {
+            product_id: [name, total]
+            for product_id, name, total in ranked.order_by('-total', 'product_id')[:limit]
+        }
+        if edges is not None:
+            recent = StockTransaction.objects.filter(edges).matching(**filters).order_by().values(
+                'product_id', 'product__name'
+            ).annotate(total=Count('id')).values_list('product_id', 'product__name', 'total')
+            recent = {product_id: [name, total] for product_id, name, total in recent}
+            # Products outside the rollup top could still make it with their recent transactions
+            missing = set(recent) - set(totals)
+            if missing:
+                totals.update(
+                    (product_id, [name, total])
+                    for product_id, name, total in ranked.filter(product_id__in=missing)
+                )
+            for product_id, (name, total) in recent.items():
+                totals.setdefault(product_id, [name, 0])[1] += total
+        best = sorted(totals.items(), key=lambda item: (-item[1][1], item[0]))[:limit]
+        return [(product_id, name, total) for product_id, (name, total) in best]
+
+
+class StockTransactionRollup(models.Model):
+    """
+    Number and units of the transactions per hour or day and (product,
+    source, destination, type, transfer type), plus the same totals over
+    all products. Kept up to date as transactions are recorded, so
+    summaries over any period read these instead of the transactions.
+    Missing warehouses and transfer types are stored as 0 and '', and all
+    products as product 0, so the key can be enforced as unique
+    """
+    HOUR = 'H'
+    DAY = 'D'
+    PERIODS = {HOUR: timedelta(hours=1), DAY: timedelta(days=1)}
+    ALL_PRODUCTS = 0
+    KEY = (
+        'period', 'product', 'bucket', 'source_warehouse', 'destination_warehouse',
+        'transaction_type', 'transfer_type',
+    )
+
+    period = models.CharField(max_length=1, choices=[(HOUR, 'Hour'), (DAY, 'Day')])
+    bucket = models.DateTimeField()
+    source_warehouse = models.BigIntegerField(default=0)
+    destination_warehouse = models.BigIntegerField(default=0)
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    transaction_type = models.CharField(max_length=2)
+    transfer_type = models.CharField(max_length=50, blank=True, default='')
+    count = models.PositiveIntegerField(default=0)
+    quantity = models.PositiveBigIntegerField(default=0)
+
+    objects = StockTransactionRollupManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=[
+                    'period', 'product', 'bucket', 'source_warehouse', 'destination_warehouse',
+                    'transaction_type', 'transfer_type',
+                ],
+                name='unique_transaction_rollup'
+            ),
+        ]
+        indexes = [
+            # Top products over a period scan every product in its buckets
+            models.Index(fields=['period', 'bucket'], name='rollup_period_bucket_idx'),
+        ]
+
+    def __str__(self):
+        product = f"product {self.product_id}" if self.product_id != self.ALL_PRODUCTS else "all products"
+        return f"{self.count} {self.transaction_type} transactions of {product} in {self.get_period_display().lower()} {self.bucket}"
+
+
+class StockTransactionArchiveManager(models.Manager):
+    def archived_until(self):
+        """End of the newest archived month, or None"""
+        month = self.aggregate(month=Max('month'))['month']
+        if month is None:
+            return None
+        return add_months(datetime(month.year, month.month, 1, tzinfo=dt_timezone.utc), 1)
+
+
+class StockTransactionArchive(models.Model):
+    """
+    Transactions of a closed month moved out of the database into a
+    gzipped NDJSON file under TRANSACTION_ARCHIVE_DIR, one row per line
+    as exported. A month archived again after late inserts gets another file
+    """
+    month = models.DateField()  # first day of the UTC month
+    file = models.CharField(max_length=255)
+    rows = models.PositiveIntegerField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    objects = StockTransactionArchiveManager()
+
+    class Meta:
+        ordering = ['month', 'id']
+
+    def __str__(self):
+        return f"{self.rows} transactions of {self.month:%B %Y} in {self.file}"
+
+
+class StockReservationManager(models.Manager):
+    def reserve(self, warehouse_id, product_id, quantity, created_by, ttl=None):
+        """
+        Hold quantity units of a warehouse's stock for ttl seconds
+        (STOCK_RESERVATION_TTL by default). Held units are no longer
+        available, so other withdrawals and reservations cannot take them.
+        Raises ValidationError if not enough units are available
+        """
+        if ttl is None:
+            ttl = settings.STOCK_RESERVATION_TTL
+        with transaction.atomic():
+            if not WarehouseStock.objects.hold(warehouse_id, product_id, quantity):
+                raise WarehouseStock.objects._shortfall_error({(warehouse_id, product_id): -quantity})
+            return self.create(
+                warehouse_id=warehouse_id, product_id=product_id, quantity=quantity,
+                created_by=created_by, expires_at=timezone.now() + timedelta(seconds=ttl)
             )
-            dest_stock.quantity += self.quantity
-            dest_stock.save()
-
-            # Check critical level
-            self._check_critical_stock(dest_stock)
-
-    def _check_critical_stock(self, stock):
-        """Check if stock is at critical level and send alert if necessary"""
-        if stock.quantity <= stock.product.minimum_stock:
-            # Get admin users and warehouse authorized users
-            admin_users = User.objects.filter(is_staff=True)
-            warehouse_users = stock.warehouse.authorized_users.all()
-            all_users = set(list(admin_users) + list(warehouse_users))
-
-            # Create email message
-            message = f"""
-Critical Stock Alert!
-
-Warehouse: {stock.warehouse.name}
-Product: {stock.product.name}
-Current Stock: {stock.quantity}
-Minimum Stock Level: {stock.product.minimum_stock}
-Time: {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
-
-This is an automated notification. Please take necessary action to replenish the stock.
-"""
-            # Send email
-            send_mail(
-                subject=f'Critical Stock Alert - {stock.warehouse.name} - {stock.product.name}',
-                message=message,
-                from_email=settings.DEFAULT_FROM_EMAIL,
-                recipient_list=[user.email for user in all_users if user.email],
+
+    def expire(self, batch_size=300):
+        """
+        Expire every held reservation past its expiry time and return its
+        units to the available stock: one UPDATE for the reservations and
+        one per batch of stock records. Returns the number expired
+        """
+        connection = connections[router.db_for_write(self.model)]
+        qn = connection.ops.quote_name
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        holds = defaultdict(int)
+        with transaction.atomic(using=connection.alias):
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f'UPDATE {qn(self.model._meta.db_table)} '
+                    f'SET {qn("status")} = %s, {qn("updated_at")} = %s '
+                    f'WHERE {qn("status")} = %s AND {qn("expires_at")} <= %s '
+                    f'RETURNING {qn("warehouse_id")}, {qn("product_id")}, {qn("quantity")}',
+                    [self.model.EXPIRED, now, self.model.HELD, now]
+                )
+                expired = cursor.fetchall()
+            for warehouse_id, product_id, quantity in expired:
+                holds[warehouse_id, product_id] += quantity
+            WarehouseStock.objects.release_holds(holds, batch_size=batch_size)
+        return len(expired)
+
+
+class StockReservation(models.Model):
+    """
+    Units of a warehouse's stock held for an order while it is picked.
+    Confirming records the withdrawal; releasing or expiring returns the
+    units to the available stock
+    """
+    HELD = 'HELD'
+    CONFIRMED = 'CONFIRMED'
+    RELEASED = 'RELEASED'
+    EXPIRED = 'EXPIRED'
+    STATUSES = [
+        (HELD, 'Held'),
+        (CONFIRMED, 'Confirmed'),
+        (RELEASED, 'Released'),
+        (EXPIRED, 'Expired'),
+    ]
+
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=10, choices=STATUSES, default=HELD)
+    expires_at = models.DateTimeField()
+    # The withdrawal recorded on confirmation
+    transaction = models.ForeignKey(
+        'StockTransaction', on_delete=models.DO_NOTHING, db_constraint=False,
+        null=True, blank=True, related_name='+'
+    )
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = StockReservationManager()
+
+    class Meta:
+        indexes = [
+            # The sweeper's scan for expired holds
+            models.Index(fields=['expires_at'], condition=Q(status='HELD'), name='reservation_held_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} of product {self.product_id} at warehouse {self.warehouse_id} ({self.status})"
+
+    def confirm(self, stock_transaction):
+        """
+        Save stock_transaction, an unsaved withdrawal of exactly the reserved
+        units, in place of the hold. The hold is released and the units
+        withdrawn in one database transaction, so no one else can take them
+        in between. Raises ValidationError if the reservation has expired or
+        was already confirmed or released
+        """
+        withdrawal = (stock_transaction.source_warehouse_id, stock_transaction.product_id, stock_transaction.quantity)
+        if withdrawal != (self.warehouse_id, self.product_id, self.quantity):
+            raise ValidationError('The transaction must withdraw the reserved units from the reserved warehouse')
+        with transaction.atomic():
+            self._finish(self.CONFIRMED, expired_ok=False)
+            stock_transaction.save()
+            self.transaction = stock_transaction
+            StockReservation.objects.filter(pk=self.pk).update(transaction=stock_transaction)
+        return stock_transaction
+
+    def release(self):
+        """Return the held units to the available stock"""
+        with transaction.atomic():
+            self._finish(self.RELEASED, expired_ok=True)
+
+    def _finish(self, status, expired_ok):
+        now = timezone.now()
+        held = StockReservation.objects.filter(pk=self.pk, status=self.HELD)
+        if not expired_ok:
+            held = held.filter(expires_at__gt=now)
+        # The conditional update claims the hold, so it is given back only once
+        if not held.update(status=status, updated_at=now):
+            raise ValidationError('The reservation has expired or was already confirmed or released')
+        WarehouseStock.objects.release_holds({(self.warehouse_id, self.product_id): self.quantity})
+        self.status = status
+        self.updated_at = now
+
+
+def stock_is_critical(quantity, minimum_stock):
+    """Whether a stock record is critical; None for quantity means no record"""
+    return quantity is not None and quantity <= minimum_stock
+
+
+class CriticalStockEventManager(models.Manager):
+    def record(self, changes):
+        """
+        Write an event for each stock record that entered or left critical
+        state. changes holds (warehouse_id, product_id, was_critical,
+        quantity, minimum_stock), with None for quantity if the record was
+        deleted
+        """
+        events = [
+            self.model(
+                warehouse_id=warehouse_id, product_id=product_id, quantity=quantity,
+                minimum_stock=minimum_stock, is_critical=not was_critical
             )
+            for warehouse_id, product_id, was_critical, quantity, minimum_stock in changes
+            if was_critical != stock_is_critical(quantity, minimum_stock)
+        ]
+        if events:
+            self.bulk_create(events)
+            bump_critical_stock_events()
+        return events
+
+
+class CriticalStockEvent(models.Model):
+    """
+    A stock record entering or leaving critical state, kept for the
+    critical stock stream. Outlives the records it references
+    """
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    product = models.ForeignKey(Product, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    # Empty when the stock record was deleted
+    quantity = models.PositiveIntegerField(null=True, blank=True)
+    minimum_stock = models.PositiveIntegerField()
+    is_critical = models.BooleanField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    objects = CriticalStockEventManager()
+
+    def __str__(self):
+        state = 'critical' if self.is_critical else 'no longer critical'
+        return f"Product {self.product_id} at warehouse {self.warehouse_id} {state}: {self.quantity}"
+
+
+class CriticalStockAlert(models.Model):
+    """A critical stock alert waiting to go out in the next digest email"""
+    warehouse = models.ForeignKey(Warehouse, on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.product} at {self.warehouse}: {self.quantity}"
+
+
+def queue_critical_stock_alert(warehouse_id, product_id):
+    """Hand the alert to Celery once the current transaction commits"""
+    from .tasks import send_critical_stock_alert
+
+    transaction.on_commit(
+        lambda: send_critical_stock_alert.delay(warehouse_id, product_id)
+    )
@@ -0,0 +1,164 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+from functools import reduce
+from operator import or_
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+Cursor = namedtuple('Cursor', ['position', 'reverse'])
+
+
+def rows_after(position, ordering):
+    """Rows strictly after position, e.g. a > x OR (a = x AND b > y)"""
+    clauses = []
+    for index, field in enumerate(ordering):
+        name = field.lstrip('-')
+        lookup = 'lt' if field.startswith('-') else 'gt'
+        clause = {
+            other.lstrip('-'): value
+            for other, value in zip(ordering[:index], position[:index])
+        }
+        clause[f'{name}__{lookup}'] = position[index]
+        clauses.append(Q(**clause))
+    return reduce(or_, clauses)
+
+
+class KeysetPagination(BasePagination):
+    """
+    Cursor pagination over a composite, unique ordering. Pages are selected
+    with a WHERE on the boundary row's key instead of an OFFSET, so a deep
+    page costs the same as the first one
+    """
+    cursor_query_param = 'cursor'
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    # Attribute names, optionally prefixed with '-', ending in a unique field
+    ordering = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        def fetch(ordering, position, limit):
+            rows = queryset.order_by(*ordering)
+            if position is not None:
+                rows = rows.filter(rows_after(position, ordering))
+            return list(rows[:limit])
+
+        return self.paginate(fetch, queryset.model, request)
+
+    def paginate(self, fetch, model, request):
+        """
+        Paginate rows that are not a queryset. fetch(ordering, position,
+        limit) returns the first limit rows in ordering strictly after
+        position, or from the start when it is None; model's fields
+        validate cursor values
+        """
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            cursor = cursor._replace(position=self.coerce_position(cursor.position, model))
+        reverse = bool(cursor and cursor.reverse)
+
+        ordering = [self._flip(field) for field in self.ordering] if reverse else list(self.ordering)
+        results = fetch(ordering, cursor.position if cursor else None, self.page_size + 1)
+        has_more = len(results) > self.page_size
+        results = results[:self.page_size]
+        if reverse:
+            results.reverse()
+
+        self.has_next = has_more if not reverse else cursor is not None
+        self.has_previous = cursor is not None if not reverse else has_more
+        self.first_position = self._position(results[0]) if results else None
+        self.last_position = self._position(results[-1]) if results else None
+        return results
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True,
+                cutoff=self.max_page_size
+            )
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_next_link(self):
+        if not self.has_next or self.last_position is None:
+            return None
+        return self.encode_cursor(Cursor(self.last_position, False))
+
+    def get_previous_link(self):
+        if not self.has_previous or self.first_position is None:
+            return None
+        return self.encode_cursor(Cursor(self.first_position, True))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            payload = json.loads(base64.urlsafe_b64decode(encoded.encode('ascii')))
+            position, reverse = payload['p'], bool(payload['r'])
+        except (TypeError, ValueError, KeyError, binascii.Error, UnicodeEncodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return Cursor(position, reverse)
+
+    def coerce_position(self, position, model):
+        """Convert the cursor's values to the types of the ordering fields"""
+        values = []
+        try:
+            for field, value in zip(self.ordering, position):
+                if value is None:
+                    raise ValueError
+                values.append(model._meta.get_field(field.lstrip('-')).to_python(value))
+        except (ValidationError, ValueError, TypeError):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def encode_cursor(self, cursor):
+        payload = json.dumps({'p': cursor.position, 'r': int(cursor.reverse)})
+        encoded = base64.urlsafe_b64encode(payload.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def _position(self, instance):
+        values = []
+        for field in self.ordering:
+            name = field.lstrip('-')
+            value = instance[name] if isinstance(instance, dict) else getattr(instance, name)
+            values.append(value.isoformat() if hasattr(value, 'isoformat') else value)
+        return values
+
+    @staticmethod
+    def _flip(field):
+        return field[1:] if field.startswith('-') else f'-{field}'
+
+
+class StockTransactionPagination(KeysetPagination):
+    ordering = ('-created_at', 'id')
+
+
+class WarehouseStockPagination(KeysetPagination):
+    ordering = ('warehouse_id', 'product_id')
+
+
+class StockReservationPagination(KeysetPagination):
+    ordering = ('-id',)
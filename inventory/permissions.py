@@ -1,6 +1,48 @@
+from django.conf import settings
+from django.core.cache import cache
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 from rest_framework import permissions
 
+
+def authorized_warehouses_cache_key(user_id):
+    return f'authorized_warehouses_{user_id}'
+
+
+def get_authorized_warehouse_ids(user):
+    """
+    Ids of the warehouses a user is authorized for. Kept on the user for the
+    rest of the request and cached across requests until access changes
+    """
+    warehouse_ids = getattr(user, '_authorized_warehouse_ids', None)
+    if warehouse_ids is None:
+        cache_key = authorized_warehouses_cache_key(user.pk)
+        warehouse_ids = cache.get(cache_key)
+        if warehouse_ids is None:
+            warehouse_ids = frozenset(user.authorized_warehouses.values_list('id', flat=True))
+            cache.set(cache_key, warehouse_ids, timeout=settings.AUTHORIZED_WAREHOUSES_CACHE_TIMEOUT)
+        user._authorized_warehouse_ids = warehouse_ids
+    return warehouse_ids
+
+
+async def aget_authorized_warehouse_ids(user):
+    """Async version of get_authorized_warehouse_ids for async views"""
+    warehouse_ids = getattr(user, '_authorized_warehouse_ids', None)
+    if warehouse_ids is None:
+        cache_key = authorized_warehouses_cache_key(user.pk)
+        warehouse_ids = await cache.aget(cache_key)
+        if warehouse_ids is None:
+            warehouse_ids = frozenset([
+                warehouse_id async for warehouse_id in user.authorized_warehouses.values_list('id', flat=True)
+            ])
+            await cache.aset(cache_key, warehouse_ids, timeout=settings.AUTHORIZED_WAREHOUSES_CACHE_TIMEOUT)
+        user._authorized_warehouse_ids = warehouse_ids
+    return warehouse_ids
+
+
+def has_warehouse_access(user, warehouse_id):
+    return warehouse_id is not None and warehouse_id in get_authorized_warehouse_ids(user)
+
+
 class IsAdminUser(permissions.BasePermission):
     def has_permission(self, request, view):
         return request.user and request.user.is_staff and request.user.is_superuser
@@ -9,15 +51,11 @@ class HasWarehouseAccess(permissions.BasePermission):
     def has_object_permission(self, request, view, obj):
         if request.user.is_staff and request.user.is_superuser:
             return True
-            
-        
-        if hasattr(obj, 'warehouse'):
-            return request.user in obj.warehouse.authorized_users.all()
-        elif hasattr(obj, 'source_warehouse'):
-            has_source_access = (obj.source_warehouse and 
-                               request.user in obj.source_warehouse.authorized_users.all())
-            has_dest_access = (obj.destination_warehouse and 
-                             request.user in obj.destination_warehouse.authorized_users.all())
-            return has_source_access or has_dest_access
-        
+
+        if hasattr(obj, 'warehouse_id'):
+            return has_warehouse_access(request.user, obj.warehouse_id)
+        elif hasattr(obj, 'source_warehouse_id'):
+            return (has_warehouse_access(request.user, obj.source_warehouse_id) or
+                    has_warehouse_access(request.user, obj.destination_warehouse_id))
+
         return False
@@ -0,0 +1,57 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+_read_from_replica = ContextVar('read_from_replica', default=False)
+
+
+@contextmanager
+def replica_reads(enabled=True):
+    """Send reads made inside the block to the read replica, if one is configured"""
+    token = _read_from_replica.set(enabled)
+    try:
+        yield
+    finally:
+        _read_from_replica.reset(token)
+
+
+def primary_pin_cache_key(user_id):
+    return f'replica_primary_pin_{user_id}'
+
+
+def pin_to_primary(user):
+    """Serve the user's reads from the primary until the replica has caught up with their write"""
+    cache.set(primary_pin_cache_key(user.pk), True, timeout=settings.REPLICA_STICKY_SECONDS)
+
+
+def is_pinned_to_primary(user):
+    return bool(cache.get(primary_pin_cache_key(user.pk)))
+
+
+class PrimaryReplicaRouter:
+    """
+    Writes always go to the primary. Reads go to settings.REPLICA_DATABASE
+    only inside replica_reads() and never within a transaction on the primary
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = settings.REPLICA_DATABASE
+        if (replica and _read_from_replica.get()
+                and not connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return replica
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == settings.REPLICA_DATABASE:
+            return False
+        return None
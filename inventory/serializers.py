@@ -1,31 +1,37 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import F
+from django.utils import timezone
 from .models import (
     Warehouse, Customer, Product, WarehouseStock,
-    StockTransaction
+    StockTransaction, StockReservation
 )
+from .metrics import TimedSerializerMixin, timed_serialization
+from .permissions import has_warehouse_access
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'email', 'is_staff')
 
-class WarehouseSerializer(serializers.ModelSerializer):
+class WarehouseSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Warehouse
         fields = '__all__'
 
-class CustomerSerializer(serializers.ModelSerializer):
+class CustomerSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Customer
         fields = '__all__'
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = '__all__'
 
-class WarehouseStockSerializer(serializers.ModelSerializer):
+class WarehouseStockSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only=True)
     warehouse_name = serializers.CharField(source='warehouse.name', read_only=True)
     
@@ -33,7 +39,13 @@ class WarehouseStockSerializer(serializers.ModelSerializer):
         model = WarehouseStock
         fields = '__all__'
 
-class StockTransactionSerializer(serializers.ModelSerializer):
+    def validate_quantity(self, quantity):
+        # Held units stay until their reservations are confirmed, released or expire
+        if self.instance is not None and quantity < self.instance.reserved:
+            raise serializers.ValidationError(f'{self.instance.reserved} units are reserved')
+        return quantity
+
+class StockTransactionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     source_warehouse_name = serializers.CharField(source='source_warehouse.name', read_only=True)
     destination_warehouse_name = serializers.CharField(source='destination_warehouse.name', read_only=True)
     customer_name = serializers.CharField(source='customer.name', read_only=True)
@@ -61,23 +73,23 @@ class StockTransactionSerializer(serializers.ModelSerializer):
             if transaction_type == 'WW':
                 if not source_warehouse or not destination_warehouse:
                     raise serializers.ValidationError('Both warehouses are required for warehouse-to-warehouse transfer')
-                if user not in source_warehouse.authorized_users.all():
+                if not has_warehouse_access(user, source_warehouse.id):
                     raise serializers.ValidationError('You do not have access to the source warehouse')
-                if user not in destination_warehouse.authorized_users.all():
+                if not has_warehouse_access(user, destination_warehouse.id):
                     raise serializers.ValidationError('You do not have access to the destination warehouse')
 
             # For WC transfers, check access to source warehouse
             elif transaction_type == 'WC':
                 if not source_warehouse or not customer:
                     raise serializers.ValidationError('Source warehouse and customer are required for warehouse-to-customer transfer')
-                if user not in source_warehouse.authorized_users.all():
+                if not has_warehouse_access(user, source_warehouse.id):
                     raise serializers.ValidationError('You do not have access to the source warehouse')
 
             # For CW transfers, check access to destination warehouse
             elif transaction_type == 'CW':
                 if not destination_warehouse or not customer:
                     raise serializers.ValidationError('Destination warehouse and customer are required for customer-to-warehouse transfer')
-                if user not in destination_warehouse.authorized_users.all():
+                if not has_warehouse_access(user, destination_warehouse.id):
                     raise serializers.ValidationError('You do not have access to the destination warehouse')
 
         return attrs
@@ -85,4 +97,120 @@ class StockTransactionSerializer(serializers.ModelSerializer):
     def create(self, validated_data):
         # Get the user from context and add it to validated_data
         validated_data['performed_by'] = self.context['request'].user
-        return super().create(validated_data)
\ No newline at end of file
+        return super().create(validated_data)
+
+
+class StockTransactionRowSerializer:
+    """
+    Read-only fast path for transaction listings with the same output as
+    StockTransactionSerializer. Rows are fetched with .values() and the
+    related names joined in the same query, so no model instances or
+    per-row field objects are created; only datetimes need converting
+    """
+    fields = (
+        'id', 'source_warehouse', 'destination_warehouse', 'customer', 'product',
+        'quantity', 'transaction_type', 'transfer_type', 'notes', 'performed_by',
+        'created_at', 'updated_at',
+    )
+    names = {
+        'source_warehouse_name': F('source_warehouse__name'),
+        'destination_warehouse_name': F('destination_warehouse__name'),
+        'customer_name': F('customer__name'),
+        'product_name': F('product__name'),
+        'performed_by_username': F('performed_by__username'),
+    }
+    datetime_fields = ('created_at', 'updated_at')
+
+    @classmethod
+    def get_queryset(cls, queryset):
+        return queryset.select_related(None).values(*cls.fields, **cls.names)
+
+    @classmethod
+    def to_representation(cls, rows):
+        with timed_serialization():
+            return list(cls.iter_representation(rows))
+
+    @classmethod
+    def iter_representation(cls, rows):
+        # Resolve the timezone once rather than for every value
+        to_datetime = serializers.DateTimeField(
+            default_timezone=timezone.get_current_timezone() if settings.USE_TZ else None
+        ).to_representation
+        for row in rows:
+            for field in cls.datetime_fields:
+                row[field] = to_datetime(row[field])
+            # Like the dotted-source fields, leave out names of missing relations
+            for name in cls.names:
+                if row[name] is None:
+                    del row[name]
+            yield row
+
+
+class BulkStockTransactionSerializer(serializers.Serializer):
+    """
+    Validates one row of a bulk upload without any per-row queries. Related
+    objects are plain ids; warehouse access is checked against the set of
+    authorized warehouse ids passed in the context (None for staff)
+    """
+    source_warehouse = serializers.IntegerField(source='source_warehouse_id', required=False, allow_null=True)
+    destination_warehouse = serializers.IntegerField(source='destination_warehouse_id', required=False, allow_null=True)
+    customer = serializers.IntegerField(source='customer_id', required=False, allow_null=True)
+    product = serializers.IntegerField(source='product_id')
+    quantity = serializers.IntegerField(min_value=0)
+    transaction_type = serializers.ChoiceField(choices=StockTransaction.TRANSACTION_TYPES)
+    transfer_type = serializers.ChoiceField(choices=StockTransaction.TRANSFER_TYPES, required=False, allow_null=True)
+    notes = serializers.CharField(required=False, allow_blank=True, default='')
+
+    def validate(self, attrs):
+        try:
+            StockTransaction(**attrs).validate_transfer()
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+
+        warehouse_ids = self.context.get('warehouse_ids')
+        if warehouse_ids is not None:
+            source_id = attrs.get('source_warehouse_id')
+            dest_id = attrs.get('destination_warehouse_id')
+            if source_id and source_id not in warehouse_ids:
+                raise serializers.ValidationError('You do not have access to the source warehouse')
+            if dest_id and dest_id not in warehouse_ids:
+                raise serializers.ValidationError('You do not have access to the destination warehouse')
+
+        return attrs
+
+
+class StockReservationSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    ttl = serializers.IntegerField(
+        min_value=1, max_value=settings.STOCK_RESERVATION_MAX_TTL, required=False, write_only=True,
+        help_text='Seconds to hold the units; STOCK_RESERVATION_TTL by default'
+    )
+    quantity = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        model = StockReservation
+        fields = '__all__'
+        read_only_fields = ('status', 'expires_at', 'transaction', 'created_by')
+
+    def validate(self, attrs):
+        user = self.context['request'].user
+        if not user.is_staff and not has_warehouse_access(user, attrs['warehouse'].id):
+            raise serializers.ValidationError({'warehouse': 'You do not have access to this warehouse'})
+        return attrs
+
+    def create(self, validated_data):
+        try:
+            return StockReservation.objects.reserve(
+                validated_data['warehouse'].id, validated_data['product'].id, validated_data['quantity'],
+                created_by=self.context['request'].user, ttl=validated_data.get('ttl')
+            )
+        except DjangoValidationError as e:
+            raise serializers.ValidationError({'error': e.messages})
+
+
+class StockLookupSerializer(serializers.Serializer):
+    """Body of a batch stock lookup: the SKUs and optionally the warehouses to search"""
+    skus = serializers.ListField(
+        child=serializers.CharField(max_length=50), allow_empty=False,
+        max_length=settings.STOCK_LOOKUP_MAX_SKUS
+    )
+    warehouses = serializers.ListField(child=serializers.IntegerField(), required=False)
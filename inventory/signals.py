@@ -0,0 +1,216 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_save, post_delete, pre_save, pre_delete
+from django.dispatch import receiver
+
+from .models import (
+    Warehouse, Product, WarehouseStock, WarehouseStockSummary, StockLedgerEntry, CriticalStockEvent,
+    stock_is_critical
+)
+from .caching import bump_warehouse_generations, delete_on_commit
+from .lookups import product_sku_cache_key, forget_product_skus
+from .metrics import record_query
+from .permissions import authorized_warehouses_cache_key
+from .tasks import alert_recipients_cache_key
+
+
+@receiver(m2m_changed, sender=Warehouse.authorized_users.through)
+def invalidate_alert_recipients(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop cached alert recipients when warehouse users change"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance is a user; pk_set holds warehouse ids (None on clear)
+        warehouse_ids = pk_set if pk_set is not None else Warehouse.objects.values_list('id', flat=True)
+    else:
+        warehouse_ids = [instance.pk]
+    delete_on_commit([alert_recipients_cache_key(warehouse_id) for warehouse_id in warehouse_ids])
+
+
+@receiver(m2m_changed, sender=Warehouse.authorized_users.through)
+def invalidate_authorized_warehouses(sender, instance, action, reverse, pk_set, **kwargs):
+    """Drop the cached warehouse ids of users whose access changed"""
+    if reverse:
+        if action not in ('post_add', 'post_remove', 'post_clear'):
+            return
+        user_ids = [instance.pk]
+        instance.__dict__.pop('_authorized_warehouse_ids', None)
+    elif action in ('post_add', 'post_remove'):
+        user_ids = pk_set
+    elif action == 'pre_clear':
+        # pk_set is None on clear, so collect the users before they are removed
+        user_ids = instance.authorized_users.values_list('id', flat=True)
+    else:
+        return
+    delete_on_commit([authorized_warehouses_cache_key(user_id) for user_id in user_ids])
+
+
+@receiver(pre_delete, sender=Warehouse)
+def forget_deleted_warehouse_access(sender, instance, **kwargs):
+    user_ids = instance.authorized_users.values_list('id', flat=True)
+    delete_on_commit([authorized_warehouses_cache_key(user_id) for user_id in user_ids])
+
+
+@receiver(post_save, sender=Warehouse)
+def create_stock_summary(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        WarehouseStockSummary.objects.get_or_create(warehouse=instance)
+    # Cached stats show the warehouse name
+    bump_warehouse_generations([instance.pk])
+
+
+@receiver(post_save, sender=WarehouseStock)
+def update_stock_summary(sender, instance, created, raw=False, **kwargs):
+    """
+    Keep summaries in step with stock records saved through the ORM, e.g.
+    the admin or the stock API. Transactions update them directly
+    """
+    if raw or getattr(instance, '_summary_recorded', False):
+        return
+    changes = [(instance.warehouse_id, instance.minimum_stock, None, instance.quantity)]
+    previous = getattr(instance, '_previous_position', None)
+    if not created:
+        if previous is None:
+            WarehouseStockSummary.objects.rebuild([instance.warehouse_id])
+            bump_warehouse_generations([instance.warehouse_id])
+            return
+        # The record may have moved to another warehouse
+        warehouse_id, _, quantity, minimum_stock = previous
+        changes.append((warehouse_id, minimum_stock, quantity, None))
+    WarehouseStockSummary.objects.record_changes(changes)
+    bump_warehouse_generations({warehouse_id for warehouse_id, *_ in changes})
+
+
+@receiver(post_delete, sender=WarehouseStock)
+def refresh_stock_summary(sender, instance, origin=None, **kwargs):
+    # A cascading warehouse delete removes the summary as well
+    if getattr(origin, 'model', type(origin)) is Warehouse:
+        return
+    WarehouseStockSummary.objects.record_changes(
+        [(instance.warehouse_id, instance.minimum_stock, instance.quantity, None)]
+    )
+    bump_warehouse_generations([instance.warehouse_id])
+
+
+@receiver(pre_save, sender=WarehouseStock)
+def remember_stock_position(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        instance._previous_position = WarehouseStock.objects.filter(
+            pk=instance.pk
+        ).values_list('warehouse_id', 'product_id', 'quantity', 'minimum_stock').first()
+
+
+@receiver(post_save, sender=WarehouseStock)
+def record_stock_adjustment(sender, instance, created, raw=False, **kwargs):
+    """Write direct stock edits to the ledger; transactions write their own entries"""
+    if raw or getattr(instance, '_ledger_recorded', False):
+        return
+    entries = [(instance.warehouse_id, instance.product_id, instance.quantity)]
+    previous = getattr(instance, '_previous_position', None)
+    if not created and previous is not None:
+        warehouse_id, product_id, quantity, _ = previous
+        entries.append((warehouse_id, product_id, -quantity))
+    StockLedgerEntry.objects.bulk_create([
+        StockLedgerEntry(warehouse_id=warehouse_id, product_id=product_id, delta=delta)
+        for warehouse_id, product_id, delta in _net_changes(entries)
+    ])
+
+
+@receiver(post_delete, sender=WarehouseStock)
+def record_stock_removal(sender, instance, **kwargs):
+    if instance.quantity:
+        StockLedgerEntry.objects.create(
+            warehouse_id=instance.warehouse_id, product_id=instance.product_id, delta=-instance.quantity
+        )
+
+
+@receiver(post_save, sender=WarehouseStock)
+def record_critical_stock_change(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    changes = [(instance.warehouse_id, instance.product_id, False, instance.quantity, instance.minimum_stock)]
+    previous = getattr(instance, '_previous_position', None)
+    if not created and previous is not None:
+        warehouse_id, product_id, quantity, minimum_stock = previous
+        was_critical = stock_is_critical(quantity, minimum_stock)
+        if (warehouse_id, product_id) == (instance.warehouse_id, instance.product_id):
+            changes = [(warehouse_id, product_id, was_critical, instance.quantity, instance.minimum_stock)]
+        else:
+            changes.append((warehouse_id, product_id, was_critical, None, minimum_stock))
+    CriticalStockEvent.objects.record(changes)
+
+
+@receiver(post_delete, sender=WarehouseStock)
+def record_critical_stock_removal(sender, instance, **kwargs):
+    CriticalStockEvent.objects.record([(
+        instance.warehouse_id, instance.product_id,
+        stock_is_critical(instance.quantity, instance.minimum_stock), None, instance.minimum_stock
+    )])
+
+
+def _net_changes(entries):
+    totals = {}
+    for warehouse_id, product_id, delta in entries:
+        totals[warehouse_id, product_id] = totals.get((warehouse_id, product_id), 0) + delta
+    return [(warehouse_id, product_id, delta) for (warehouse_id, product_id), delta in totals.items() if delta]
+
+
+@receiver(pre_save, sender=Product)
+def remember_minimum_stock(sender, instance, raw=False, **kwargs):
+    if instance.pk and not raw:
+        instance._previous_minimum_stock, instance._previous_sku = Product.objects.filter(
+            pk=instance.pk
+        ).values_list('minimum_stock', 'sku').first() or (None, None)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def invalidate_product_lookup(sender, instance, created=False, **kwargs):
+    previous_sku = getattr(instance, '_previous_sku', None)
+    skus = {instance.sku, previous_sku} - {None}
+    cache.delete_many([product_sku_cache_key(sku) for sku in skus])
+    # New products only add SKUs, which are never cached as missing
+    if not created and (previous_sku != instance.sku or kwargs['signal'] is post_delete):
+        forget_product_skus()
+
+
+@receiver(post_save, sender=Product)
+def refresh_critical_counts(sender, instance, created, raw=False, **kwargs):
+    """A new minimum level changes which stock records count as critical"""
+    previous = getattr(instance, '_previous_minimum_stock', None)
+    if not created and previous is not None and previous != instance.minimum_stock:
+        stocks = WarehouseStock.objects.filter(product=instance)
+        with transaction.atomic():
+            # Locked in the order transactions lock stock records, so no
+            # quantity changes between reading it and moving the minimum
+            positions = list(stocks.select_for_update().order_by('warehouse_id').values_list(
+                'warehouse_id', 'quantity'
+            ))
+            stocks.update(minimum_stock=instance.minimum_stock)
+            # Only quantities between the old and new minimum change state
+            crossing = [
+                (warehouse_id, quantity) for warehouse_id, quantity in positions
+                if min(previous, instance.minimum_stock) < quantity <= max(previous, instance.minimum_stock)
+            ]
+            CriticalStockEvent.objects.record(
+                (warehouse_id, instance.pk, stock_is_critical(quantity, previous), quantity, instance.minimum_stock)
+                for warehouse_id, quantity in crossing
+            )
+            # Counted out at the old minimum and back in at the new one
+            WarehouseStockSummary.objects.record_changes(
+                change
+                for warehouse_id, quantity in crossing
+                for change in (
+                    (warehouse_id, previous, quantity, None),
+                    (warehouse_id, instance.minimum_stock, None, quantity),
+                )
+            )
+        bump_warehouse_generations({warehouse_id for warehouse_id, _ in positions})
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    """Count every query towards the metrics of the request that runs it"""
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
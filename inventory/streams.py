@@ -0,0 +1,137 @@
+"""
+Server-Sent Events stream of stock records entering and leaving critical
+state. Like the lookups, the view runs natively under ASGI, so an idle
+stream is a sleeping coroutine. Streams poll a cache counter that each
+committed batch of events bumps, and query the event table only when it
+moves.
+
+Event ids are assigned on insert, not on commit, so an event may become
+visible after events with higher ids. Streams therefore look back over
+the events created in the last CRITICAL_STOCK_STREAM_LOOKBACK seconds as
+well as past the highest id sent
+"""
+import asyncio
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Max, Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import require_GET
+
+from .caching import CRITICAL_STOCK_EVENTS_KEY
+from .lookups import aauthenticate, error
+from .models import CriticalStockEvent
+from .permissions import aget_authorized_warehouse_ids
+
+# Events sent per query while a stream catches up
+BATCH_SIZE = 500
+
+
+def lookback():
+    return timedelta(seconds=settings.CRITICAL_STOCK_STREAM_LOOKBACK)
+
+
+def format_event(event, last_event_id):
+    # The SSE id is where a reconnecting client resumes, so it is the
+    # highest id sent rather than that of an event committed late
+    return (
+        f"id: {last_event_id}\n"
+        f"event: {'critical' if event['is_critical'] else 'replenished'}\n"
+        f"data: {json.dumps(event, cls=DjangoJSONEncoder)}\n\n"
+    )
+
+
+@require_GET
+async def critical_stock_stream(request):
+    """
+    Critical stock transitions in the warehouses the user may see, or in
+    ?warehouse= only. Resumes after the Last-Event-ID header (or
+    ?last_event_id=) and otherwise starts with the next event. A resumed
+    stream repeats the events of the lookback window, which clients skip
+    by the id in their data. The stream ends after
+    CRITICAL_STOCK_STREAM_TIMEOUT seconds; EventSource clients reconnect
+    and resume by themselves
+    """
+    user = await aauthenticate(request)
+    if user is None:
+        return error('Authentication credentials were not provided.', 401)
+
+    events = CriticalStockEvent.objects.order_by('id').values(
+        'id', 'warehouse', 'product', 'quantity', 'minimum_stock', 'is_critical', 'created_at'
+    )
+    if not user.is_staff:
+        events = events.filter(warehouse_id__in=await aget_authorized_warehouse_ids(user))
+    warehouse_id = request.GET.get('warehouse')
+    if warehouse_id:
+        if not warehouse_id.isdigit():
+            return error('warehouse must be an id.', 400)
+        events = events.filter(warehouse_id=warehouse_id)
+
+    last_event_id = request.headers.get('Last-Event-ID') or request.GET.get('last_event_id')
+    sent = {}
+    if last_event_id is None:
+        aggregate = await CriticalStockEvent.objects.aaggregate(last=Max('id'))
+        last_event_id = aggregate['last'] or 0
+        # Events committed before a new stream starts are not sent, even
+        # inside the lookback window
+        sent = {
+            event_id: created_at async for event_id, created_at in events.filter(
+                id__lte=last_event_id, created_at__gte=timezone.now() - lookback()
+            ).values_list('id', 'created_at')
+        }
+    elif not last_event_id.isdigit():
+        return error('Last-Event-ID must be an event id.', 400)
+
+    response = StreamingHttpResponse(
+        stream_events(events, int(last_event_id), sent), content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    # Keep nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+async def stream_events(events, last_event_id, sent=None):
+    """
+    sent maps the ids of events in the lookback window that are not to be
+    sent (again) to their creation time
+    """
+    yield f'retry: {settings.CRITICAL_STOCK_STREAM_RETRY}\n\n'
+    sent = dict(sent or {})
+    now = time.monotonic()
+    deadline = now + settings.CRITICAL_STOCK_STREAM_TIMEOUT
+    next_heartbeat = now + settings.CRITICAL_STOCK_STREAM_HEARTBEAT
+    seen = object()
+    while True:
+        generation = await cache.aget(CRITICAL_STOCK_EVENTS_KEY)
+        if generation != seen:
+            seen = generation
+            since = timezone.now() - lookback()
+            sent = {event_id: created_at for event_id, created_at in sent.items() if created_at >= since}
+            pending = events.filter(Q(id__gt=last_event_id) | Q(created_at__gte=since))
+            after = 0
+            while True:
+                batch = [event async for event in pending.filter(id__gt=after)[:BATCH_SIZE]]
+                for event in batch:
+                    after = event['id']
+                    if event['id'] in sent:
+                        continue
+                    sent[event['id']] = event['created_at']
+                    last_event_id = max(last_event_id, event['id'])
+                    yield format_event(event, last_event_id)
+                if len(batch) < BATCH_SIZE:
+                    break
+
+        now = time.monotonic()
+        if now >= deadline:
+            return
+        if now >= next_heartbeat:
+            # A comment line, so proxies do not close an idle connection
+            yield ': heartbeat\n\n'
+            next_heartbeat = now + settings.CRITICAL_STOCK_STREAM_HEARTBEAT
+        await asyncio.sleep(min(settings.CRITICAL_STOCK_STREAM_POLL_INTERVAL, deadline - now))
@@ -0,0 +1,118 @@
+"""
+Seeded synthetic inventory for benchmarks. The same seed and scale always
+produce the same rows, so timings from different runs are comparable.
+Transactions are history only: they are inserted directly, without moving
+stock or writing the ledger, and spread evenly over the past year
+"""
+import random
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (
+    Warehouse, Customer, Product, WarehouseStock, WarehouseStockSummary, StockTransaction,
+    StockTransactionRollup
+)
+
+SCALES = {
+    'small': {'warehouses': 20, 'products': 2_000, 'transactions': 50_000},
+    'medium': {'warehouses': 200, 'products': 20_000, 'transactions': 1_000_000},
+    'large': {'warehouses': 1_000, 'products': 100_000, 'transactions': 10_000_000},
+}
+
+
+def product_sku(index):
+    return f'SKU-{index:07d}'
+
+
+def generate_dataset(warehouses, products, transactions, stocks_per_product=5,
+                     customers=100, seed=1, batch_size=10_000, history_days=365, log=None):
+    """
+    Create the users, warehouses, customers, products, stock rows and
+    transaction history. Needs at least two warehouses for transfers.
+    Returns the ids that benchmark scenarios pick from
+    """
+    rng = random.Random(seed)
+    log = log or (lambda message: None)
+    stocks_per_product = min(stocks_per_product, warehouses)
+
+    with transaction.atomic():
+        admin_user = User.objects.create_superuser('benchmark-admin', 'benchmark@example.com', None)
+        user = User.objects.create_user('benchmark-user')
+        warehouse_ids = [warehouse.id for warehouse in Warehouse.objects.bulk_create([
+            Warehouse(name=f'Warehouse {index:04d}', location=f'Region {index % 10}')
+            for index in range(warehouses)
+        ])]
+        user.authorized_warehouses.set(warehouse_ids[:10])
+        customer_ids = [customer.id for customer in Customer.objects.bulk_create([
+            Customer(
+                name=f'Customer {index:03d}', address='Synthetic', contact_person='Synthetic',
+                phone='000', email=f'customer{index}@example.com',
+                customer_type='BUSINESS' if index % 2 else 'INDIVIDUAL'
+            )
+            for index in range(customers)
+        ])]
+    log(f'{warehouses} warehouses, {customers} customers')
+
+    product_ids = []
+    for start in range(0, products, batch_size):
+        with transaction.atomic():
+            created = Product.objects.bulk_create([
+                Product(
+                    name=f'Product {index:07d}', description='', sku=product_sku(index),
+                    minimum_stock=rng.randint(5, 20)
+                )
+                for index in range(start, min(start + batch_size, products))
+            ])
+            product_ids.extend(product.id for product in created)
+            WarehouseStock.objects.bulk_create([
+                WarehouseStock(
+                    warehouse_id=warehouse_id, product_id=product.id, quantity=rng.randint(0, 500),
+                    minimum_stock=product.minimum_stock
+                )
+                for product in created
+                for warehouse_id in rng.sample(warehouse_ids, stocks_per_product)
+            ])
+    WarehouseStockSummary.objects.rebuild()
+    log(f'{products} products, {products * stocks_per_product} stock rows')
+
+    performers = [admin_user.id, user.id]
+    now = timezone.now()
+    batches = -(-transactions // batch_size)
+    for batch in range(batches):
+        count = min(batch_size, transactions - batch * batch_size)
+        rows = []
+        for _ in range(count):
+            source, destination, customer = None, None, None
+            kind = rng.choices(('CW', 'WC', 'WW'), weights=(4, 4, 2))[0]
+            if kind == 'CW':
+                destination, customer = rng.choice(warehouse_ids), rng.choice(customer_ids)
+            elif kind == 'WC':
+                source, customer = rng.choice(warehouse_ids), rng.choice(customer_ids)
+            else:
+                source, destination = rng.sample(warehouse_ids, 2)
+            rows.append(StockTransaction(
+                source_warehouse_id=source, destination_warehouse_id=destination, customer_id=customer,
+                product_id=rng.choice(product_ids), quantity=rng.randint(1, 50), transaction_type=kind,
+                transfer_type='TRUCK' if kind == 'WW' else None, performed_by_id=rng.choice(performers)
+            ))
+        with transaction.atomic():
+            created = StockTransaction.objects.bulk_create(rows)
+            # auto_now_add always stamps the insert time; move the batch into the past
+            StockTransaction.objects.filter(
+                pk__range=(created[0].pk, created[-1].pk)
+            ).update(created_at=now - timedelta(days=history_days) * (1 - batch / batches))
+        if batch % 10 == 9 or batch == batches - 1:
+            log(f'{batch * batch_size + count} transactions')
+    # bulk_create bypasses the rollups, so they are built once the history is backdated
+    log(f'{StockTransactionRollup.objects.rebuild()} transaction rollups')
+
+    return {
+        'admin_user': admin_user.id,
+        'user': user.id,
+        'warehouses': warehouse_ids,
+        'customers': customer_ids,
+        'products': product_ids,
+    }
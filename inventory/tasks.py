@@ -1,48 +1,372 @@
+import csv
+import gzip
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+import zipfile
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
 
 from celery import shared_task
-from django.core.mail import send_mail
+from django.core.cache import cache
+from django.core.mail import send_mail, send_mass_mail
 from django.template.loader import render_to_string
 from django.utils import timezone
+from django.utils.text import slugify
 from django.contrib.auth.models import User
-from weasyprint import HTML
+from django.db import transaction
+from django.db.models import Q, F, Sum
+from django.db.models.functions import Coalesce
 from django.conf import settings
-from .models import WarehouseStock, Warehouse
+from .models import (
+    WarehouseStock, Warehouse, CriticalStockAlert, WarehouseStockSummary, StockCheckpoint,
+    StockTransactionRollup, CriticalStockEvent, StockReservation, floor_time
+)
+from .archive import archive_closed_months, create_partitions
+from .routers import replica_reads
 from django.core.mail import EmailMessage
 
+logger = logging.getLogger(__name__)
+
+
+def alert_recipients_cache_key(warehouse_id):
+    return f'critical_stock_recipients_{warehouse_id}'
+
+
+def get_alert_recipients(warehouse_id):
+    """Emails of admin users and the warehouse's authorized users, cached per warehouse"""
+    cache_key = alert_recipients_cache_key(warehouse_id)
+    recipients = cache.get(cache_key)
+    if recipients is None:
+        recipients = sorted(set(
+            User.objects.filter(
+                Q(is_staff=True) | Q(authorized_warehouses=warehouse_id)
+            ).exclude(email='').values_list('email', flat=True)
+        ))
+        cache.set(cache_key, recipients, timeout=settings.CRITICAL_STOCK_RECIPIENTS_CACHE_TIMEOUT)
+    return recipients
+
+
+def format_critical_stock_alert(warehouse, product, quantity):
+    return f"""
+Critical Stock Alert!
+
+Warehouse: {warehouse.name}
+Product: {product.name}
+Current Stock: {quantity}
+Minimum Stock Level: {product.minimum_stock}
+Time: {timezone.now().strftime('%Y-%m-%d %H:%M:%S')}
+
+This is an automated notification. Please take necessary action to replenish the stock.
+"""
+
 
 @shared_task
+def send_critical_stock_alert(warehouse_id, product_id):
+    """
+    Alert about a critical stock level, at most once per warehouse and
+    product within CRITICAL_STOCK_ALERT_WINDOW seconds. In digest mode the
+    alert is stored for send_critical_stock_digest instead of mailed
+    """
+    dedupe_key = f'critical_stock_alert_{warehouse_id}_{product_id}'
+    if not cache.add(dedupe_key, True, timeout=settings.CRITICAL_STOCK_ALERT_WINDOW):
+        return "Critical Stock Alert Suppressed"
+
+    stock = WarehouseStock.objects.select_related('warehouse', 'product').filter(
+        warehouse_id=warehouse_id,
+        product_id=product_id
+    ).first()
+    if stock is None or not stock.is_critical:
+        # Replenished since the alert was queued
+        cache.delete(dedupe_key)
+        return "Stock No Longer Critical"
+
+    if settings.CRITICAL_STOCK_ALERT_DIGEST:
+        CriticalStockAlert.objects.create(
+            warehouse_id=warehouse_id,
+            product_id=product_id,
+            quantity=stock.quantity
+        )
+        return "Critical Stock Alert Queued"
+
+    send_mail(
+        subject=f'Critical Stock Alert - {stock.warehouse.name} - {stock.product.name}',
+        message=format_critical_stock_alert(stock.warehouse, stock.product, stock.quantity),
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        recipient_list=get_alert_recipients(warehouse_id),
+    )
+    return "Critical Stock Alert Sent"
+
+
+@shared_task
+def send_critical_stock_digest():
+    """
+    Send all pending critical stock alerts as one email per recipient. The
+    alerts are marked sent in the same transaction once the mail went out,
+    so a failed send leaves them pending for the next run
+    """
+    with transaction.atomic():
+        # A digest running alongside skips the alerts this one sends
+        alerts = list(CriticalStockAlert.objects.filter(sent_at__isnull=True).select_related(
+            'warehouse', 'product'
+        ).select_for_update(skip_locked=True, of=('self',)).order_by('created_at'))
+        if not alerts:
+            return "No Pending Alerts"
+        send_mass_mail(build_digest_messages(alerts))
+        CriticalStockAlert.objects.filter(id__in=[alert.id for alert in alerts]).update(sent_at=timezone.now())
+
+    return "Critical Stock Digest Sent"
+
+
+def build_digest_messages(alerts):
+    """One digest message per recipient of the alerts"""
+    # Keep only the latest alert per warehouse and product
+    latest = {(alert.warehouse_id, alert.product_id): alert for alert in alerts}
+
+    alerts_by_recipient = defaultdict(list)
+    for alert in latest.values():
+        for email in get_alert_recipients(alert.warehouse_id):
+            alerts_by_recipient[email].append(alert)
+
+    messages = []
+    for email, recipient_alerts in alerts_by_recipient.items():
+        body = "\n".join(
+            format_critical_stock_alert(alert.warehouse, alert.product, alert.quantity)
+            for alert in recipient_alerts
+        )
+        messages.append((
+            f'Critical Stock Digest - {len(recipient_alerts)} item(s) at critical level',
+            body,
+            settings.DEFAULT_FROM_EMAIL,
+            [email],
+        ))
+    return messages
+
+
+def get_stock_report_summary():
+    """Report totals read from the per-warehouse stock summaries"""
+    return WarehouseStockSummary.objects.aggregate(
+        total_count=Coalesce(Sum('total_skus'), 0),
+        critical_count=Coalesce(Sum('critical_skus'), 0)
+    )
+
+
+def iter_stock_report_rows(chunk_size=2000):
+    """Stream report rows ordered by warehouse without loading model instances"""
+    return WarehouseStock.objects.order_by('warehouse_id', 'product_id').values(
+        'warehouse_id',
+        'quantity',
+        'minimum_stock',
+        warehouse_name=F('warehouse__name'),
+        product_name=F('product__name'),
+        critical=F('is_critical'),
+    ).iterator(chunk_size=chunk_size)
+
+
+def render_stock_report_sections(rows):
+    """Render each warehouse's rows into its own HTML section"""
+    for warehouse_id, warehouse_rows in groupby(rows, key=itemgetter('warehouse_id')):
+        warehouse_rows = list(warehouse_rows)
+        warehouse_name = warehouse_rows[0]['warehouse_name']
+        yield warehouse_id, warehouse_name, render_to_string('stock_status_report_section.html', {
+            'warehouse_name': warehouse_name,
+            'stocks': warehouse_rows,
+        })
+
+
+def iter_stock_report_documents(summary, timestamp):
+    """Yield (filename, html) for the summary page and every warehouse"""
+    context = {'timestamp': timestamp, **summary}
+    yield 'stock_status_report_summary.pdf', render_to_string(
+        'stock_status_report.html', {'include_summary': True, 'sections': [], **context}
+    )
+    for warehouse_id, warehouse_name, section in render_stock_report_sections(iter_stock_report_rows()):
+        yield f'stock_status_report_{warehouse_id}_{slugify(warehouse_name)}.pdf', render_to_string(
+            'stock_status_report.html', {'include_summary': False, 'sections': [section], **context}
+        )
+
+
+def render_pdf(html):
+    """Render one HTML document to PDF bytes; runs in a worker process"""
+    # Imported here so web processes that queue alerts do not load WeasyPrint
+    from weasyprint import HTML
+
+    return HTML(string=html).write_pdf()
+
+
+def render_pdfs(documents, workers):
+    """
+    Render (filename, html) pairs to (filename, pdf) in input order. With
+    more than one worker the CPU bound rendering runs in a process pool,
+    keeping at most two documents per worker in flight. Daemonic processes,
+    such as the children of a prefork Celery worker, cannot start the pool
+    and render serially
+    """
+    if workers > 1 and multiprocessing.current_process().daemon:
+        logger.warning(
+            'Rendering stock report PDFs serially: daemonic processes cannot start '
+            'the %s worker pool. Run the report on a --pool=solo or --pool=threads worker',
+            workers
+        )
+        workers = 1
+    if workers <= 1:
+        for filename, html in documents:
+            yield filename, render_pdf(html)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for filename, html in documents:
+            pending.append((filename, executor.submit(render_pdf, html)))
+            if len(pending) >= workers * 2:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+        while pending:
+            filename, future = pending.popleft()
+            yield filename, future.result()
+
+
+def write_stock_report_archive(fileobj, summary, timestamp, workers=None):
+    """Write the summary and per-warehouse PDFs into a zip archive"""
+    workers = workers or settings.STOCK_REPORT_PDF_WORKERS or os.cpu_count()
+    with zipfile.ZipFile(fileobj, mode='w', compression=zipfile.ZIP_STORED) as archive:
+        for filename, pdf in render_pdfs(iter_stock_report_documents(summary, timestamp), workers):
+            archive.writestr(filename, pdf)
+
+
+def write_stock_report_csv(fileobj, rows):
+    """Write rows as gzip compressed CSV, holding one row in memory at a time"""
+    with gzip.GzipFile(fileobj=fileobj, mode='wb') as compressed:
+        text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(['Warehouse', 'Product', 'Current Stock', 'Minimum Stock', 'Status'])
+        for row in rows:
+            writer.writerow([
+                row['warehouse_name'],
+                row['product_name'],
+                row['quantity'],
+                row['minimum_stock'],
+                'CRITICAL' if row['critical'] else 'OK',
+            ])
+        text.flush()
+        text.detach()
+
+
+def attach_stock_report(email, report_file, filename, mimetype):
+    """
+    Attach the written report unless it is larger than
+    STOCK_REPORT_MAX_ATTACHMENT_SIZE. Email attachments are encoded in
+    memory, so the setting also bounds the memory sending takes
+    """
+    size = report_file.tell()
+    if size > settings.STOCK_REPORT_MAX_ATTACHMENT_SIZE:
+        logger.warning(
+            'Stock report %s is %s bytes, over STOCK_REPORT_MAX_ATTACHMENT_SIZE; sent without it',
+            filename, size
+        )
+        email.body += (
+            f"\n\nThe report ({size} bytes) is larger than the attachment limit of "
+            f"{settings.STOCK_REPORT_MAX_ATTACHMENT_SIZE} bytes and was not attached."
+        )
+        return
+    report_file.seek(0)
+    email.attach(filename, report_file.read(), mimetype)
+
+
+@shared_task
+def create_stock_checkpoint():
+    """
+    Checkpoint stock balances for point-in-time queries. The checkpoint
+    lags behind by STOCK_CHECKPOINT_LAG so transactions still in flight at
+    that moment have committed their ledger entries. Checkpoints older than
+    STOCK_CHECKPOINT_HOURLY_DAYS are thinned out to one a day
+    """
+    moment = timezone.now() - timedelta(seconds=settings.STOCK_CHECKPOINT_LAG)
+    created = StockCheckpoint.objects.create_checkpoint(moment)
+    before = moment - timedelta(days=settings.STOCK_CHECKPOINT_HOURLY_DAYS)
+    # Earlier days were thinned by earlier runs; a week covers missed ones
+    StockCheckpoint.objects.prune(before, since=before - timedelta(days=7))
+    return created
+
+
+@shared_task
+def rebuild_transaction_rollups(days=1):
+    """
+    Recompute the transaction rollups of the last days complete UTC days,
+    correcting any drift from transactions inserted around the rollups
+    """
+    end = floor_time(timezone.now(), StockTransactionRollup.DAY)
+    return StockTransactionRollup.objects.rebuild(end - timedelta(days=days), end)
+
+
+@shared_task
+def archive_stock_transactions():
+    """
+    Create the coming monthly transaction partitions and archive the closed
+    months older than TRANSACTION_ARCHIVE_AFTER_MONTHS. Returns the number
+    of transactions archived
+    """
+    create_partitions()
+    return sum(archive.rows for archive in archive_closed_months())
+
+
+@shared_task
+def expire_stock_reservations():
+    """Return the units of expired stock reservations to the available stock"""
+    return StockReservation.objects.expire()
+
+
+@shared_task
+def prune_critical_stock_events():
+    """
+    Delete critical stock events older than CRITICAL_STOCK_EVENT_RETENTION_DAYS;
+    streams resuming from before then start at the oldest event kept
+    """
+    cutoff = timezone.now() - timedelta(days=settings.CRITICAL_STOCK_EVENT_RETENTION_DAYS)
+    deleted, _ = CriticalStockEvent.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
+
+
+@shared_task
+@replica_reads()
 def send_stock_status_report():
     """
-    Generate and send daily stock report
-    """
-    # Get all stocks
-    stocks = WarehouseStock.objects.select_related('product', 'warehouse').all()
-    
-    # Prepare report data
-    report_data = {
-        'stocks': stocks,
-        'timestamp': timezone.now(),
-        'critical_count': sum(1 for stock in stocks 
-                            if stock.quantity <= stock.product.minimum_stock),
-        'total_count': len(stocks)
-    }
-    
-    # Generate HTML report
-    html_content = render_to_string('stock_status_report.html', report_data)
-    
-    # Convert to PDF
-    pdf_file = HTML(string=html_content).write_pdf()
-    
+    Generate and send daily stock report as a zip of per-warehouse PDFs.
+    Inventories larger than STOCK_REPORT_PDF_MAX_ROWS are sent as
+    compressed CSV instead
+    """
+    summary = get_stock_report_summary()
+    timestamp = timezone.now()
+    as_csv = summary['total_count'] > settings.STOCK_REPORT_PDF_MAX_ROWS
+
+    body = "Please find attached the daily stock status report."
+    if as_csv:
+        body += (
+            f"\n\nTotal Products in Stock: {summary['total_count']}"
+            f"\nProducts at Critical Level: {summary['critical_count']}"
+        )
+
     # Send to admin users
     admin_emails = User.objects.filter(is_superuser=True).values_list('email', flat=True)
     email = EmailMessage(
-        subject=f'Daily Stock Report - {timezone.now().strftime("%Y-%m-%d")}',
-        body="Please find attached the daily stock status report.",
+        subject=f'Daily Stock Report - {timestamp.strftime("%Y-%m-%d")}',
+        body=body,
         from_email=settings.EMAIL_HOST_USER,
         to=list(admin_emails),
     )
-    
-    email.attach('stock_status_report.pdf', pdf_file, 'application/pdf')
-    email.send()
+
+    with tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024) as report_file:
+        if as_csv:
+            write_stock_report_csv(report_file, iter_stock_report_rows())
+            attach_stock_report(email, report_file, 'stock_status_report.csv.gz', 'application/gzip')
+        else:
+            write_stock_report_archive(report_file, summary, timestamp)
+            attach_stock_report(email, report_file, 'stock_status_report.zip', 'application/zip')
+        email.send()
 
     return "Stock Status Report Sent"
@@ -1,11 +1,60 @@
-from django.test import TestCase
+import base64
+import csv
+import gzip
+import io
+import json
+import tempfile
+import zipfile
+from collections import Counter
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from asgiref.sync import sync_to_async
+from unittest import skipUnless
+from django.test import Client, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django.db import connection, connections, transaction
+from django.db.models import Count, F, Sum
+from django.test.utils import CaptureQueriesContext
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from inventory.models import Warehouse, Product, WarehouseStock, Customer, StockTransaction
-from rest_framework.test import APITestCase
+from inventory.models import (
+    Warehouse, Product, WarehouseStock, Customer, StockTransaction, CriticalStockAlert,
+    WarehouseStockSummary, StockLedgerEntry, StockCheckpoint, StockTransactionRollup,
+    CriticalStockEvent, StockReservation, floor_time, month_start, add_months
+)
+from inventory.tasks import (
+    send_critical_stock_alert, send_critical_stock_digest, send_stock_status_report,
+    get_stock_report_summary, iter_stock_report_rows, render_stock_report_sections,
+    iter_stock_report_documents, render_pdfs, expire_stock_reservations
+)
+from inventory.caching import CRITICAL_STOCK_EVENTS_KEY
+from inventory.admin import EstimatedCountPaginator
+from inventory.archive import (
+    archive_closed_months, archive_month, iter_archived_rows, create_partition, create_partitions,
+    default_partition_name, is_partitioned, partition_name
+)
+from inventory.permissions import HasWarehouseAccess, authorized_warehouses_cache_key, get_authorized_warehouse_ids
+from inventory.lookups import product_ids
+from inventory.metrics import registry
+from inventory.routers import replica_reads
+from inventory.synthetic import generate_dataset
+from inventory.views import WarehouseStockViewSet
+from inventory.serializers import StockTransactionSerializer, StockTransactionRowSerializer
+from warehouse_inventory.celery import health_check
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+try:
+    import weasyprint  # noqa: F401
+    HAS_WEASYPRINT = True
+except (ImportError, OSError):
+    HAS_WEASYPRINT = False
+from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.urls import reverse
 from django.core import mail
+from django.core.management import call_command, CommandError
 from django.test import override_settings
 from rest_framework_simplejwt.tokens import RefreshToken
 @override_settings(
@@ -24,6 +73,7 @@ class WarehouseTests(APITestCase):
 
 class StockTransactionAPITests(APITestCase):
     def setUp(self):
+        cache.clear()
         # Create users
         self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
         self.regular_user = User.objects.create_user('user', 'user@test.com', 'userpass')
@@ -67,3 +117,2018 @@ class StockTransactionAPITests(APITestCase):
                transfer_type='TRUCK',
                performed_by=self.admin_user
            )
+
+
+class StockLedgerTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001', minimum_stock=10)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+
+    def test_transfer_moves_stock(self):
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_a,
+            destination_warehouse=self.warehouse_b,
+            product=self.product,
+            quantity=30,
+            transaction_type='WW',
+            transfer_type='TRUCK',
+            performed_by=self.user
+        )
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_a).quantity, 70)
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_b).quantity, 30)
+
+    def test_transfer_query_count(self):
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=0)
+        # Savepoint, source and destination stock/summary updates, insert,
+        # rollup upsert, ledger entries, release
+        with self.assertNumQueries(9):
+            StockTransaction.objects.create(
+                source_warehouse=self.warehouse_a,
+                destination_warehouse=self.warehouse_b,
+                product=self.product,
+                quantity=5,
+                transaction_type='WW',
+                transfer_type='TRUCK',
+                performed_by=self.user
+            )
+
+    def test_failed_withdrawal_leaves_no_transaction(self):
+        with self.assertRaises(ValidationError):
+            StockTransaction.objects.create(
+                source_warehouse=self.warehouse_b,
+                destination_warehouse=self.warehouse_a,
+                product=self.product,
+                quantity=1,
+                transaction_type='WW',
+                performed_by=self.user
+            )
+        self.assertFalse(StockTransaction.objects.exists())
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_a).quantity, 100)
+
+
+class BulkTransactionAPITests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', 'user@test.com', 'userpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_c = Warehouse.objects.create(name='Warehouse C', location='Location C')
+        self.warehouse_a.authorized_users.add(self.user)
+        self.warehouse_b.authorized_users.add(self.user)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+        token = str(RefreshToken.for_user(self.user).access_token)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        self.url = '/api/stock-transactions/bulk_create/'
+
+    def _row(self, **overrides):
+        row = {
+            'source_warehouse': self.warehouse_a.id,
+            'destination_warehouse': self.warehouse_b.id,
+            'product': self.product.id,
+            'quantity': 10,
+            'transaction_type': 'WW',
+            'transfer_type': 'TRUCK',
+        }
+        row.update(overrides)
+        return row
+
+    def test_bulk_create_applies_net_deltas(self):
+        rows = [self._row() for _ in range(5)] + [
+            self._row(source_warehouse=None, destination_warehouse=self.warehouse_a.id,
+                      customer=self.customer.id, transaction_type='CW', quantity=7)
+        ]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 6)
+        self.assertEqual(StockTransaction.objects.count(), 6)
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_a).quantity, 57)
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_b).quantity, 50)
+
+    def test_bulk_create_accepts_ndjson(self):
+        body = '\n'.join(json.dumps(self._row()) for _ in range(3))
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_b).quantity, 30)
+
+    def test_bulk_create_reports_row_errors(self):
+        rows = [self._row(), self._row(destination_warehouse=self.warehouse_c.id), self._row(quantity=-1)]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([error['row'] for error in response.data['errors']], [1, 2])
+        self.assertFalse(StockTransaction.objects.exists())
+
+    def test_bulk_create_rejects_overdraw_atomically(self):
+        rows = [self._row(quantity=60), self._row(quantity=60)]
+        response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual([error['row'] for error in response.data['errors']], [0, 1])
+        self.assertFalse(StockTransaction.objects.exists())
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_a).quantity, 100)
+        self.assertFalse(WarehouseStock.objects.filter(warehouse=self.warehouse_b, quantity__gt=0).exists())
+
+    def test_bulk_create_updates_stock_in_key_order(self):
+        rows = [
+            self._row(source_warehouse=None, destination_warehouse=warehouse.id,
+                      customer=self.customer.id, transaction_type='CW')
+            for warehouse in (self.warehouse_b, self.warehouse_a)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, rows, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        update = next(
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith(f'UPDATE "{WarehouseStock._meta.db_table}"')
+        )
+        positions = [
+            update.index(f'({warehouse.id}, {self.product.id}, 10)')
+            for warehouse in (self.warehouse_a, self.warehouse_b)
+        ]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(
+            list(StockLedgerEntry.objects.filter(transaction__isnull=False).order_by('warehouse_id').values_list(
+                'warehouse_id', 'transaction__quantity'
+            )),
+            [(self.warehouse_a.id, 10), (self.warehouse_b.id, 10)]
+        )
+
+
+class CriticalStockAlertTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.regular_user = User.objects.create_user('user', 'user@test.com', 'userpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_a.authorized_users.add(self.regular_user)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001', minimum_stock=10)
+        self.other_product = Product.objects.create(name='Other Product', sku='TEST-002', minimum_stock=10)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=5)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.other_product, quantity=5)
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=5)
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_transaction_queues_alert_without_sending_mail(self, mock_alert):
+        token = str(RefreshToken.for_user(self.regular_user).access_token)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/stock-transactions/', {
+                'source_warehouse': self.warehouse_a.id,
+                'customer': self.customer.id,
+                'product': self.product.id,
+                'quantity': 1,
+                'transaction_type': 'WC',
+            }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        mock_alert.assert_called_once_with(self.warehouse_a.id, self.product.id)
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_alerts_are_deduplicated_per_warehouse_and_product(self):
+        send_critical_stock_alert(self.warehouse_a.id, self.product.id)
+        send_critical_stock_alert(self.warehouse_a.id, self.product.id)
+        send_critical_stock_alert(self.warehouse_b.id, self.product.id)
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(sorted(mail.outbox[0].to), ['admin@test.com', 'user@test.com'])
+        self.assertEqual(mail.outbox[1].to, ['admin@test.com'])
+
+    def test_recipients_follow_authorized_user_changes(self):
+        send_critical_stock_alert(self.warehouse_b.id, self.product.id)
+        cache.delete(f'critical_stock_alert_{self.warehouse_b.id}_{self.product.id}')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.warehouse_b.authorized_users.add(self.regular_user)
+        send_critical_stock_alert(self.warehouse_b.id, self.product.id)
+        self.assertEqual(sorted(mail.outbox[1].to), ['admin@test.com', 'user@test.com'])
+
+    @override_settings(CRITICAL_STOCK_ALERT_DIGEST=True)
+    def test_digest_sends_one_mail_per_recipient(self):
+        send_critical_stock_alert(self.warehouse_a.id, self.product.id)
+        send_critical_stock_alert(self.warehouse_a.id, self.other_product.id)
+        send_critical_stock_alert(self.warehouse_b.id, self.product.id)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(CriticalStockAlert.objects.count(), 3)
+
+        send_critical_stock_digest()
+        recipients = {message.to[0]: message for message in mail.outbox}
+        self.assertEqual(sorted(recipients), ['admin@test.com', 'user@test.com'])
+        self.assertIn('3 item(s)', recipients['admin@test.com'].subject)
+        self.assertIn('2 item(s)', recipients['user@test.com'].subject)
+        self.assertFalse(CriticalStockAlert.objects.filter(sent_at__isnull=True).exists())
+
+    @override_settings(CRITICAL_STOCK_ALERT_DIGEST=True)
+    def test_digest_keeps_alerts_pending_when_mail_fails(self):
+        send_critical_stock_alert(self.warehouse_a.id, self.product.id)
+        with mock.patch('inventory.tasks.send_mass_mail', side_effect=ConnectionRefusedError):
+            with self.assertRaises(ConnectionRefusedError):
+                send_critical_stock_digest()
+        self.assertTrue(CriticalStockAlert.objects.filter(sent_at__isnull=True).exists())
+
+        send_critical_stock_digest()
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), ['admin@test.com', 'user@test.com'])
+        self.assertFalse(CriticalStockAlert.objects.filter(sent_at__isnull=True).exists())
+
+
+class WarehouseStatsTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001', minimum_stock=10)
+        self.other_product = Product.objects.create(name='Other Product', sku='TEST-002', minimum_stock=10)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.other_product, quantity=5)
+        for _ in range(2):
+            StockTransaction.objects.create(
+                source_warehouse=self.warehouse_a, destination_warehouse=self.warehouse_b,
+                product=self.product, quantity=10, transaction_type='WW', performed_by=self.admin_user
+            )
+        StockTransaction.objects.create(
+            destination_warehouse=self.warehouse_a, customer=self.customer,
+            product=self.product, quantity=1, transaction_type='CW', performed_by=self.admin_user
+        )
+        token = str(RefreshToken.for_user(self.admin_user).access_token)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_stats_values(self):
+        response = self.client.get('/api/stock-transactions/')
+        self.assertEqual(response.data['warehouse_stats'], {
+            'Warehouse A': {'id': self.warehouse_a.id, 'Entry': 1, 'Exit': 2, 'products': 2, 'low_stock_items': 1},
+            'Warehouse B': {'id': self.warehouse_b.id, 'Entry': 2, 'Exit': 0, 'products': 1, 'low_stock_items': 0},
+        })
+
+    def test_stats_query_count_does_not_grow_with_warehouses(self):
+        with CaptureQueriesContext(connection) as few:
+            self.client.get('/api/stock-transactions/?transaction_type=WW')
+        cache.clear()
+        for index in range(20):
+            Warehouse.objects.create(name=f'Extra {index}', location='Location')
+        with CaptureQueriesContext(connection) as many:
+            self.client.get('/api/stock-transactions/?transaction_type=WW')
+        self.assertEqual(len(few), len(many))
+
+    def test_stats_cache_is_keyed_by_filters(self):
+        response = self.client.get('/api/stock-transactions/?transaction_type=WW')
+        self.assertEqual(response.data['warehouse_stats']['Warehouse A']['Entry'], 0)
+        response = self.client.get('/api/stock-transactions/?transaction_type=CW')
+        self.assertEqual(response.data['warehouse_stats']['Warehouse A']['Entry'], 1)
+        self.assertEqual(response.data['warehouse_stats']['Warehouse A']['Exit'], 0)
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_stats_are_fresh_right_after_a_write(self, mock_alert):
+        self.client.get('/api/stock-transactions/')
+        with self.captureOnCommitCallbacks(execute=True):
+            StockTransaction.objects.create(
+                source_warehouse=self.warehouse_a, customer=self.customer,
+                product=self.product, quantity=80, transaction_type='WC', performed_by=self.admin_user
+            )
+
+        response = self.client.get('/api/stock-transactions/')
+        self.assertEqual(response.data['warehouse_stats']['Warehouse A'], {
+            'id': self.warehouse_a.id, 'Entry': 1, 'Exit': 3, 'products': 2, 'low_stock_items': 2
+        })
+
+    def test_unchanged_stats_come_from_cache(self):
+        with CaptureQueriesContext(connection) as cold:
+            self.client.get('/api/stock-transactions/')
+        with CaptureQueriesContext(connection) as warm:
+            self.client.get('/api/stock-transactions/')
+        self.assertEqual(len(cold) - len(warm), 2)
+
+
+class WarehouseAccessCacheTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('user', 'user@test.com', 'userpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_a.authorized_users.add(self.user)
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        self.stock = WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=1)
+
+    def fresh_user(self):
+        # A new instance per request, as authentication would load it
+        return User.objects.get(pk=self.user.pk)
+
+    def test_warm_access_check_needs_no_queries(self):
+        get_authorized_warehouse_ids(self.fresh_user())
+        request = mock.Mock(user=self.fresh_user())
+
+        with self.assertNumQueries(0):
+            self.assertFalse(HasWarehouseAccess().has_object_permission(request, None, self.stock))
+            self.assertEqual(get_authorized_warehouse_ids(request.user), {self.warehouse_a.id})
+
+    def test_membership_changes_invalidate_cache(self):
+        self.assertEqual(get_authorized_warehouse_ids(self.fresh_user()), {self.warehouse_a.id})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.warehouse_b.authorized_users.add(self.user)
+        self.assertEqual(
+            get_authorized_warehouse_ids(self.fresh_user()), {self.warehouse_a.id, self.warehouse_b.id}
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.authorized_warehouses.remove(self.warehouse_a)
+        self.assertEqual(get_authorized_warehouse_ids(self.fresh_user()), {self.warehouse_b.id})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.warehouse_b.authorized_users.clear()
+        self.assertEqual(get_authorized_warehouse_ids(self.fresh_user()), set())
+
+    def test_revoked_access_is_not_cached_again_before_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.warehouse_a.authorized_users.remove(self.user)
+                # A request served before the commit still reads the old membership
+                cache.set(authorized_warehouses_cache_key(self.user.pk), frozenset({self.warehouse_a.id}))
+        self.assertEqual(get_authorized_warehouse_ids(self.fresh_user()), set())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                self.user.authorized_warehouses.add(self.warehouse_b)
+                cache.set(authorized_warehouses_cache_key(self.user.pk), frozenset())
+                self.warehouse_b.delete()
+                cache.set(authorized_warehouses_cache_key(self.user.pk), frozenset({self.warehouse_b.id}))
+        self.assertEqual(get_authorized_warehouse_ids(self.fresh_user()), set())
+
+    def test_stock_listing_respects_cached_access(self):
+        url = reverse('warehousestock-detail', args=[self.stock.id])
+        self.client.force_authenticate(self.fresh_user())
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.warehouse_b.authorized_users.add(self.user)
+        self.client.force_authenticate(self.fresh_user())
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+
+
+class HealthCheckTests(APITestCase):
+    def test_healthy_services(self):
+        response = self.client.get(reverse('health'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['status'], 'ok')
+        self.assertIn('database:default', response.data['checks'])
+        self.assertIn('cache', response.data['checks'])
+
+    @mock.patch('inventory.health.check_cache', side_effect=ConnectionError('refused'))
+    def test_failing_service_returns_503(self, mock_check):
+        response = self.client.get(reverse('health'))
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response.data['checks']['cache'], 'error: refused')
+
+    def test_worker_health_check_task(self):
+        checks = health_check.apply().get()
+        self.assertIn('database:default', checks)
+
+        with mock.patch('inventory.health.check_database', side_effect=ConnectionError('gone')):
+            with self.assertRaises(RuntimeError):
+                health_check.apply().get()
+
+
+class QueryBudgetMixin:
+    def assertWithinQueryBudget(self, response, endpoint):
+        budget = settings.QUERY_BUDGETS[endpoint]
+        self.assertLessEqual(
+            response.metrics.queries, budget,
+            f'{endpoint} ran {response.metrics.queries} queries, over its budget of {budget}'
+        )
+
+
+class RequestMetricsTests(QueryBudgetMixin, APITestCase):
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+        self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.user = User.objects.create_user('user', 'user@test.com', 'userpass')
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        token = RefreshToken.for_user(self.user).access_token
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def add_warehouses(self, count):
+        for index in range(count):
+            warehouse = Warehouse.objects.create(name=f'Warehouse {index}', location='Location')
+            warehouse.authorized_users.add(self.user)
+            StockTransaction.objects.create(
+                destination_warehouse=warehouse, customer=self.customer, product=self.product,
+                quantity=5, transaction_type='CW', performed_by=self.admin_user
+            )
+
+    def test_transaction_list_budget_does_not_grow_with_warehouses(self):
+        self.add_warehouses(1)
+        response = self.client.get('/api/stock-transactions/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertWithinQueryBudget(response, 'StockTransactionViewSet.list')
+        one_warehouse = response.metrics.queries
+
+        self.add_warehouses(10)
+        cache.clear()
+        response = self.client.get('/api/stock-transactions/')
+        self.assertEqual(len(response.data['results']), 11)
+        self.assertWithinQueryBudget(response, 'StockTransactionViewSet.list')
+        self.assertEqual(response.metrics.queries, one_warehouse)
+
+    def test_server_timing_header(self):
+        self.add_warehouses(1)
+        response = self.client.get('/api/stock-transactions/')
+        self.assertRegex(
+            response['Server-Timing'],
+            rf'^db;dur=[0-9.]+;desc="{response.metrics.queries} queries", '
+            r'serialize;dur=[0-9.]+, total;dur=[0-9.]+$'
+        )
+        self.assertGreater(response.metrics.serialize_time, 0)
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_prometheus_metrics(self):
+        self.client.get('/api/stock-transactions/')
+        self.client.get('/api/stock-transactions/')
+        response = Client().get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer scrape-token')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn(
+            'inventory_requests_total{view="StockTransactionViewSet",action="list",'
+            'method="GET",status="200"} 2', body
+        )
+        self.assertIn(
+            'inventory_request_duration_seconds_count'
+            '{view="StockTransactionViewSet",action="list"} 2', body
+        )
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_metrics_require_the_token_or_staff(self):
+        url = reverse('metrics')
+        anonymous = Client()
+        self.assertEqual(anonymous.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(
+            anonymous.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, status.HTTP_401_UNAUTHORIZED
+        )
+        # A user's API token is not the scrape token
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        anonymous.force_login(self.user)
+        self.assertEqual(anonymous.get(url).status_code, status.HTTP_401_UNAUTHORIZED)
+        anonymous.force_login(self.admin_user)
+        self.assertEqual(anonymous.get(url).status_code, status.HTTP_200_OK)
+
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(
+                Client().get(url, HTTP_AUTHORIZATION='Bearer ').status_code, status.HTTP_401_UNAUTHORIZED
+            )
+
+    async def test_async_views_are_measured(self):
+        response = await self.async_client.get(
+            reverse('stock-lookup-sku', args=['W-001']),
+            headers={'Authorization': self.client._credentials['HTTP_AUTHORIZATION']}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertGreater(response.metrics.queries, 0)
+        self.assertWithinQueryBudget(response, 'stock_lookup_by_sku')
+
+
+class AdminChangelistQueryTests(TestCase):
+    changelists = (
+        'admin:inventory_warehouse_changelist',
+        'admin:inventory_warehousestock_changelist',
+        'admin:inventory_stocktransaction_changelist',
+        'admin:auth_user_changelist',
+    )
+
+    def setUp(self):
+        cache.clear()
+        self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.client.force_login(self.admin_user)
+        self.rows = 0
+
+    def add_rows(self, count):
+        for _ in range(count):
+            self.rows += 1
+            user = User.objects.create_user(f'user{self.rows}')
+            warehouse = Warehouse.objects.create(name=f'Warehouse {self.rows}', location='Location')
+            warehouse.authorized_users.add(user, self.admin_user)
+            product = Product.objects.create(name=f'Product {self.rows}', sku=f'P-{self.rows}', minimum_stock=0)
+            StockTransaction.objects.create(
+                destination_warehouse=warehouse, customer=self.customer, product=product,
+                quantity=5, transaction_type='CW', performed_by=user
+            )
+            StockTransaction.objects.create(
+                source_warehouse=warehouse, customer=self.customer, product=product,
+                quantity=1, transaction_type='WC', performed_by=self.admin_user
+            )
+
+    def test_add_view_reports_insufficient_stock(self):
+        warehouse = Warehouse.objects.create(name='Warehouse', location='Location')
+        product = Product.objects.create(name='Product', sku='P-1', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=warehouse, product=product, quantity=3)
+
+        response = self.client.post(reverse('admin:inventory_stocktransaction_add'), {
+            'source_warehouse': warehouse.id, 'customer': self.customer.id, 'product': product.id,
+            'quantity': 5, 'transaction_type': 'WC', 'performed_by': self.admin_user.id, 'notes': ''
+        })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Available: 3, Requested: 5')
+        self.assertFalse(StockTransaction.objects.exists())
+
+    def changelist_queries(self):
+        queries = {}
+        for name in self.changelists:
+            response = self.client.get(reverse(name))
+            self.assertEqual(response.status_code, 200)
+            queries[name] = response.metrics.queries
+        return queries
+
+    def test_changelists_run_a_constant_number_of_queries(self):
+        self.add_rows(2)
+        few = self.changelist_queries()
+        self.add_rows(20)
+        self.assertEqual(self.changelist_queries(), few)
+
+
+class StockTransactionRowSerializerTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_a, destination_warehouse=self.warehouse_b,
+            product=self.product, quantity=10, transaction_type='WW', transfer_type='TRUCK',
+            notes='Restock', performed_by=self.user
+        )
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_b, customer=self.customer,
+            product=self.product, quantity=5, transaction_type='WC', performed_by=self.user
+        )
+
+    def test_rows_match_model_serializer(self):
+        queryset = StockTransaction.objects.order_by('id')
+        request = mock.Mock(user=self.user)
+        expected = StockTransactionSerializer(queryset, many=True, context={'request': request}).data
+        rows = StockTransactionRowSerializer.to_representation(
+            StockTransactionRowSerializer.get_queryset(queryset)
+        )
+        self.assertEqual(json.loads(json.dumps(rows)), json.loads(json.dumps(expected)))
+
+    def test_listing_uses_one_query_for_rows(self):
+        self.client.force_authenticate(self.user)
+        self.client.get('/api/stock-transactions/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/stock-transactions/?page_size=1')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(
+            len([q for q in queries if 'FROM "inventory_stocktransaction"' in q['sql']]), 1
+        )
+        next_page = self.client.get(response.data['next'])
+        self.assertEqual(next_page.data['results'][0]['quantity'], 10)
+
+    def export(self, **params):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/stock-transactions/export/', params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_csv_export(self):
+        response, content = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(content.decode())))
+        self.assertEqual([row['transaction_type'] for row in rows], ['WW', 'WC'])
+        self.assertEqual(rows[0]['notes'], 'Restock')
+        self.assertEqual(rows[0]['customer_name'], '')
+        self.assertEqual(rows[1]['customer_name'], 'Customer')
+
+    def test_gzip_ndjson_export_applies_filters(self):
+        response, content = self.export(file_format='ndjson', gzip='1', transaction_type='WC')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('.ndjson.gz', response['Content-Disposition'])
+        rows = [json.loads(line) for line in gzip.decompress(content).decode().splitlines()]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['customer_name'], 'Customer')
+        self.assertEqual(rows[0]['quantity'], 5)
+
+    async def test_export_streams_asynchronously_under_asgi(self):
+        token = await sync_to_async(lambda: str(RefreshToken.for_user(self.user).access_token))()
+        response = await self.async_client.get(
+            '/api/stock-transactions/export/', {'file_format': 'ndjson'},
+            headers={'Authorization': f'Bearer {token}'}
+        )
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        rows = [json.loads(line) for line in content.decode().splitlines()]
+        self.assertEqual([row['transaction_type'] for row in rows], ['WW', 'WC'])
+
+
+class StockHistoryTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        self.stock = WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+        self.client.force_authenticate(self.user)
+
+    def stock_as_of(self, moment):
+        response = self.client.get('/api/warehouse-stocks/', {'as_of': moment.isoformat()})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return {row['warehouse_name']: row['quantity'] for row in response.data['results']}
+
+    def test_point_in_time_stock(self):
+        before_transfer = timezone.now()
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_a, destination_warehouse=self.warehouse_b,
+            product=self.product, quantity=30, transaction_type='WW', performed_by=self.user
+        )
+        after_transfer = timezone.now()
+        StockCheckpoint.objects.create_checkpoint(after_transfer)
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_b, customer=self.customer,
+            product=self.product, quantity=20, transaction_type='WC', performed_by=self.user
+        )
+        self.stock.quantity = 75
+        self.stock.save()
+        now = timezone.now()
+
+        self.assertEqual(self.stock_as_of(before_transfer), {'Warehouse A': 100})
+        self.assertEqual(self.stock_as_of(after_transfer), {'Warehouse A': 70, 'Warehouse B': 30})
+        self.assertEqual(self.stock_as_of(now), {'Warehouse A': 75, 'Warehouse B': 10})
+        self.assertEqual(
+            StockCheckpoint.objects.filter(taken_at=after_transfer).count(), 2
+        )
+
+    def test_history_reads_entries_after_the_checkpoint_only(self):
+        StockCheckpoint.objects.create_checkpoint(timezone.now())
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_a, customer=self.customer,
+            product=self.product, quantity=10, transaction_type='WC', performed_by=self.user
+        )
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                StockCheckpoint.objects.balances(timezone.now()),
+                {(self.warehouse_a.id, self.product.id): 90}
+            )
+        ledger_sql = next(q['sql'] for q in queries if 'inventory_stockledgerentry' in q['sql'])
+        self.assertIn('"created_at" >', ledger_sql)
+
+    def test_transactions_and_ledger_are_immutable(self):
+        stock_transaction = StockTransaction.objects.create(
+            source_warehouse=self.warehouse_a, customer=self.customer,
+            product=self.product, quantity=10, transaction_type='WC', performed_by=self.user
+        )
+        url = f'/api/stock-transactions/{stock_transaction.id}/'
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        self.assertEqual(self.client.patch(url, {'quantity': 1}).status_code, status.HTTP_405_METHOD_NOT_ALLOWED)
+        with self.assertRaises(ValidationError):
+            stock_transaction.save()
+        with self.assertRaises(TypeError):
+            StockLedgerEntry.objects.filter(transaction=stock_transaction).delete()
+
+        # Removing a warehouse leaves its history in place
+        self.warehouse_a.delete()
+        self.assertEqual(
+            sum(StockLedgerEntry.objects.filter(warehouse_id=stock_transaction.source_warehouse_id)
+                .values_list('delta', flat=True)),
+            0
+        )
+
+    def test_invalid_as_of(self):
+        response = self.client.get('/api/warehouse-stocks/', {'as_of': 'yesterday'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_as_of_stock_is_paginated(self):
+        products = [
+            Product.objects.create(name=f'Product {index}', sku=f'P-{index}', minimum_stock=0)
+            for index in range(5)
+        ]
+        for product in products[:3]:
+            WarehouseStock.objects.create(warehouse=self.warehouse_b, product=product, quantity=5)
+        StockCheckpoint.objects.create_checkpoint(timezone.now())
+        # After the checkpoint: new keys, and one key emptied
+        for product in products[3:]:
+            WarehouseStock.objects.create(warehouse=self.warehouse_a, product=product, quantity=7)
+        WarehouseStock.objects.filter(warehouse=self.warehouse_b, product=products[1]).delete()
+        moment = timezone.now()
+        expected = [
+            (warehouse_id, product_id, quantity)
+            for (warehouse_id, product_id), quantity in sorted(StockCheckpoint.objects.balances(moment).items())
+        ]
+
+        pages = []
+        url = f'/api/warehouse-stocks/?as_of={moment.isoformat().replace("+", "%2B")}&page_size=2'
+        while url:
+            pages.append(self.client.get(url).data)
+            url = pages[-1]['next']
+        rows = [(row['warehouse'], row['product'], row['quantity']) for page in pages for row in page['results']]
+        self.assertEqual(rows, expected)
+        self.assertEqual(len(rows), 5)
+        self.assertTrue(all(len(page['results']) <= 2 for page in pages))
+
+        previous = self.client.get(pages[-1]['previous']).data
+        self.assertEqual(previous['results'], pages[-2]['results'])
+
+    def test_old_checkpoints_are_thinned_to_one_a_day(self):
+        start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=10)
+        moments = [start + timedelta(days=day, hours=hour) for day in range(10) for hour in (1, 2, 3)]
+        for moment in moments:
+            StockCheckpoint.objects.create(
+                warehouse=self.warehouse_a, product=self.product, quantity=100, taken_at=moment
+            )
+
+        StockCheckpoint.objects.prune(start + timedelta(days=8))
+
+        remaining = list(StockCheckpoint.objects.order_by('taken_at').values_list('taken_at', flat=True))
+        self.assertEqual(remaining, [
+            moment for moment in moments
+            if moment >= start + timedelta(days=8) or moment.hour == 1
+        ])
+
+
+class KeysetPaginationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouses = [
+            Warehouse.objects.create(name=f'Warehouse {index}', location='Location')
+            for index in range(3)
+        ]
+        self.products = [
+            Product.objects.create(name=f'Product {index}', sku=f'SKU-{index}')
+            for index in range(4)
+        ]
+        for warehouse in self.warehouses:
+            for product in self.products:
+                WarehouseStock.objects.create(warehouse=warehouse, product=product, quantity=100)
+        StockTransaction.objects.bulk_create([
+            StockTransaction(
+                source_warehouse=self.warehouses[0], destination_warehouse=self.warehouses[1],
+                product=self.products[0], quantity=1, transaction_type='WW', performed_by=self.admin_user
+            )
+            for _ in range(7)
+        ])
+        # Force ties on created_at so the id tie-breaker is exercised
+        StockTransaction.objects.filter(id__in=StockTransaction.objects.order_by('id').values('id')[:4]).update(
+            created_at=timezone.now()
+        )
+        token = str(RefreshToken.for_user(self.admin_user).access_token)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def _walk(self, url):
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            pages.append(response.data)
+            url = response.data['next']
+        return pages
+
+    def test_transaction_pages_cover_every_row_in_order(self):
+        pages = self._walk('/api/stock-transactions/?page_size=3')
+        self.assertEqual([len(page['results']) for page in pages], [3, 3, 1])
+        self.assertIn('warehouse_stats', pages[0])
+        ids = [row['id'] for page in pages for row in page['results']]
+        expected = list(StockTransaction.objects.order_by('-created_at', 'id').values_list('id', flat=True))
+        self.assertEqual(ids, expected)
+
+        previous = self.client.get(pages[-1]['previous']).data
+        self.assertEqual(previous['results'], pages[1]['results'])
+
+    def test_stock_pages_follow_warehouse_and_product(self):
+        pages = self._walk('/api/warehouse-stocks/?page_size=5')
+        keys = [(row['warehouse'], row['product']) for page in pages for row in page['results']]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), 12)
+        self.assertIsNone(pages[0]['previous'])
+
+    def test_deep_pages_run_the_same_queries(self):
+        pages = self._walk('/api/warehouse-stocks/?page_size=2')
+        with CaptureQueriesContext(connection) as first:
+            self.client.get('/api/warehouse-stocks/?page_size=2')
+        with CaptureQueriesContext(connection) as last:
+            self.client.get(pages[-2]['next'])
+        self.assertEqual(len(first), len(last))
+        self.assertNotIn('OFFSET', last.captured_queries[-1]['sql'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/warehouse-stocks/?cursor=garbage')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cursor_values_must_match_the_ordering(self):
+        cursors = [
+            ('/api/stock-transactions/', ['not-a-date', 1]),
+            ('/api/stock-transactions/', ['2024-01-01T00:00:00', 'x']),
+            ('/api/warehouse-stocks/', ['a', 'b']),
+            ('/api/warehouse-stocks/', [None, 1]),
+            ('/api/warehouse-stocks/', [[1], {}]),
+        ]
+        for path, position in cursors:
+            payload = json.dumps({'p': position, 'r': 0}).encode('ascii')
+            cursor = base64.urlsafe_b64encode(payload).decode('ascii')
+            with self.subTest(path=path, position=position):
+                response = self.client.get(path, {'cursor': cursor})
+                self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class WarehouseStockSkuLookupTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        product_ids.clear()
+        self.user = User.objects.create_user('scanner', 'scanner@test.com', 'scannerpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_a.authorized_users.add(self.user)
+        self.widget = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        self.gadget = Product.objects.create(name='Gadget', sku='G-001', minimum_stock=0)
+        for warehouse in (self.warehouse_a, self.warehouse_b):
+            WarehouseStock.objects.create(warehouse=warehouse, product=self.widget, quantity=10)
+            WarehouseStock.objects.create(warehouse=warehouse, product=self.gadget, quantity=20)
+        self.client.force_authenticate(self.user)
+
+    def test_filter_by_sku(self):
+        response = self.client.get('/api/warehouse-stocks/', {'sku': 'G-001'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [(row['warehouse'], row['product']) for row in response.data['results']],
+            [(self.warehouse_a.id, self.gadget.id)]
+        )
+
+        response = self.client.get('/api/warehouse-stocks/', {'sku': 'UNKNOWN'})
+        self.assertEqual(response.data['results'], [])
+
+    def test_batch_lookup(self):
+        response = self.client.post('/api/warehouse-stocks/lookup/', {
+            'skus': ['W-001', 'G-001', 'W-001', 'UNKNOWN']
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['results'], [
+            {'sku': 'W-001', 'product': self.widget.id, 'warehouse': self.warehouse_a.id, 'quantity': 10},
+            {'sku': 'G-001', 'product': self.gadget.id, 'warehouse': self.warehouse_a.id, 'quantity': 20},
+        ])
+        self.assertEqual(response.data['missing'], ['UNKNOWN'])
+
+        # Known SKUs are now cached
+        with self.assertNumQueries(1):
+            response = self.client.post('/api/warehouse-stocks/lookup/', {
+                'skus': ['G-001', 'W-001']
+            }, format='json')
+        self.assertEqual(len(response.data['results']), 2)
+
+        response = self.client.post('/api/warehouse-stocks/lookup/', {
+            'skus': ['W-001'], 'warehouses': [self.warehouse_b.id]
+        }, format='json')
+        self.assertEqual(response.data['results'], [])
+
+    def test_batch_lookup_limit(self):
+        response = self.client.post('/api/warehouse-stocks/lookup/', {
+            'skus': [f'SKU-{index}' for index in range(settings.STOCK_LOOKUP_MAX_SKUS + 1)]
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_sku_cache_follows_renames(self):
+        self.assertEqual(product_ids.resolve(['W-001']), {'W-001': self.widget.id})
+        with self.assertNumQueries(0):
+            product_ids.resolve(['W-001'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.widget.sku = 'W-002'
+            self.widget.save()
+
+        self.assertEqual(product_ids.resolve(['W-001', 'W-002']), {'W-002': self.widget.id})
+
+
+class BenchmarkTests(TestCase):
+    def test_generated_dataset(self):
+        dataset = generate_dataset(warehouses=3, products=12, transactions=25, stocks_per_product=2, batch_size=10)
+        self.assertEqual(len(dataset['warehouses']), 3)
+        self.assertEqual(Product.objects.count(), 12)
+        self.assertEqual(WarehouseStock.objects.count(), 24)
+        self.assertEqual(StockTransaction.objects.count(), 25)
+        # Three batches spread over the past year
+        self.assertEqual(StockTransaction.objects.values('created_at').distinct().count(), 3)
+        self.assertEqual(
+            WarehouseStockSummary.objects.aggregate(total=Sum('total_units'))['total'],
+            WarehouseStock.objects.aggregate(total=Sum('quantity'))['total']
+        )
+
+    def test_regressions_fail_the_benchmark(self):
+        from inventory.management.commands.benchmark import Command
+
+        baseline = {
+            'database': 'sqlite', 'scale': {'warehouses': 2}, 'seed': 1,
+            'scenarios': {'transaction_list': {'median_ms': 10.0, 'p95_ms': 12.0, 'queries': 4}},
+        }
+        command = Command(stdout=io.StringIO())
+        command.compare(baseline, baseline, tolerance=0.5)
+
+        slower = {**baseline, 'scenarios': {'transaction_list': {'median_ms': 16.0, 'p95_ms': 20.0, 'queries': 4}}}
+        with self.assertRaisesMessage(CommandError, 'transaction_list: median 16.0 ms'):
+            command.compare(slower, baseline, tolerance=0.5)
+
+        more_queries = {**baseline, 'scale': {'warehouses': 20},
+                        'scenarios': {'transaction_list': {'median_ms': 99.0, 'p95_ms': 99.0, 'queries': 5}}}
+        with self.assertRaisesMessage(CommandError, 'transaction_list: 5 queries, baseline 4'):
+            command.compare(more_queries, baseline, tolerance=0.5)
+
+
+class StockStatusReportTests(TestCase):
+    def setUp(self):
+        self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001', minimum_stock=10)
+        self.other_product = Product.objects.create(name='Other Product', sku='TEST-002', minimum_stock=10)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.other_product, quantity=5)
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=10)
+
+    def test_summary_is_computed_in_one_query(self):
+        with self.assertNumQueries(1):
+            summary = get_stock_report_summary()
+        self.assertEqual(summary, {'total_count': 3, 'critical_count': 2})
+
+    def test_sections_are_rendered_per_warehouse(self):
+        sections = list(render_stock_report_sections(iter_stock_report_rows(chunk_size=1)))
+        self.assertEqual([section[:2] for section in sections], [
+            (self.warehouse_a.id, 'Warehouse A'),
+            (self.warehouse_b.id, 'Warehouse B'),
+        ])
+        self.assertEqual(sections[0][2].count('CRITICAL'), 1)
+
+    def test_report_documents_are_split_by_warehouse(self):
+        documents = list(iter_stock_report_documents(get_stock_report_summary(), timezone.now()))
+        self.assertEqual([filename for filename, _ in documents], [
+            'stock_status_report_summary.pdf',
+            f'stock_status_report_{self.warehouse_a.id}_warehouse-a.pdf',
+            f'stock_status_report_{self.warehouse_b.id}_warehouse-b.pdf',
+        ])
+        self.assertIn('Products at Critical Level: 2', documents[0][1])
+        self.assertNotIn('Summary', documents[1][1])
+        self.assertNotIn('Warehouse B', documents[1][1])
+
+    @skipUnless(HAS_WEASYPRINT, 'WeasyPrint and its system libraries are not installed')
+    @override_settings(STOCK_REPORT_PDF_WORKERS=2)
+    def test_report_is_sent_as_zip_of_pdfs(self):
+        send_stock_status_report()
+        filename, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual((filename, mimetype), ('stock_status_report.zip', 'application/zip'))
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            self.assertEqual(len(archive.namelist()), 3)
+            for name in archive.namelist():
+                self.assertTrue(archive.read(name).startswith(b'%PDF'))
+
+    @override_settings(STOCK_REPORT_PDF_MAX_ROWS=2, STOCK_REPORT_MAX_ATTACHMENT_SIZE=10)
+    def test_oversized_report_is_not_attached(self):
+        with self.assertLogs('inventory.tasks', 'WARNING'):
+            send_stock_status_report()
+        self.assertEqual(mail.outbox[0].attachments, [])
+        self.assertIn('larger than the attachment limit of 10 bytes', mail.outbox[0].body)
+
+    def test_daemonic_workers_render_serially_with_a_warning(self):
+        documents = [('a.pdf', '<p>a</p>'), ('b.pdf', '<p>b</p>')]
+        process = mock.Mock(daemon=True)
+        with mock.patch('inventory.tasks.multiprocessing.current_process', return_value=process), \
+                mock.patch('inventory.tasks.render_pdf', side_effect=str.encode), \
+                mock.patch('inventory.tasks.ProcessPoolExecutor') as executor, \
+                self.assertLogs('inventory.tasks', 'WARNING') as logs:
+            rendered = list(render_pdfs(documents, workers=4))
+        self.assertEqual(rendered, [('a.pdf', b'<p>a</p>'), ('b.pdf', b'<p>b</p>')])
+        executor.assert_not_called()
+        self.assertIn('serially', logs.output[0])
+
+    @override_settings(STOCK_REPORT_PDF_MAX_ROWS=2)
+    def test_large_inventory_is_sent_as_compressed_csv(self):
+        send_stock_status_report()
+        self.assertEqual(len(mail.outbox), 1)
+        filename, content, mimetype = mail.outbox[0].attachments[0]
+        self.assertEqual((filename, mimetype), ('stock_status_report.csv.gz', 'application/gzip'))
+        rows = list(csv.reader(io.StringIO(gzip.decompress(content).decode())))
+        self.assertEqual(rows[0], ['Warehouse', 'Product', 'Current Stock', 'Minimum Stock', 'Status'])
+        self.assertEqual(rows[1:], [
+            ['Warehouse A', 'Test Product', '100', '10', 'OK'],
+            ['Warehouse A', 'Other Product', '5', '10', 'CRITICAL'],
+            ['Warehouse B', 'Test Product', '10', '10', 'CRITICAL'],
+        ])
+        self.assertIn('Products at Critical Level: 2', mail.outbox[0].body)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN output is SQLite specific')
+class QueryIndexTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001')
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan)
+        self.assertNotIn('USE TEMP B-TREE FOR ORDER BY', plan)
+
+    def test_listing_order_uses_created_index(self):
+        self.assertUsesIndex(
+            StockTransaction.objects.order_by('-created_at', 'id')[:100],
+            'stocktxn_created_idx'
+        )
+
+    def test_transaction_type_filter_uses_type_index(self):
+        self.assertUsesIndex(
+            StockTransaction.objects.filter(transaction_type='WW').order_by('-created_at', 'id')[:100],
+            'stocktxn_type_created_idx'
+        )
+
+    def test_warehouse_filter_uses_both_partial_indexes(self):
+        plan = StockTransaction.objects.involving_warehouse(self.warehouse_a.id).explain()
+        self.assertIn('stocktxn_source_created_idx', plan)
+        self.assertIn('stocktxn_dest_created_idx', plan)
+
+    def test_low_stock_count_uses_critical_index(self):
+        plan = WarehouseStock.objects.filter(
+            warehouse=self.warehouse_a, is_critical=True
+        ).values('warehouse').annotate(count=Count('id')).explain()
+        self.assertIn('stock_critical_idx', plan)
+
+    def test_critical_filter_uses_partial_index(self):
+        self.assertUsesIndex(
+            WarehouseStock.objects.filter(is_critical=True).order_by('warehouse_id', 'product_id'),
+            'stock_critical_idx'
+        )
+
+
+class WarehouseStockSummaryTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=10)
+        self.other = Product.objects.create(name='Gadget', sku='G-001', minimum_stock=5)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.other, quantity=3)
+
+    def stored(self):
+        return {
+            summary.pop('warehouse_id'): summary
+            for summary in WarehouseStockSummary.objects.values(
+                'warehouse_id', 'total_skus', 'critical_skus', 'total_units'
+            )
+        }
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_transactions_keep_summary_in_sync(self, mock_alert):
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_a,
+            destination_warehouse=self.warehouse_b,
+            product=self.product,
+            quantity=95,
+            transaction_type='WW',
+            performed_by=self.user
+        )
+        StockTransaction.objects.record_many([
+            StockTransaction(
+                destination_warehouse=self.warehouse_a, customer=self.customer, product=self.other,
+                quantity=10, transaction_type='CW', performed_by=self.user
+            ),
+            StockTransaction(
+                source_warehouse=self.warehouse_b, customer=self.customer, product=self.product,
+                quantity=90, transaction_type='WC', performed_by=self.user
+            ),
+        ])
+
+        self.assertEqual(self.stored(), WarehouseStockSummary.objects.compute())
+        self.assertEqual(self.stored()[self.warehouse_a.id], {
+            'total_skus': 2, 'critical_skus': 1, 'total_units': 18
+        })
+        self.assertEqual(get_stock_report_summary(), {'total_count': 3, 'critical_count': 2})
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_transfers_update_summaries_after_stock_in_warehouse_order(self, mock_alert):
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=10)
+        with CaptureQueriesContext(connection) as queries:
+            StockTransaction.objects.create(
+                source_warehouse=self.warehouse_b, destination_warehouse=self.warehouse_a,
+                product=self.product, quantity=5, transaction_type='WW', performed_by=self.user
+            )
+
+        updates = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].startswith(('UPDATE "inventory_warehousestock"', 'UPDATE "inventory_warehousestocksummary"'))
+        ]
+        self.assertEqual(len(updates), 4)
+        self.assertTrue(all('warehousestocksummary' not in sql for sql in updates[:2]))
+        self.assertTrue(updates[2].endswith(f'"warehouse_id" = {self.warehouse_a.id}'))
+        self.assertTrue(updates[3].endswith(f'"warehouse_id" = {self.warehouse_b.id}'))
+        self.assertEqual(self.stored(), WarehouseStockSummary.objects.compute())
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_bulk_transactions_increment_summaries_without_recounting(self, mock_alert):
+        with CaptureQueriesContext(connection) as queries:
+            StockTransaction.objects.record_many([
+                StockTransaction(
+                    source_warehouse=self.warehouse_a, customer=self.customer, product=self.product,
+                    quantity=95, transaction_type='WC', performed_by=self.user
+                ),
+                StockTransaction(
+                    destination_warehouse=self.warehouse_b, customer=self.customer, product=self.other,
+                    quantity=4, transaction_type='CW', performed_by=self.user
+                ),
+            ])
+
+        recounts = [
+            query['sql'] for query in queries.captured_queries
+            if 'JOIN "inventory_warehousestock"' in query['sql']
+        ]
+        self.assertEqual(recounts, [])
+        self.assertEqual(self.stored(), WarehouseStockSummary.objects.compute())
+
+    def test_direct_stock_edits_keep_summary_in_sync(self):
+        stock = WarehouseStock.objects.get(warehouse=self.warehouse_a, product=self.other)
+        stock.quantity = 50
+        stock.save()
+        stock.warehouse = self.warehouse_b
+        stock.save()
+        self.assertEqual(self.stored(), WarehouseStockSummary.objects.compute())
+
+        stock.delete()
+        self.assertEqual(self.stored(), WarehouseStockSummary.objects.compute())
+
+        self.warehouse_a.delete()
+        self.assertEqual(self.stored(), WarehouseStockSummary.objects.compute())
+
+    def test_minimum_stock_change_updates_critical_counts(self):
+        self.product.minimum_stock = 200
+        self.product.save()
+
+        self.assertEqual(self.stored()[self.warehouse_a.id]['critical_skus'], 2)
+
+    def test_rebuild_command_repairs_drift(self):
+        WarehouseStockSummary.objects.filter(warehouse=self.warehouse_a).update(total_units=0)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_stock_summary', '--verify', stdout=io.StringIO())
+        call_command('rebuild_stock_summary', stdout=io.StringIO())
+        call_command('rebuild_stock_summary', '--verify', stdout=io.StringIO())
+
+        self.assertEqual(self.stored()[self.warehouse_a.id]['total_units'], 103)
+
+
+class StockTransactionRollupTests(APITestCase):
+    # Minutes after the start of the first day; the last lands exactly on a day boundary
+    OFFSETS = [0, 30, 59, 61, 200, 1439, 1440, 1500, 2000, 2880, 3000, 4320, 5000, 5759, 5760]
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.products = [
+            Product.objects.create(name=f'Product {index}', sku=f'P-{index}', minimum_stock=0)
+            for index in range(7)
+        ]
+        for product in self.products:
+            WarehouseStock.objects.create(warehouse=self.warehouse_a, product=product, quantity=1000)
+
+        transactions = []
+        for index in range(len(self.OFFSETS)):
+            product = self.products[index * index % len(self.products)]
+            if index % 3 == 0:
+                transactions.append(StockTransaction(
+                    source_warehouse=self.warehouse_a, destination_warehouse=self.warehouse_b, product=product,
+                    quantity=index + 1, transaction_type='WW', transfer_type='TRUCK', performed_by=self.user
+                ))
+            elif index % 3 == 1:
+                transactions.append(StockTransaction(
+                    destination_warehouse=self.warehouse_b, customer=self.customer, product=product,
+                    quantity=index + 1, transaction_type='CW', performed_by=self.user
+                ))
+            else:
+                transactions.append(StockTransaction(
+                    source_warehouse=self.warehouse_a, customer=self.customer, product=product,
+                    quantity=index + 1, transaction_type='WC', performed_by=self.user
+                ))
+        created = StockTransaction.objects.record_many(transactions)
+
+        self.start = floor_time(timezone.now(), StockTransactionRollup.DAY) - timedelta(days=10)
+        for stock_transaction, offset in zip(created, self.OFFSETS):
+            StockTransaction.objects.filter(pk=stock_transaction.pk).update(
+                created_at=self.start + timedelta(minutes=offset, seconds=offset % 7)
+            )
+        StockTransactionRollup.objects.rebuild()
+
+    def raw_counts(self, start=None, end=None, **filters):
+        return Counter(dict(
+            ((source, destination, kind, transfer), count)
+            for source, destination, kind, transfer, count in StockTransaction.objects.matching(
+                start=start, end=end, **filters
+            ).order_by().values(
+                'source_warehouse_id', 'destination_warehouse_id', 'transaction_type', 'transfer_type'
+            ).annotate(count=Count('id')).values_list(
+                'source_warehouse_id', 'destination_warehouse_id', 'transaction_type', 'transfer_type', 'count'
+            )
+        ))
+
+    def raw_top_products(self, limit, start=None, end=None, **filters):
+        ranked = StockTransaction.objects.matching(start=start, end=end, **filters).order_by().values(
+            'product_id', 'product__name'
+        ).annotate(count=Count('id')).values_list('product_id', 'product__name', 'count')
+        return sorted(ranked, key=lambda row: (-row[2], row[0]))[:limit]
+
+    def ranges(self):
+        day, hour, minute = timedelta(days=1), timedelta(hours=1), timedelta(minutes=1)
+        return [
+            (None, None),
+            (self.start, self.start + 2 * day),
+            (self.start + day, self.start + 4 * day),
+            (self.start + 30 * minute, self.start + 3 * day + 20 * hour + 1 * minute),
+            (self.start + 61 * minute, self.start + 24 * hour + 33 * minute),
+            (self.start + 3 * hour + 10 * minute, self.start + 3 * hour + 20 * minute),
+            (self.start - 5 * day, self.start + 5 * hour),
+        ]
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        StockTransaction.objects.create(
+            source_warehouse=self.warehouse_a, destination_warehouse=self.warehouse_b, product=self.products[0],
+            quantity=3, transaction_type='WW', transfer_type='TRUCK', performed_by=self.user
+        )
+        StockTransaction.objects.record_many([
+            StockTransaction(
+                destination_warehouse=self.warehouse_a, customer=self.customer, product=self.products[1],
+                quantity=4, transaction_type='CW', performed_by=self.user
+            )
+            for _ in range(2)
+        ])
+        fields = [*StockTransactionRollup.KEY, 'count', 'quantity']
+        recorded = sorted(StockTransactionRollup.objects.values_list(*fields))
+
+        StockTransactionRollup.objects.rebuild()
+
+        self.assertEqual(sorted(StockTransactionRollup.objects.values_list(*fields)), recorded)
+        today = StockTransactionRollup.objects.get(
+            period=StockTransactionRollup.DAY, product=StockTransactionRollup.ALL_PRODUCTS,
+            transaction_type='CW', bucket__gt=self.start + timedelta(days=5)
+        )
+        self.assertEqual((today.count, today.quantity), (2, 8))
+
+    def test_counts_match_the_transactions(self):
+        for filters in ({}, {'warehouse_id': self.warehouse_a.id}, {'transaction_type': 'WC'},
+                        {'warehouse_ids': [self.warehouse_b.id]}):
+            for start, end in self.ranges():
+                with self.subTest(filters=filters, start=start, end=end):
+                    self.assertEqual(
+                        StockTransactionRollup.objects.counts(start, end, **filters),
+                        self.raw_counts(start, end, **filters)
+                    )
+                    self.assertEqual(
+                        StockTransactionRollup.objects.top_products(3, start, end, **filters),
+                        self.raw_top_products(3, start, end, **filters)
+                    )
+
+    def test_whole_days_read_only_rollups(self):
+        start, end = self.start, self.start + timedelta(days=2)
+        with CaptureQueriesContext(connection) as queries:
+            StockTransactionRollup.objects.counts(start, end)
+        # One rollup query plus the transactions at exactly end
+        self.assertEqual(len(queries), 2)
+        self.assertIn('inventory_stocktransactionrollup', queries[0]['sql'])
+
+    def test_summary_endpoint_uses_rollups(self):
+        self.client.force_authenticate(self.user)
+        start = timezone.localtime(self.start + timedelta(minutes=45))
+        end = timezone.localtime(self.start + timedelta(days=2, hours=3))
+        response = self.client.get('/api/stock-transactions/warehouse_summary/', {
+            'start_date': start.isoformat(), 'end_date': end.isoformat()
+        })
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        raw = StockTransaction.objects.filter(created_at__range=(start, end))
+        self.assertEqual(response.data['transaction_types'], [
+            {'transaction_type': kind, 'count': count}
+            for kind, count in raw.order_by('transaction_type').values_list(
+                'transaction_type'
+            ).annotate(count=Count('id'))
+        ])
+        self.assertEqual(response.data['transfer_types'], [
+            {'transfer_type': 'TRUCK', 'count': raw.filter(transfer_type='TRUCK').count()},
+            {'transfer_type': None, 'count': raw.filter(transfer_type=None).count()},
+        ])
+        self.assertEqual(response.data['top_products'], [
+            {'product__name': name, 'count': count}
+            for _, name, count in self.raw_top_products(5, start, end)
+        ])
+        self.assertEqual(response.data['warehouse_stats']['Warehouse B']['Entry'], raw.filter(
+            destination_warehouse=self.warehouse_b
+        ).count())
+
+    def test_summary_rejects_invalid_dates(self):
+        self.client.force_authenticate(self.user)
+        for start_date, end_date in (('2024-02-01', '2024-01-01'), ('yesterday', '2024-01-01')):
+            response = self.client.get('/api/stock-transactions/warehouse_summary/', {
+                'start_date': start_date, 'end_date': end_date
+            })
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class StockTransactionArchiveTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_settings = override_settings(TRANSACTION_ARCHIVE_DIR=directory.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.admin_user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.user = User.objects.create_user('user', 'user@test.com', 'userpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.user.authorized_warehouses.add(self.warehouse_b)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=100)
+
+        self.old_month = add_months(month_start(timezone.now()), -3)
+        for index, days in enumerate((2, 40, 70, None)):
+            stock_transaction = StockTransaction.objects.create(
+                source_warehouse=self.warehouse_a,
+                destination_warehouse=self.warehouse_b if index % 2 else None,
+                customer=None if index % 2 else self.customer,
+                product=self.product, quantity=index + 1, transaction_type='WW' if index % 2 else 'WC',
+                transfer_type='TRUCK' if index % 2 else None, notes=f'Note {index}', performed_by=self.admin_user
+            )
+            if days is not None:
+                StockTransaction.objects.filter(pk=stock_transaction.pk).update(
+                    created_at=self.old_month + timedelta(days=days, hours=index)
+                )
+        StockTransactionRollup.objects.rebuild()
+
+    def export(self, user, **params):
+        self.client.force_authenticate(user)
+        response = self.client.get('/api/stock-transactions/export/', {'file_format': 'ndjson', **params})
+        return [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+    def test_closed_months_move_to_archive_files(self):
+        archives = archive_closed_months(keep_months=1)
+
+        self.assertEqual(
+            [(archive.month, archive.rows) for archive in archives],
+            [(self.old_month.date(), 1), (add_months(self.old_month, 1).date(), 1)]
+        )
+        self.assertEqual(StockTransaction.objects.count(), 2)
+        self.assertEqual(
+            [row['notes'] for row in iter_archived_rows()], ['Note 0', 'Note 1']
+        )
+        self.assertEqual(archive_closed_months(keep_months=1), [])
+
+    def test_exports_read_archived_months(self):
+        exports = [
+            (self.admin_user, {}),
+            (self.user, {}),
+            (self.admin_user, {'transaction_type': 'WW'}),
+            (self.admin_user, {
+                'start_date': (self.old_month + timedelta(days=10)).isoformat(),
+                'end_date': timezone.now().isoformat()
+            }),
+        ]
+        before = [self.export(user, **params) for user, params in exports]
+
+        archive_closed_months(keep_months=0)
+
+        self.assertEqual(StockTransaction.objects.count(), 1)
+        self.assertEqual([self.export(user, **params) for user, params in exports], before)
+        self.assertEqual([len(rows) for rows in before], [4, 2, 2, 3])
+
+    def test_summary_keeps_counting_archived_months(self):
+        self.client.force_authenticate(self.admin_user)
+        before = self.client.get('/api/stock-transactions/warehouse_summary/').data
+        archive_closed_months(keep_months=1)
+        StockTransactionRollup.objects.rebuild()
+        cache.clear()
+
+        after = self.client.get('/api/stock-transactions/warehouse_summary/').data
+        self.assertEqual(after['transaction_types'], before['transaction_types'])
+        self.assertEqual(after['warehouse_stats'], before['warehouse_stats'])
+
+    def test_open_months_are_not_archived(self):
+        with self.assertRaises(ValueError):
+            archive_month(month_start(timezone.now()))
+
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Transactions are only partitioned on PostgreSQL')
+class TransactionPartitionTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_settings = override_settings(TRANSACTION_ARCHIVE_DIR=directory.name)
+        archive_settings.enable()
+        self.addCleanup(archive_settings.disable)
+
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=self.warehouse, product=self.product, quantity=100)
+
+    def record(self, created_at=None):
+        stock_transaction = StockTransaction.objects.create(
+            source_warehouse=self.warehouse, customer=self.customer, product=self.product,
+            quantity=1, transaction_type='WC', performed_by=self.user
+        )
+        if created_at is not None:
+            StockTransaction.objects.filter(pk=stock_transaction.pk).update(created_at=created_at)
+        return stock_transaction.pk
+
+    def partition_of(self, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT tableoid::regclass::text FROM {StockTransaction._meta.db_table} WHERE id = %s', [pk]
+            )
+            return cursor.fetchone()[0]
+
+    def test_transactions_land_in_their_month_partition(self):
+        self.assertTrue(is_partitioned(connection))
+        self.assertEqual(self.partition_of(self.record()), partition_name(month_start(timezone.now())))
+
+    def test_late_partitions_take_over_rows_from_the_default_partition(self):
+        months_ahead = settings.TRANSACTION_PARTITION_MONTHS_AHEAD + 2
+        month = add_months(month_start(timezone.now()), months_ahead)
+        pk = self.record(month + timedelta(days=1))
+        self.assertEqual(self.partition_of(pk), default_partition_name())
+
+        self.assertIn(partition_name(month), create_partitions(months_ahead))
+        self.assertEqual(self.partition_of(pk), partition_name(month))
+
+    def test_archiving_leaves_no_rows_of_the_month_behind(self):
+        partitioned = add_months(month_start(timezone.now()), -3)
+        unpartitioned = add_months(partitioned, 1)
+        for month in (partitioned, unpartitioned):
+            self.record(month + timedelta(days=1))
+            self.record(month + timedelta(days=2))
+        create_partition(connection, partitioned)
+
+        for month in (partitioned, unpartitioned):
+            self.assertEqual(archive_month(month).rows, 2)
+            self.assertFalse(StockTransaction.objects.filter(
+                created_at__gte=month, created_at__lt=add_months(month, 1)
+            ).exists())
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT to_regclass(%s)', [partition_name(partitioned)])
+            self.assertIsNone(cursor.fetchone()[0])
+
+    @override_settings(ADMIN_EXACT_COUNT_LIMIT=0)
+    def test_admin_count_estimate_adds_up_partitions(self):
+        self.record()
+        self.record(add_months(month_start(timezone.now()), -3))
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {StockTransaction._meta.db_table}')
+
+        paginator = EstimatedCountPaginator(StockTransaction.objects.all(), 10)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(paginator.count, 2)
+        self.assertFalse(any('COUNT(' in query['sql'] for query in queries.captured_queries))
+
+class AsyncStockLookupTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('scanner', 'scanner@test.com', 'scannerpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_a.authorized_users.add(self.user)
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=5)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=10)
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=20)
+        token = RefreshToken.for_user(self.user).access_token
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    async def test_requires_valid_token(self):
+        url = reverse('stock-lookup', args=[self.warehouse_a.id, self.product.id])
+        response = await self.async_client.get(url)
+        self.assertEqual(response.status_code, 401)
+        response = await self.async_client.get(url, headers={'Authorization': 'Bearer invalid'})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_lookup_by_warehouse_and_product(self):
+        response = await self.async_client.get(
+            reverse('stock-lookup', args=[self.warehouse_a.id, self.product.id]), headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['quantity'], 10)
+        self.assertEqual(response.json()['sku'], 'W-001')
+
+        response = await self.async_client.get(
+            reverse('stock-lookup', args=[self.warehouse_b.id, self.product.id]), headers=self.headers
+        )
+        self.assertEqual(response.status_code, 404)
+
+    async def test_lookup_by_sku_only_shows_authorized_warehouses(self):
+        response = await self.async_client.get(
+            reverse('stock-lookup-sku', args=['W-001']), headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['product']['id'], self.product.id)
+        self.assertEqual(
+            [stock['warehouse'] for stock in response.json()['results']], [self.warehouse_a.id]
+        )
+
+        response = await self.async_client.get(
+            reverse('stock-lookup-sku', args=['W-001']), {'warehouse': self.warehouse_b.id},
+            headers=self.headers
+        )
+        self.assertEqual(response.json()['results'], [])
+
+    async def test_sku_change_invalidates_cached_product(self):
+        url = reverse('stock-lookup-sku', args=['W-001'])
+        self.assertEqual((await self.async_client.get(url, headers=self.headers)).status_code, 200)
+
+        self.product.sku = 'W-002'
+        await self.product.asave()
+
+        self.assertEqual((await self.async_client.get(url, headers=self.headers)).status_code, 404)
+        response = await self.async_client.get(
+            reverse('stock-lookup-sku', args=['W-002']), headers=self.headers
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+@mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+class CriticalStockTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.user = User.objects.create_user('clerk', 'clerk@test.com', 'clerkpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_a.authorized_users.add(self.user)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=10)
+        self.stock = WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=12)
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=5)
+
+    def events(self):
+        return list(CriticalStockEvent.objects.order_by('id').values_list('warehouse_id', 'quantity', 'is_critical'))
+
+    def withdraw(self, quantity):
+        return StockTransaction(
+            source_warehouse=self.warehouse_a, customer=self.customer, product=self.product,
+            quantity=quantity, transaction_type='WC', performed_by=self.admin
+        )
+
+    def test_transactions_keep_flag_and_record_transitions(self, mock_alert):
+        self.assertEqual(self.events(), [(self.warehouse_b.id, 5, True)])
+
+        self.withdraw(1).save()
+        self.withdraw(2).save()
+        self.stock.refresh_from_db()
+        self.assertTrue(self.stock.is_critical)
+
+        StockTransaction.objects.record_many([
+            StockTransaction(
+                destination_warehouse=self.warehouse_a, customer=self.customer, product=self.product,
+                quantity=20, transaction_type='CW', performed_by=self.admin
+            ),
+        ])
+        self.stock.refresh_from_db()
+        self.assertFalse(self.stock.is_critical)
+        self.assertEqual(self.events()[1:], [
+            (self.warehouse_a.id, 9, True), (self.warehouse_a.id, 29, False)
+        ])
+
+    def test_new_records_announced_alike_by_single_and_bulk_receipts(self, mock_alert):
+        def receipt(quantity):
+            warehouse = Warehouse.objects.create(name=f'Warehouse {quantity}', location='Location')
+            return StockTransaction(
+                destination_warehouse=warehouse, customer=self.customer, product=self.product,
+                quantity=quantity, transaction_type='CW', performed_by=self.admin
+            )
+
+        def new_events(record):
+            before = CriticalStockEvent.objects.count()
+            record()
+            return [is_critical for _, _, is_critical in self.events()[before:]]
+
+        for quantity in (3, 50):
+            single = new_events(lambda: receipt(quantity).save())
+            bulk = new_events(lambda: StockTransaction.objects.record_many([receipt(quantity)]))
+            self.assertEqual(bulk, single)
+            self.assertEqual(single, [True] if quantity <= 10 else [])
+
+    def test_minimum_stock_change_updates_flag(self, mock_alert):
+        self.product.minimum_stock = 4
+        self.product.save()
+
+        self.assertEqual(
+            dict(WarehouseStock.objects.values_list('warehouse_id', 'minimum_stock')),
+            {self.warehouse_a.id: 4, self.warehouse_b.id: 4}
+        )
+        self.assertFalse(WarehouseStock.objects.filter(is_critical=True).exists())
+        self.assertEqual(self.events()[1:], [(self.warehouse_b.id, 5, False)])
+
+    def test_deleted_stock_leaves_critical_state(self, mock_alert):
+        WarehouseStock.objects.filter(warehouse=self.warehouse_b).get().delete()
+
+        self.assertEqual(self.events()[1:], [(self.warehouse_b.id, None, False)])
+
+    def test_critical_lists_authorized_critical_stock(self, mock_alert):
+        url = '/api/warehouse-stocks/critical/'
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get(url).json()['results'], [])
+
+        self.withdraw(5).save()
+        results = self.client.get(url).json()['results']
+        self.assertEqual([(stock['warehouse'], stock['quantity']) for stock in results], [(self.warehouse_a.id, 7)])
+
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(url, {'warehouse': self.warehouse_b.id})
+        self.assertEqual([stock['quantity'] for stock in response.json()['results']], [5])
+
+
+@mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+class StockReservationTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.user = User.objects.create_user('picker', 'picker@test.com', 'pickerpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_a.authorized_users.add(self.user)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        self.stock = WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=10)
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=10)
+        self.client.force_authenticate(self.user)
+
+    def withdrawal(self, quantity):
+        return StockTransaction(
+            source_warehouse=self.warehouse_a, customer=self.customer, product=self.product,
+            quantity=quantity, transaction_type='WC', performed_by=self.admin
+        )
+
+    def reserve(self, quantity):
+        return StockReservation.objects.reserve(self.warehouse_a.id, self.product.id, quantity, self.user)
+
+    def test_reserved_units_cannot_be_withdrawn(self, mock_alert):
+        self.reserve(8)
+
+        with self.assertRaisesMessage(ValidationError, 'Available: 2, Requested: 3'):
+            self.withdrawal(3).save()
+        with self.assertRaisesMessage(ValidationError, 'Available: 2, Requested: 3'):
+            StockTransaction.objects.record_many([self.withdrawal(3)])
+        with self.assertRaises(ValidationError):
+            self.reserve(3)
+        self.withdrawal(2).save()
+
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.quantity, self.stock.reserved), (8, 8))
+
+    def test_confirm_records_the_withdrawal(self, mock_alert):
+        response = self.client.post('/api/stock-reservations/', {
+            'warehouse': self.warehouse_a.id, 'product': self.product.id, 'quantity': 4, 'ttl': 60
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], StockReservation.HELD)
+        url = f"/api/stock-reservations/{response.data['id']}/confirm/"
+
+        response = self.client.post(url, {'transaction_type': 'WC', 'customer': self.customer.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual((response.data['source_warehouse'], response.data['quantity']), (self.warehouse_a.id, 4))
+        reservation = StockReservation.objects.get()
+        self.assertEqual(reservation.status, StockReservation.CONFIRMED)
+        self.assertEqual(reservation.transaction_id, response.data['id'])
+        self.stock.refresh_from_db()
+        self.assertEqual((self.stock.quantity, self.stock.reserved), (6, 0))
+
+        response = self.client.post(url, {'transaction_type': 'WC', 'customer': self.customer.id}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(StockTransaction.objects.count(), 1)
+
+    def test_release_and_expiry_return_units(self, mock_alert):
+        released = self.reserve(2)
+        expired = self.reserve(3)
+        StockReservation.objects.filter(pk=expired.pk).update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        response = self.client.post(f'/api/stock-reservations/{released.id}/release/')
+        self.assertEqual(response.data['status'], StockReservation.RELEASED)
+        self.assertEqual(expire_stock_reservations(), 1)
+        self.assertEqual(expire_stock_reservations(), 0)
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.reserved, 0)
+        expired.refresh_from_db()
+        self.assertEqual(expired.status, StockReservation.EXPIRED)
+        with self.assertRaises(ValidationError):
+            expired.confirm(self.withdrawal(3))
+
+    def test_reservations_need_warehouse_access(self, mock_alert):
+        response = self.client.post('/api/stock-reservations/', {
+            'warehouse': self.warehouse_b.id, 'product': self.product.id, 'quantity': 1
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        StockReservation.objects.reserve(self.warehouse_b.id, self.product.id, 1, self.admin)
+        self.reserve(1)
+        response = self.client.get('/api/stock-reservations/')
+        self.assertEqual([reservation['warehouse'] for reservation in response.data['results']], [self.warehouse_a.id])
+
+
+class CriticalStockStreamTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.user = User.objects.create_user('clerk', 'clerk@test.com', 'clerkpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.warehouse_a.authorized_users.add(self.user)
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=10)
+        self.stock = WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=5)
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=5)
+        token = RefreshToken.for_user(self.user).access_token
+        self.headers = {'Authorization': f'Bearer {token}'}
+        self.url = reverse('critical-stock-stream')
+
+    def replenish(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.stock.quantity = 50
+            self.stock.save()
+
+    async def read(self, response):
+        return b''.join([chunk async for chunk in response.streaming_content]).decode()
+
+    async def test_requires_valid_token(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 401)
+
+    @override_settings(CRITICAL_STOCK_STREAM_TIMEOUT=0, CRITICAL_STOCK_STREAM_LOOKBACK=0)
+    async def test_resumes_after_last_event_id(self):
+        first = await CriticalStockEvent.objects.order_by('id').afirst()
+        response = await self.async_client.get(self.url, headers={**self.headers, 'Last-Event-ID': '0'})
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = await self.read(response)
+        self.assertTrue(body.startswith('retry: 1000\n\n'))
+        # Warehouse B is not the user's
+        self.assertEqual(body.count('event: critical\n'), 1)
+        self.assertIn(f'id: {first.id}\n', body)
+
+        response = await self.async_client.get(self.url, {'last_event_id': first.id}, headers=self.headers)
+        self.assertNotIn('event:', await self.read(response))
+
+    @override_settings(CRITICAL_STOCK_STREAM_TIMEOUT=0)
+    async def test_resumed_streams_repeat_the_lookback_window(self):
+        first = await CriticalStockEvent.objects.order_by('id').afirst()
+        response = await self.async_client.get(self.url, {'last_event_id': first.id}, headers=self.headers)
+        body = await self.read(response)
+        self.assertEqual(json.loads(body.split('data: ')[1])['id'], first.id)
+
+    @override_settings(CRITICAL_STOCK_STREAM_TIMEOUT=5, CRITICAL_STOCK_STREAM_POLL_INTERVAL=0.01)
+    async def test_pushes_events_committed_out_of_id_order(self):
+        # An id taken by a transaction that has not committed yet
+        late_id = (await CriticalStockEvent.objects.acreate(
+            warehouse=self.warehouse_a, product=self.product, quantity=50, minimum_stock=10, is_critical=False
+        )).id
+        await CriticalStockEvent.objects.filter(id=late_id).adelete()
+        await CriticalStockEvent.objects.acreate(
+            warehouse=self.warehouse_b, product=self.product, quantity=50, minimum_stock=10, is_critical=False
+        )
+
+        response = await self.async_client.get(self.url, headers=self.headers)
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'retry: 1000\n\n')
+
+        await CriticalStockEvent.objects.acreate(
+            id=late_id, warehouse=self.warehouse_a, product=self.product,
+            quantity=50, minimum_stock=10, is_critical=False
+        )
+        await cache.aset(CRITICAL_STOCK_EVENTS_KEY, 'committed')
+
+        event = (await anext(chunks)).decode()
+        self.assertEqual(json.loads(event.split('data: ')[1])['id'], late_id)
+        # Resuming from the event's own id would repeat everything after it
+        self.assertNotIn(f'id: {late_id}\n', event)
+        await chunks.aclose()
+
+    @override_settings(CRITICAL_STOCK_STREAM_TIMEOUT=5, CRITICAL_STOCK_STREAM_POLL_INTERVAL=0.01)
+    async def test_pushes_new_transitions(self):
+        response = await self.async_client.get(self.url, headers=self.headers)
+        chunks = aiter(response.streaming_content)
+        self.assertEqual(await anext(chunks), b'retry: 1000\n\n')
+
+        await sync_to_async(self.replenish)()
+
+        event = (await anext(chunks)).decode()
+        self.assertIn('event: replenished\n', event)
+        data = json.loads(event.split('data: ')[1])
+        self.assertEqual(
+            (data['warehouse'], data['quantity'], data['is_critical']), (self.warehouse_a.id, 50, False)
+        )
+        await chunks.aclose()
+
+
+@override_settings(REPLICA_DATABASE='replica')
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+    client_class = APIClient
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.product = Product.objects.create(name='Widget', sku='W-001', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=self.warehouse, product=self.product, quantity=10)
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.client.force_authenticate(self.user)
+
+    def test_reads_inside_transactions_stay_on_primary(self):
+        with replica_reads():
+            self.assertEqual(WarehouseStock.objects.all().db, 'replica')
+            with transaction.atomic():
+                self.assertEqual(WarehouseStock.objects.all().db, 'default')
+        self.assertEqual(WarehouseStock.objects.all().db, 'default')
+
+    def test_listing_reads_from_replica(self):
+        with CaptureQueriesContext(connections['replica']) as replica_queries:
+            response = self.client.get('/api/warehouse-stocks/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertTrue(replica_queries.captured_queries)
+
+    def test_replica_reads_end_when_the_view_raises(self):
+        self.client.raise_request_exception = True
+        with mock.patch.object(WarehouseStockViewSet, 'list', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.get('/api/warehouse-stocks/')
+        self.assertEqual(WarehouseStock.objects.all().db, 'default')
+
+    def test_cached_stats_are_computed_on_primary(self):
+        for url in ('/api/stock-transactions/', '/api/stock-transactions/warehouse_summary/'):
+            cache.clear()
+            with self.subTest(url=url), CaptureQueriesContext(connections['replica']) as replica_queries:
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, status.HTTP_200_OK)
+                self.assertEqual(response.data['warehouse_stats']['Warehouse A']['products'], 1)
+                stats_queries = [
+                    query['sql'] for query in replica_queries.captured_queries
+                    if 'inventory_warehousestocksummary' in query['sql']
+                ]
+                self.assertEqual(stats_queries, [])
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_reads_stick_to_primary_after_a_write(self, mock_alert):
+        response = self.client.post('/api/stock-transactions/', {
+            'source_warehouse': self.warehouse.id, 'customer': self.customer.id,
+            'product': self.product.id, 'quantity': 1, 'transaction_type': 'WC'
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        with CaptureQueriesContext(connections['replica']) as replica_queries:
+            response = self.client.get('/api/stock-transactions/')
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertEqual(replica_queries.captured_queries, [])
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class StockLedgerConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse_a = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.warehouse_b = Warehouse.objects.create(name='Warehouse B', location='Location B')
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=self.warehouse_a, product=self.product, quantity=50)
+
+    def _transfer(self, source=None, destination=None):
+        try:
+            StockTransaction.objects.create(
+                source_warehouse=source or self.warehouse_a,
+                destination_warehouse=destination or self.warehouse_b,
+                product=self.product,
+                quantity=1,
+                transaction_type='WW',
+                performed_by=self.user
+            )
+            return True
+        except ValidationError:
+            return False
+        finally:
+            connection.close()
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_parallel_transfers_do_not_lose_updates(self, mock_alert):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda _: self._transfer(), range(80)))
+
+        self.assertEqual(results.count(True), 50)
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_a).quantity, 0)
+        self.assertEqual(WarehouseStock.objects.get(warehouse=self.warehouse_b).quantity, 50)
+        self.assertEqual(StockTransaction.objects.count(), 50)
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_opposite_transfers_do_not_deadlock(self, mock_alert):
+        WarehouseStock.objects.create(warehouse=self.warehouse_b, product=self.product, quantity=50)
+        directions = [(self.warehouse_a, self.warehouse_b), (self.warehouse_b, self.warehouse_a)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            results = list(executor.map(lambda index: self._transfer(*directions[index % 2]), range(80)))
+
+        self.assertEqual(results.count(True), 80)
+        self.assertEqual(
+            sorted(WarehouseStock.objects.values_list('quantity', flat=True)), [50, 50]
+        )
+
+
+@skipUnlessDBFeature('test_db_allows_multiple_connections')
+class StockReservationConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'adminpass')
+        self.warehouse = Warehouse.objects.create(name='Warehouse A', location='Location A')
+        self.customer = Customer.objects.create(
+            name='Customer', address='Address', contact_person='Contact',
+            phone='123', email='customer@test.com', customer_type='BUSINESS'
+        )
+        self.product = Product.objects.create(name='Test Product', sku='TEST-001', minimum_stock=0)
+        WarehouseStock.objects.create(warehouse=self.warehouse, product=self.product, quantity=50)
+
+    def withdrawal(self):
+        return StockTransaction(
+            source_warehouse=self.warehouse, customer=self.customer, product=self.product,
+            quantity=1, transaction_type='WC', performed_by=self.user
+        )
+
+    def _pick(self, reserve):
+        """Pick one unit, with or without reserving it first; returns the stage that failed"""
+        try:
+            if not reserve:
+                try:
+                    self.withdrawal().save()
+                except ValidationError:
+                    return 'withdraw'
+                return None
+            try:
+                reservation = StockReservation.objects.reserve(self.warehouse.id, self.product.id, 1, self.user)
+            except ValidationError:
+                return 'reserve'
+            try:
+                reservation.confirm(self.withdrawal())
+            except ValidationError:
+                return 'confirm'
+            return None
+        finally:
+            connection.close()
+
+    @mock.patch('inventory.tasks.send_critical_stock_alert.delay')
+    def test_confirmations_never_fail_under_contention(self, mock_alert):
+        # Reserving pickers compete with pickers that withdraw straight away
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            failures = list(executor.map(lambda index: self._pick(index % 2 == 0), range(100)))
+
+        self.assertEqual(failures.count('confirm'), 0)
+        self.assertEqual(failures.count(None), 50)
+        stock = WarehouseStock.objects.get(warehouse=self.warehouse)
+        self.assertEqual((stock.quantity, stock.reserved), (0, 0))
+        confirmed = StockReservation.objects.filter(status=StockReservation.CONFIRMED)
+        self.assertEqual(confirmed.count(), failures[::2].count(None))
@@ -1,10 +1,12 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from rest_framework_simplejwt.views import TokenRefreshView
+from .lookups import stock_lookup, stock_lookup_by_sku
+from .streams import critical_stock_stream
 from .views import (
-    LoginView, LogoutView,
+    LoginView, LogoutView, HealthCheckView, metrics,
     WarehouseViewSet, CustomerViewSet, ProductViewSet,
-    WarehouseStockViewSet, StockTransactionViewSet
+    WarehouseStockViewSet, StockTransactionViewSet, StockReservationViewSet
 )
 
 router = DefaultRouter()
@@ -13,11 +15,17 @@ router.register(r'customers', CustomerViewSet, basename='customer')
 router.register(r'products', ProductViewSet, basename='product')
 router.register(r'warehouse-stocks', WarehouseStockViewSet, basename='warehousestock')
 router.register(r'stock-transactions', StockTransactionViewSet, basename='stocktransaction')
+router.register(r'stock-reservations', StockReservationViewSet, basename='stockreservation')
 
 urlpatterns = [
     path('', include(router.urls)),
     path('login/', LoginView.as_view(), name='login'),
     path('logout/', LogoutView.as_view(), name='logout'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    path('health/', HealthCheckView.as_view(), name='health'),
+    path('metrics/', metrics, name='metrics'),
+    path('stock/<int:warehouse_id>/<int:product_id>/', stock_lookup, name='stock-lookup'),
+    path('stock/sku/<str:sku>/', stock_lookup_by_sku, name='stock-lookup-sku'),
+    path('stock/critical/stream/', critical_stock_stream, name='critical-stock-stream'),
 ]
 
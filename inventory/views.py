@@ -1,26 +1,85 @@
+import hashlib
+import hmac
+from collections import Counter
+from itertools import chain
+
 from django.shortcuts import render
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import require_GET
+from django.conf import settings
 from django.core.cache import cache
 from rest_framework import viewsets, status, generics, serializers
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, AllowAny, SAFE_METHODS
+from rest_framework.views import APIView
+from rest_framework.parsers import JSONParser
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.contrib.auth import logout
-from django.db.models import Q, F, Count, Prefetch
-from django.shortcuts import get_object_or_404
+from django.db import DEFAULT_DB_ALIAS, router
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.functional import cached_property
+from django.utils.dateparse import parse_datetime
 from .models import (
     Warehouse, Customer, Product, WarehouseStock,
-     StockTransaction
+     StockTransaction, StockCheckpoint, StockTransactionRollup, StockReservation
 )
 from .serializers import (
     WarehouseSerializer, CustomerSerializer,
     ProductSerializer, WarehouseStockSerializer,
-    StockTransactionSerializer
+    StockTransactionSerializer, BulkStockTransactionSerializer, StockTransactionRowSerializer,
+    StockLookupSerializer, StockReservationSerializer
+)
+from .pagination import StockTransactionPagination, WarehouseStockPagination, StockReservationPagination
+from .archive import iter_archived_rows
+from .caching import get_warehouse_generations
+from .exports import iter_csv, iter_ndjson, iter_gzip, aiter_chunks
+from .health import run_health_checks
+from .lookups import product_ids
+from .metrics import registry
+from .parsers import NDJSONParser
+from .routers import replica_reads, is_pinned_to_primary, pin_to_primary
+from .permissions import (
+    IsAdminUser, HasWarehouseAccess, get_authorized_warehouse_ids, has_warehouse_access
 )
-from .permissions import IsAdminUser, HasWarehouseAccess
 from rest_framework import status
 from django.core.exceptions import ValidationError as DjangoValidationError
 
+class ReplicaReadMixin:
+    """
+    Serve safe requests from the read replica. After a user writes, their
+    reads stay on the primary for REPLICA_STICKY_SECONDS so they see it.
+    Actions named in replica_read_actions only read, whatever their method
+    """
+    replica_read_actions = ()
+
+    def is_read_only(self, request):
+        return request.method in SAFE_METHODS or self.action in self.replica_read_actions
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if self.is_read_only(request) and not is_pinned_to_primary(request.user):
+            self._replica_reads = replica_reads()
+            self._replica_reads.__enter__()
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        if (not self.is_read_only(request) and response.status_code < 400
+                and request.user.is_authenticated):
+            pin_to_primary(request.user)
+        return super().finalize_response(request, response, *args, **kwargs)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        finally:
+            # Also reached when the view raises, so the thread never keeps reading from the replica
+            reads = self.__dict__.pop('_replica_reads', None)
+            if reads is not None:
+                reads.__exit__(None, None, None)
+
+
 class LoginView(TokenObtainPairView):
     pass
 
@@ -31,6 +90,32 @@ class LogoutView(generics.GenericAPIView):
         logout(request)
         return Response({'detail': 'Successfully logged out.'})
 
+class HealthCheckView(APIView):
+    """Liveness and readiness probe for load balancers and orchestrators"""
+    authentication_classes = []
+    permission_classes = [AllowAny]
+
+    def get(self, request, *args, **kwargs):
+        healthy, checks = run_health_checks()
+        return Response(
+            {'status': 'ok' if healthy else 'error', 'checks': checks},
+            status=status.HTTP_200_OK if healthy else status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+
+@require_GET
+def metrics(request):
+    """
+    Request metrics of this process for Prometheus to scrape, for staff
+    sessions or with METRICS_TOKEN as the bearer token
+    """
+    token = settings.METRICS_TOKEN.encode()
+    authorization = request.headers.get('Authorization', '').encode()
+    if not request.user.is_staff and not (token and hmac.compare_digest(authorization, b'Bearer ' + token)):
+        response = HttpResponse('Authentication required', status=401, content_type='text/plain')
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 class WarehouseViewSet(viewsets.ModelViewSet):
     queryset = Warehouse.objects.all()
     serializer_class = WarehouseSerializer
@@ -39,7 +124,7 @@ class WarehouseViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         if self.request.user.is_staff:
             return Warehouse.objects.all()
-        return self.request.user.authorized_warehouses.all()
+        return Warehouse.objects.filter(id__in=get_authorized_warehouse_ids(self.request.user))
 
     def get_permissions(self):
         if self.action in ['create', 'update', 'partial_update', 'destroy']:
@@ -56,17 +141,19 @@ class ProductViewSet(viewsets.ModelViewSet):
     serializer_class = ProductSerializer
     permission_classes = [IsAuthenticated, IsAdminUser]
 
-class WarehouseStockViewSet(viewsets.ModelViewSet):
+class WarehouseStockViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = WarehouseStock.objects.all()
     serializer_class = WarehouseStockSerializer
     permission_classes = [IsAuthenticated, HasWarehouseAccess]
+    pagination_class = WarehouseStockPagination
+    replica_read_actions = ('lookup', 'critical')
 
     def get_queryset(self):
         queryset = WarehouseStock.objects.all()
         
         if not self.request.user.is_staff:
             queryset = queryset.filter(
-                warehouse__authorized_users=self.request.user
+                warehouse_id__in=get_authorized_warehouse_ids(self.request.user)
             )
         
         # Filter by warehouse if specified
@@ -78,6 +165,14 @@ class WarehouseStockViewSet(viewsets.ModelViewSet):
         product_id = self.request.query_params.get('product', None)
         if product_id:
             queryset = queryset.filter(product_id=product_id)
+
+        # Filter by SKU without joining products
+        sku = self.request.query_params.get('sku', None)
+        if sku:
+            resolved = product_ids.resolve([sku])
+            if sku not in resolved:
+                return queryset.none()
+            queryset = queryset.filter(product_id=resolved[sku])
             
         return queryset.select_related('warehouse', 'product')
 
@@ -86,159 +181,399 @@ class WarehouseStockViewSet(viewsets.ModelViewSet):
             return [IsAuthenticated(), IsAdminUser()]
         return [IsAuthenticated(), HasWarehouseAccess()]
 
+    def list(self, request, *args, **kwargs):
+        if 'as_of' in request.query_params:
+            return self.list_as_of(request.query_params)
+        return super().list(request, *args, **kwargs)
+
+    @action(detail=False, methods=['post'])
+    def lookup(self, request):
+        """
+        Quantities of up to STOCK_LOOKUP_MAX_SKUS SKUs, optionally only in
+        the given warehouses. SKUs resolve to product ids through the
+        in-process cache, so a warm lookup is a single query on the stock table
+        """
+        serializer = StockLookupSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        skus = list(dict.fromkeys(serializer.validated_data['skus']))
+        warehouse_ids = serializer.validated_data.get('warehouses')
+
+        resolved = product_ids.resolve(skus)
+        stocks = WarehouseStock.objects.filter(product_id__in=resolved.values())
+        if not request.user.is_staff:
+            stocks = stocks.filter(warehouse_id__in=get_authorized_warehouse_ids(request.user))
+        if warehouse_ids is not None:
+            stocks = stocks.filter(warehouse_id__in=warehouse_ids)
+
+        skus_by_id = {product_id: sku for sku, product_id in resolved.items()}
+        return Response({
+            'results': [
+                {'sku': skus_by_id[product_id], 'product': product_id,
+                 'warehouse': warehouse_id, 'quantity': quantity}
+                for warehouse_id, product_id, quantity in stocks.order_by(
+                    'product_id', 'warehouse_id'
+                ).values_list('warehouse_id', 'product_id', 'quantity')
+            ],
+            'missing': [sku for sku in skus if sku not in resolved],
+        })
+
+    @action(detail=False, methods=['get'])
+    def critical(self, request):
+        """
+        Stock records at or below their product's minimum level, paged in
+        the order of the partial index that holds only critical records
+        """
+        queryset = self.filter_queryset(self.get_queryset()).filter(is_critical=True)
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    def list_as_of(self, params):
+        """Stock at a past moment, rebuilt from the nearest checkpoint and the ledger"""
+        moment = parse_datetime(params['as_of'])
+        if moment is None:
+            raise serializers.ValidationError({'as_of': 'Expected an ISO 8601 date and time'})
+        if timezone.is_naive(moment):
+            moment = timezone.make_aware(moment)
+
+        try:
+            warehouse_id = int(params['warehouse']) if params.get('warehouse') else None
+            product_id = int(params['product']) if params.get('product') else None
+        except ValueError:
+            raise serializers.ValidationError('warehouse and product must be ids')
+
+        warehouse_ids = None
+        if not self.request.user.is_staff:
+            warehouse_ids = get_authorized_warehouse_ids(self.request.user)
+        if warehouse_id is not None:
+            warehouse_ids = {warehouse_id} if warehouse_ids is None else warehouse_ids & {warehouse_id}
+        product_ids = [product_id] if product_id is not None else None
+
+        def fetch(ordering, position, limit):
+            return [
+                {'warehouse_id': warehouse_id, 'product_id': product_id, 'quantity': quantity}
+                for warehouse_id, product_id, quantity in StockCheckpoint.objects.balance_page(
+                    moment, ordering, position, limit, warehouse_ids, product_ids
+                )
+            ]
+
+        page = self.paginator.paginate(fetch, StockCheckpoint, self.request)
+        warehouse_names = dict(Warehouse.objects.filter(
+            id__in={row['warehouse_id'] for row in page}
+        ).values_list('id', 'name'))
+        product_names = dict(Product.objects.filter(
+            id__in={row['product_id'] for row in page}
+        ).values_list('id', 'name'))
 
-class StockTransactionViewSet(viewsets.ModelViewSet):
+        response = self.get_paginated_response([
+            {
+                'warehouse': row['warehouse_id'],
+                'warehouse_name': warehouse_names.get(row['warehouse_id']),
+                'product': row['product_id'],
+                'product_name': product_names.get(row['product_id']),
+                'quantity': row['quantity'],
+            }
+            for row in page
+        ])
+        response.data = {'as_of': moment, **response.data}
+        return response
+
+
+class StockTransactionViewSet(ReplicaReadMixin, viewsets.ModelViewSet):
     queryset = StockTransaction.objects.all()
     serializer_class = StockTransactionSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = StockTransactionPagination
+    # Transactions are part of the stock ledger and cannot be edited or deleted
+    http_method_names = ['get', 'post', 'head', 'options']
 
     def get_serializer_context(self):
         context = super().get_serializer_context()
         context['request'] = self.request
         return context
 
-    def validate_date_range(self, start_date, end_date):
+    def parse_date_range(self, start_date, end_date):
         if bool(start_date) != bool(end_date):
             raise serializers.ValidationError("Both start_date and end_date are required")
-        if start_date and end_date and start_date > end_date:
+        field = StockTransaction._meta.get_field('created_at')
+        try:
+            start, end = field.to_python(start_date), field.to_python(end_date)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError(e.messages)
+        start, end = [timezone.make_aware(moment) if timezone.is_naive(moment) else moment for moment in (start, end)]
+        if start > end:
             raise serializers.ValidationError("start_date cannot be after end_date")
+        return start, end
 
     def get_authorized_warehouses(self):
         user = self.request.user
         if user.is_staff:
             return Warehouse.objects.all()
-        return user.authorized_warehouses.all()
+        return Warehouse.objects.filter(id__in=get_authorized_warehouse_ids(user))
 
-    def get_queryset(self):
-        queryset = StockTransaction.objects.select_related(
-            'source_warehouse',
-            'destination_warehouse',
-            'customer',
-            'product',
-            'performed_by'
-        ).prefetch_related(
-            'source_warehouse__authorized_users',
-            'destination_warehouse__authorized_users'
-        )
-        
+    def can_access_warehouse(self, warehouse_id):
+        user = self.request.user
+        if user.is_staff:
+            return Warehouse.objects.filter(id=warehouse_id).exists()
+        return has_warehouse_access(user, int(warehouse_id))
+
+    @cached_property
+    def filters(self):
+        """
+        The validated listing filters, as keyword arguments for
+        StockTransaction.objects.matching() and the transaction rollups
+        """
         user = self.request.user
         params = self.request.query_params
         warehouse_id = params.get('warehouse')
         start_date = params.get('start_date')
         end_date = params.get('end_date')
-        transaction_type = params.get('transaction_type')
-        
-        # Validate date range if provided
+        filters = {'transaction_type': params.get('transaction_type')}
+
         if start_date or end_date:
-            self.validate_date_range(start_date, end_date)
+            filters['start'], filters['end'] = self.parse_date_range(start_date, end_date)
 
-        # Base query for authorized warehouses
-        authorized_warehouses = self.get_authorized_warehouses()
-        
+        # Restrict to authorized warehouses
         if not user.is_staff:
-            queryset = queryset.filter(
-                Q(source_warehouse__in=authorized_warehouses) |
-                Q(destination_warehouse__in=authorized_warehouses)
-            )
+            filters['warehouse_ids'] = get_authorized_warehouse_ids(user)
 
         # Apply specific warehouse filter if requested
         if warehouse_id:
-            if int(warehouse_id) not in authorized_warehouses.values_list('id', flat=True):
+            if not self.can_access_warehouse(warehouse_id):
                 raise serializers.ValidationError("You don't have access to this warehouse")
-            queryset = queryset.filter(
-                Q(source_warehouse_id=warehouse_id) |
-                Q(destination_warehouse_id=warehouse_id)
-            )
-        
-        # Apply additional filters
-        if transaction_type:
-            queryset = queryset.filter(transaction_type=transaction_type)
-            
-        if start_date and end_date:
-            queryset = queryset.filter(created_at__range=[start_date, end_date])
-        
-        return queryset.order_by('-created_at')
+            filters['warehouse_id'] = warehouse_id
+        return filters
+
+    def get_queryset(self):
+        return StockTransaction.objects.select_related(
+            'source_warehouse',
+            'destination_warehouse',
+            'customer',
+            'product',
+            'performed_by'
+        ).matching(**self.filters).order_by('-created_at')
 
-    def get_warehouse_stats(self, queryset):
-        authorized_warehouses = self.get_authorized_warehouses()
-        cache_key = f'warehouse_stats_{self.request.user.id}'
+    def get_warehouse_stats(self, filters, counts=None):
+        # Movements come from the transaction rollups, and the warehouse
+        # generations change with every write to their stock
+        user = self.request.user
+        if user.is_staff:
+            warehouse_ids = Warehouse.objects.values_list('id', flat=True)
+        else:
+            warehouse_ids = get_authorized_warehouse_ids(user)
+            if not warehouse_ids:
+                # Nothing to report, and the empty IN filter cannot be rendered as SQL
+                return {}
+        generations = sorted(get_warehouse_generations(warehouse_ids).items())
+        query_hash = hashlib.md5(f'{sorted(filters.items())}{generations}'.encode()).hexdigest()
+        cache_key = f'warehouse_stats_{user.id}_{query_hash}'
         stats = cache.get(cache_key)
         
         if stats is None:
+            # Cached under the primary's generations, so read from the primary:
+            # a lagging replica's stats would be served until the timeout
+            if router.db_for_read(StockTransactionRollup) != DEFAULT_DB_ALIAS:
+                counts = None
+            entries = Counter()
+            exits = Counter()
+            with replica_reads(False):
+                if counts is None:
+                    counts = StockTransactionRollup.objects.counts(**filters)
+                # Stock counts from the maintained per-warehouse summaries
+                warehouses = list(self.get_authorized_warehouses().annotate(
+                    products=Coalesce('stock_summary__total_skus', 0),
+                    low_stock_items=Coalesce('stock_summary__critical_skus', 0)
+                ).order_by('id').values('id', 'name', 'products', 'low_stock_items'))
+            for (source_id, destination_id, _, _), count in counts.items():
+                entries[destination_id] += count
+                exits[source_id] += count
+
             stats = {}
-            for warehouse in authorized_warehouses:
-                warehouse_transactions = queryset.filter(
-                    Q(source_warehouse=warehouse) |
-                    Q(destination_warehouse=warehouse)
-                )
-                
-                stats[warehouse.name] = {
-                    'id': warehouse.id,
-                    'Entry': warehouse_transactions.filter(
-                        destination_warehouse=warehouse
-                    ).count(),
-                    'Exit': warehouse_transactions.filter(
-                        source_warehouse=warehouse
-                    ).count(),
-                    'products': WarehouseStock.objects.filter(
-                        warehouse=warehouse
-                    ).count(),
-                    'low_stock_items': WarehouseStock.objects.filter(
-                        warehouse=warehouse,
-                        quantity__lte=F('product__minimum_stock')
-                    ).count()
+            for warehouse in warehouses:
+                stats[warehouse['name']] = {
+                    'id': warehouse['id'],
+                    'Entry': entries[warehouse['id']],
+                    'Exit': exits[warehouse['id']],
+                    'products': warehouse['products'],
+                    'low_stock_items': warehouse['low_stock_items']
                 }
-            cache.set(cache_key, stats, timeout=300)  # 5 minutes
+            cache.set(cache_key, stats, timeout=settings.WAREHOUSE_STATS_CACHE_TIMEOUT)
         
         return stats
 
     def list(self, request, *args, **kwargs):
         queryset = self.get_queryset()
-        warehouse_stats = self.get_warehouse_stats(queryset)
-        
-        page = self.paginate_queryset(queryset)
+        warehouse_stats = self.get_warehouse_stats(self.filters)
+
+        # Listings are read-only, so rows skip the model serializer
+        rows = StockTransactionRowSerializer.get_queryset(queryset)
+        page = self.paginate_queryset(rows)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            response = self.get_paginated_response(serializer.data)
+            response = self.get_paginated_response(StockTransactionRowSerializer.to_representation(page))
             response.data = {
                 'warehouse_stats': warehouse_stats,
                 **response.data
             }
             return response
 
-        serializer = self.get_serializer(queryset, many=True)
         return Response({
             'warehouse_stats': warehouse_stats,
-            'results': serializer.data
+            'results': StockTransactionRowSerializer.to_representation(rows)
         })
 
     def perform_create(self, serializer):
         user = self.request.user
-        data = self.request.data
-        source_id = data.get('source_warehouse')
-        dest_id = data.get('destination_warehouse')
+        source_warehouse = serializer.validated_data.get('source_warehouse')
+        dest_warehouse = serializer.validated_data.get('destination_warehouse')
         
-        if source_id and dest_id and source_id == dest_id:
+        if source_warehouse and dest_warehouse and source_warehouse == dest_warehouse:
                 raise serializers.ValidationError(
                     {'error': 'Source and destination warehouses cannot be the same'}
                 )
 
         # Verify warehouse access
-        if source_id:
-            source_warehouse = get_object_or_404(Warehouse, id=source_id)
-            if not user.is_staff and user not in source_warehouse.authorized_users.all():
+        if source_warehouse:
+            if not user.is_staff and not has_warehouse_access(user, source_warehouse.id):
                 raise serializers.ValidationError(
                     {'source_warehouse': 'You do not have access to this warehouse'}
                 )
                 
-        if dest_id:
-            dest_warehouse = get_object_or_404(Warehouse, id=dest_id)
-            if not user.is_staff and user not in dest_warehouse.authorized_users.all():
+        if dest_warehouse:
+            if not user.is_staff and not has_warehouse_access(user, dest_warehouse.id):
                 raise serializers.ValidationError(
                     {'destination_warehouse': 'You do not have access to this warehouse'}
                 )
         
-        serializer.save(performed_by=user)
+        try:
+            serializer.save(performed_by=user)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError({'error': e.messages})
+
+    def get_missing_references(self, rows):
+        """Per-row errors for ids that do not exist, using one query per model"""
+        references = [
+            ('source_warehouse', 'source_warehouse_id', Warehouse),
+            ('destination_warehouse', 'destination_warehouse_id', Warehouse),
+            ('customer', 'customer_id', Customer),
+            ('product', 'product_id', Product),
+        ]
+        requested = {}
+        for _, attr, model in references:
+            requested.setdefault(model, set()).update(
+                row[attr] for row in rows if row.get(attr)
+            )
+        existing = {
+            model: set(model.objects.filter(id__in=ids).values_list('id', flat=True))
+            for model, ids in requested.items()
+        }
+
+        errors = {}
+        for index, row in enumerate(rows):
+            for field, attr, model in references:
+                if row.get(attr) and row[attr] not in existing[model]:
+                    errors.setdefault(index, {})[field] = [f'Invalid pk "{row[attr]}" - object does not exist.']
+        return errors
+
+    def row_errors_response(self, row_errors):
+        return Response(
+            {'errors': [
+                {'row': index, 'errors': errors}
+                for index, errors in row_errors if errors
+            ]},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser, NDJSONParser])
+    def bulk_create(self, request):
+        """
+        Record a batch of transactions sent as a JSON array or NDJSON stream.
+        The batch is applied atomically: any row error rejects the whole batch
+        """
+        rows = request.data
+        if not isinstance(rows, list):
+            return Response(
+                {'error': 'Expected a list of transactions'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        warehouse_ids = None
+        if not request.user.is_staff:
+            warehouse_ids = get_authorized_warehouse_ids(request.user)
+
+        serializer = BulkStockTransactionSerializer(
+            data=rows, many=True, context={'warehouse_ids': warehouse_ids}
+        )
+        if not serializer.is_valid():
+            return self.row_errors_response(enumerate(serializer.errors))
+
+        validated_rows = serializer.validated_data
+        missing = self.get_missing_references(validated_rows)
+        if missing:
+            return self.row_errors_response(sorted(missing.items()))
+
+        transactions = [
+            StockTransaction(performed_by=request.user, **row) for row in validated_rows
+        ]
+        try:
+            created = StockTransaction.objects.record_many(transactions)
+        except DjangoValidationError as e:
+            shortfalls = {
+                (error.params['warehouse'], error.params['product']): error.messages
+                for error in e.error_list
+            }
+            row_errors = []
+            for index, stock_transaction in enumerate(transactions):
+                messages = [
+                    message
+                    for key, _ in stock_transaction.stock_deltas()
+                    for message in shortfalls.get(key, [])
+                ]
+                if messages:
+                    row_errors.append((index, {'non_field_errors': messages}))
+            return self.row_errors_response(row_errors)
+
+        return Response({'created': len(created)}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """
+        Stream the filtered transaction history, oldest first, as CSV or
+        NDJSON (?file_format=), optionally gzip compressed (?gzip=1). Rows
+        are read from the archives and the database in chunks as the
+        response is sent, through an async iterator under ASGI
+        """
+        file_format = request.query_params.get('file_format', 'csv')
+        if file_format not in ('csv', 'ndjson'):
+            return Response(
+                {'error': 'file_format must be csv or ndjson'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        compress = request.query_params.get('gzip') in ('1', 'true')
+
+        queryset = StockTransactionRowSerializer.get_queryset(
+            self.get_queryset().order_by('created_at', 'id')
+        )
+        # Archived months come first, being older than anything left in the
+        # database. Pin the database now; the rows are read after the view returns
+        rows = StockTransactionRowSerializer.iter_representation(chain(
+            iter_archived_rows(**self.filters),
+            queryset.using(queryset.db).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+        ))
+
+        if file_format == 'csv':
+            fields = list(StockTransactionRowSerializer.fields) + list(StockTransactionRowSerializer.names)
+            content, content_type = iter_csv(rows, fields), 'text/csv'
+        else:
+            content, content_type = iter_ndjson(rows), 'application/x-ndjson'
+        filename = f"stock_transactions_{timezone.now().strftime('%Y%m%d_%H%M%S')}.{file_format}"
+        if compress:
+            content, content_type, filename = iter_gzip(content), 'application/gzip', f'{filename}.gz'
+        if isinstance(request._request, ASGIRequest):
+            content = aiter_chunks(content)
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
 
     @action(detail=False, methods=['get'])
     def available_warehouses(self, request):
@@ -251,24 +586,97 @@ class StockTransactionViewSet(viewsets.ModelViewSet):
     def warehouse_summary(self, request):
         """Detailed summary of warehouse statistics"""
         warehouse_id = request.query_params.get('warehouse')
-        if warehouse_id and not self.get_authorized_warehouses().filter(id=warehouse_id).exists():
+        if warehouse_id and not self.can_access_warehouse(warehouse_id):
             return Response(
                 {'error': 'You do not have access to this warehouse'},
                 status=status.HTTP_403_FORBIDDEN
             )
             
-        queryset = self.get_queryset()
-        if warehouse_id:
-            queryset = queryset.filter(
-                Q(source_warehouse_id=warehouse_id) |
-                Q(destination_warehouse_id=warehouse_id)
-            )
-            
+        # Counted from the hourly and daily rollups, not the transactions
+        filters = self.filters
+        counts = StockTransactionRollup.objects.counts(**filters)
+        transaction_types = Counter()
+        transfer_types = Counter()
+        for (_, _, transaction_type, transfer_type), count in counts.items():
+            transaction_types[transaction_type] += count
+            transfer_types[transfer_type] += count
+
         summary = {
-            'transaction_types': queryset.values('transaction_type').annotate(count=Count('id', distinct=True)).order_by('transaction_type'),
-            'transfer_types': queryset.values('transfer_type').annotate(count=Count('id', distinct=True)).order_by('transfer_type'),
-            'top_products': queryset.values('product__name').annotate(count=Count('id', distinct=True)).order_by('-count')[:5],
-            'warehouse_stats': self.get_warehouse_stats(queryset)
+            'transaction_types': [
+                {'transaction_type': transaction_type, 'count': count}
+                for transaction_type, count in sorted(transaction_types.items())
+            ],
+            'transfer_types': [
+                {'transfer_type': transfer_type, 'count': count}
+                for transfer_type, count in sorted(
+                    transfer_types.items(), key=lambda item: (item[0] is None, item[0] or '')
+                )
+            ],
+            'top_products': [
+                {'product__name': name, 'count': count}
+                for _, name, count in StockTransactionRollup.objects.top_products(5, **filters)
+            ],
+            'warehouse_stats': self.get_warehouse_stats(filters, counts)
         }
         
-        return Response(summary)
\ No newline at end of file
+        return Response(summary)
+
+
+class StockReservationViewSet(viewsets.ModelViewSet):
+    """
+    Hold units for an order while it is picked, then confirm the hold into
+    a withdrawal or release it. Holds not confirmed or released by their
+    expiry are released by the expire_stock_reservations task
+    """
+    queryset = StockReservation.objects.all()
+    serializer_class = StockReservationSerializer
+    permission_classes = [IsAuthenticated, HasWarehouseAccess]
+    pagination_class = StockReservationPagination
+    http_method_names = ['get', 'post', 'head', 'options']
+
+    def get_queryset(self):
+        queryset = StockReservation.objects.all()
+        if not self.request.user.is_staff:
+            queryset = queryset.filter(warehouse_id__in=get_authorized_warehouse_ids(self.request.user))
+
+        warehouse_id = self.request.query_params.get('warehouse', None)
+        if warehouse_id:
+            queryset = queryset.filter(warehouse_id=warehouse_id)
+
+        reservation_status = self.request.query_params.get('status', None)
+        if reservation_status:
+            queryset = queryset.filter(status=reservation_status)
+        return queryset
+
+    @action(detail=True, methods=['post'])
+    def confirm(self, request, pk=None):
+        """
+        Record the withdrawal of the reserved units, e.g.
+        {"transaction_type": "WC", "customer": 3}. The source warehouse,
+        product and quantity are the reservation's
+        """
+        reservation = self.get_object()
+        data = dict(request.data.items())
+        data.update(
+            source_warehouse=reservation.warehouse_id, product=reservation.product_id, quantity=reservation.quantity
+        )
+        serializer = StockTransactionSerializer(data=data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+
+        stock_transaction = StockTransaction(**serializer.validated_data, performed_by=request.user)
+        try:
+            reservation.confirm(stock_transaction)
+        except DjangoValidationError as e:
+            raise serializers.ValidationError({'error': e.messages})
+        serializer = StockTransactionSerializer(stock_transaction, context=self.get_serializer_context())
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @action(detail=True, methods=['post'])
+    def release(self, request, pk=None):
+        """Give the reserved units back before the reservation expires"""
+        reservation = self.get_object()
+        try:
+            reservation.release()
+        except DjangoValidationError as e:
+            raise serializers.ValidationError({'error': e.messages})
+        return Response(self.get_serializer(reservation).data)
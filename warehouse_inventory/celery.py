@@ -21,8 +21,44 @@ app.conf.beat_schedule = {
         'task': 'inventory.tasks.send_stock_status_report',
         'schedule': crontab(hour=23, minute=00),
     },
+    'send-critical-stock-digest': {
+        'task': 'inventory.tasks.send_critical_stock_digest',
+        'schedule': crontab(minute='*/15'),
+    },
+    'create-stock-checkpoint': {
+        'task': 'inventory.tasks.create_stock_checkpoint',
+        'schedule': crontab(minute=0),
+    },
+    'rebuild-transaction-rollups': {
+        'task': 'inventory.tasks.rebuild_transaction_rollups',
+        'schedule': crontab(hour=2, minute=30),
+    },
+    'archive-stock-transactions': {
+        'task': 'inventory.tasks.archive_stock_transactions',
+        'schedule': crontab(hour=3, minute=0),
+    },
+    'expire-stock-reservations': {
+        'task': 'inventory.tasks.expire_stock_reservations',
+        'schedule': crontab(),
+    },
+    'prune-critical-stock-events': {
+        'task': 'inventory.tasks.prune_critical_stock_events',
+        'schedule': crontab(hour=3, minute=30),
+    },
 }
 
+@app.task(name='warehouse_inventory.health_check')
+def health_check():
+    """
+    Run the service health checks inside a worker. Monitoring sends it and
+    waits for the result to confirm workers can reach the database and cache
+    """
+    from inventory.health import run_health_checks
+    healthy, checks = run_health_checks()
+    if not healthy:
+        raise RuntimeError(f'Worker health check failed: {checks}')
+    return checks
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
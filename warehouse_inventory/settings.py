@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 from datetime import timedelta
 
@@ -47,6 +49,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'inventory.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,6 +83,12 @@ WSGI_APPLICATION = 'warehouse_inventory.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# Seconds a database connection is reused across requests and Celery tasks
+# (0 reconnects every time). Health checks replace connections that the
+# server dropped before they are reused. asgi.py sets it to 0 because ASGI
+# requests run their database work in short-lived per-request threads.
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
@@ -88,9 +97,27 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': 'localhost',
         'PORT': '5432',
-    }
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+    },
+    # Streaming replica of default, used for reports and API listings
+    'replica': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': 'inventory_db',
+        'USER': 'postgres',
+        'PASSWORD': '',
+        'HOST': 'localhost',
+        'PORT': '5432',
+        'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    },
 }
 
+DATABASE_ROUTERS = ['inventory.routers.PrimaryReplicaRouter']
+REPLICA_DATABASE = 'replica'  # None sends every read to default
+REPLICA_STICKY_SECONDS = 10  # a user's reads stay on default this long after they write
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -159,9 +186,75 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # settings.py
 
+# Shared by every web and worker process so invalidation reaches all of them.
+# The test runner uses a local in-memory cache instead of Redis.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://localhost:6379/1',
+        'KEY_PREFIX': 'inventory',
+    }
+}
+if 'test' in sys.argv:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+    # Test cases opt in to replica routing with override_settings
+    REPLICA_DATABASE = None
+
 CELERY_BROKER_URL = 'redis://localhost:6379/0'
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
 
-
-
-
+# Critical stock alerts
+CRITICAL_STOCK_ALERT_WINDOW = 60 * 60  # seconds before the same warehouse/product alerts again
+CRITICAL_STOCK_ALERT_DIGEST = False  # queue alerts for the periodic digest email instead
+CRITICAL_STOCK_RECIPIENTS_CACHE_TIMEOUT = 300
+CRITICAL_STOCK_STREAM_POLL_INTERVAL = 1  # seconds between checks of an open stream for new events
+CRITICAL_STOCK_STREAM_HEARTBEAT = 15  # seconds between keep-alive comments on an idle stream
+CRITICAL_STOCK_STREAM_TIMEOUT = 5 * 60  # seconds before a stream ends and the client reconnects
+CRITICAL_STOCK_STREAM_RETRY = 1000  # milliseconds clients wait before reconnecting
+CRITICAL_STOCK_STREAM_LOOKBACK = 60  # seconds an event may take from insert to commit and still be streamed
+CRITICAL_STOCK_EVENT_RETENTION_DAYS = 7  # older critical stock events are pruned daily
+AUTHORIZED_WAREHOUSES_CACHE_TIMEOUT = 300  # per-user warehouse ids used by access checks
+PRODUCT_SKU_CACHE_TIMEOUT = 60 * 60  # products looked up by SKU; dropped when a product changes
+PRODUCT_ID_CACHE_SIZE = 100_000  # SKU to product id entries kept in each process
+STOCK_LOOKUP_MAX_SKUS = 5000  # SKUs accepted by one POST /api/warehouse-stocks/lookup/
+STOCK_RESERVATION_TTL = 5 * 60  # seconds a stock reservation holds its units unless the request asks otherwise
+STOCK_RESERVATION_MAX_TTL = 60 * 60  # longest hold a request may ask for
+ADMIN_EXACT_COUNT_LIMIT = 100_000  # bigger unfiltered admin changelists show the planner's row estimate
+
+# Most SQL queries a request to the view (or viewset action) should run;
+# RequestMetricsMiddleware logs a warning for requests over budget
+QUERY_BUDGETS = {
+    'StockTransactionViewSet.list': 5,
+    'StockTransactionViewSet.warehouse_summary': 6,
+    'WarehouseStockViewSet.list': 5,
+    'WarehouseStockViewSet.lookup': 4,
+    'WarehouseStockViewSet.critical': 5,
+    'stock_lookup': 3,
+    'stock_lookup_by_sku': 4,
+}
+# Bearer token Prometheus sends to /api/metrics/; staff sessions need none
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+WAREHOUSE_STATS_CACHE_TIMEOUT = 60 * 60  # stock writes invalidate cached stats right away
+
+# Stock ledger checkpoints, taken hourly by Celery beat
+STOCK_CHECKPOINT_LAG = 5 * 60  # seconds; must exceed the longest stock transaction
+STOCK_CHECKPOINT_HOURLY_DAYS = 7  # older checkpoints are thinned to the first of each day
+
+# Rows fetched per round trip when streaming transaction exports
+EXPORT_CHUNK_SIZE = 2000
+
+# Transaction history, partitioned by month on PostgreSQL and archived by Celery beat
+TRANSACTION_PARTITION_MONTHS_AHEAD = 3  # monthly partitions created before they are needed
+TRANSACTION_ARCHIVE_AFTER_MONTHS = 12  # closed months older than this move to archive files
+TRANSACTION_ARCHIVE_DIR = os.environ.get('TRANSACTION_ARCHIVE_DIR', str(BASE_DIR / 'archive'))
+
+# Daily stock report
+STOCK_REPORT_PDF_MAX_ROWS = 20000  # larger inventories are sent as compressed CSV
+STOCK_REPORT_MAX_ATTACHMENT_SIZE = 20 * 1024 * 1024  # bytes; larger reports are not attached
+STOCK_REPORT_PDF_WORKERS = None  # processes rendering warehouse PDFs, None for one per CPU
+# Only a worker started with --pool=solo or --pool=threads can start them; prefork
+# pool processes are daemonic, so there the PDFs are rendered serially with a warning